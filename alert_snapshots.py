@@ -0,0 +1,134 @@
+import os
+import uuid
+
+from datetime import datetime, timezone
+from io import BytesIO
+from nypl_py_utils.functions.log_helper import create_log
+
+logger = create_log("alert_snapshots")
+
+_DEFAULT_SNAPSHOT_DIR = "/tmp"
+_DEFAULT_SNAPSHOT_COMPRESSION = "zstd"
+
+# The file extension of each snapshot format
+_EXTENSIONS = {"parquet": "parquet", "arrow": "arrow"}
+
+
+def write_alerts_snapshot(alerts_df, closure_alerts_table):
+    """
+    Writes the alerts to a columnar snapshot so that they can be re-aggregated
+    after they are deleted from the staging table. ALERTS_SNAPSHOT_FORMAT picks
+    between Parquet and the Arrow IPC file format, and ALERTS_SNAPSHOT_COMPRESSION
+    the codec (zstd by default, or "uncompressed"). The snapshot is uploaded to
+    ALERTS_SNAPSHOT_BUCKET if it is set, and is otherwise written to
+    ALERTS_SNAPSHOT_DIR (/tmp by default). Nothing is written when
+    DO_NOT_UPDATE is set.
+
+    Parameters
+    ----------
+    alerts_df: DataFrame
+        The alerts, as built by closure_engine.build_alerts_df
+    closure_alerts_table: str
+        The name of the staging table, which prefixes the snapshot's name
+
+    Returns
+    -------
+    str or None
+        The path or S3 URL of the snapshot, or None if it wasn't written
+    """
+    snapshot_format = os.environ["ALERTS_SNAPSHOT_FORMAT"]
+    if snapshot_format not in _EXTENSIONS:
+        logger.error(f"Unknown alerts snapshot format: {snapshot_format}")
+        raise AlertSnapshotError(f"Unknown alerts snapshot format: {snapshot_format}")
+    compression = os.environ.get(
+        "ALERTS_SNAPSHOT_COMPRESSION", _DEFAULT_SNAPSHOT_COMPRESSION
+    )
+    name = "{table}-{timestamp}-{id}.{extension}".format(
+        table=closure_alerts_table,
+        timestamp=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H%M%S"),
+        id=uuid.uuid4().hex,
+        extension=_EXTENSIONS[snapshot_format],
+    )
+    if os.environ.get("DO_NOT_UPDATE", False) == "True":
+        logger.info(f"Not writing snapshot of {len(alerts_df)} alerts to {name}")
+        return None
+
+    bucket = os.environ.get("ALERTS_SNAPSHOT_BUCKET")
+    try:
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(alerts_df, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        _write_table(table, sink, snapshot_format, compression)
+        snapshot = sink.getvalue()
+        if bucket:
+            import boto3
+
+            location = "s3://{bucket}/{key}".format(bucket=bucket, key=name)
+            s3_client = boto3.client(
+                "s3", region_name=os.environ.get("AWS_REGION", "us-east-1")
+            )
+            s3_client.upload_fileobj(BytesIO(snapshot.to_pybytes()), bucket, name)
+            s3_client.close()
+        else:
+            location = os.path.join(
+                os.environ.get("ALERTS_SNAPSHOT_DIR", _DEFAULT_SNAPSHOT_DIR), name
+            )
+            with open(location, "wb") as f:
+                f.write(snapshot)
+    except Exception as e:
+        # The alerts are deleted once the run finishes, so the run fails rather
+        # than losing them without a snapshot
+        logger.error(f"Error writing alerts snapshot: {e}")
+        raise AlertSnapshotError(f"Error writing alerts snapshot: {e}") from None
+
+    logger.info(
+        "Wrote snapshot of {count} alerts to {location}".format(
+            count=len(alerts_df), location=location
+        )
+    )
+    return location
+
+
+def read_alerts_table(path):
+    """
+    Memory maps a local snapshot and returns it as an Arrow table. Columns of
+    an uncompressed Arrow IPC snapshot refer directly to the mapped file, so
+    nothing is copied until the table is converted.
+    """
+    import pyarrow as pa
+
+    if path.endswith("." + _EXTENSIONS["parquet"]):
+        import pyarrow.parquet as pq
+
+        return pq.read_table(path, memory_map=True)
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_alerts_snapshot(path):
+    """
+    Reads a local snapshot back into the same DataFrame that was written,
+    ready to pass to get_closures or get_closures_by_day
+    """
+    return read_alerts_table(path).to_pandas()
+
+
+def _write_table(table, sink, snapshot_format, compression):
+    import pyarrow as pa
+
+    codec = None if compression == "uncompressed" else compression
+    if snapshot_format == "parquet":
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, sink, compression=codec or "none")
+    else:
+        with pa.ipc.new_file(
+            sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=codec)
+        ) as writer:
+            writer.write_table(table)
+
+
+class AlertSnapshotError(Exception):
+    def __init__(self, message=None):
+        self.message = message
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+from datetime import time
+from query_helper import GET_ALERTS_COLUMNS
+
+_POLLER_LOCATION_ID = "location_closure_alert_poller"
+
+# Opening and closing times are drawn from these, which roughly match the
+# spread of regular hours across branches
+_REGULAR_OPENS = [time(9), time(10), time(10, 30), time(11), time(13)]
+_REGULAR_CLOSES = [time(17), time(18), time(19), time(20)]
+
+
+def generate_alerts_df(
+    location_count=100,
+    alerts_per_location=2,
+    polling_interval=5,
+    system_alert_share=0.05,
+    extended_closure_share=0.05,
+    missing_hours_share=0.05,
+    missed_poll_share=0.02,
+    polling_date="2023-01-01",
+    polling_hours=(6, 21),
+    seed=0,
+):
+    """
+    Generates a synthetic day of closure alerts in the same schema as the
+    DataFrame built by lambda_handler, i.e. the columns of the alerts query
+    with the datetime columns in UTC.
+
+    Parameters
+    ----------
+    location_count: int, optional
+        The number of branches posting alerts
+    alerts_per_location: int, optional
+        The number of alerts posted by each branch
+    polling_interval: int, optional
+        The number of minutes between each poll
+    system_alert_share: float, optional
+        The share of alerts that are system-wide, i.e. have a NULL location id
+    extended_closure_share: float, optional
+        The share of alerts that are extended closures lasting months
+    missing_hours_share: float, optional
+        The share of branches without any regular hours
+    missed_poll_share: float, optional
+        The share of polls at which a live alert is randomly not seen
+    polling_date: str, optional
+        The Eastern date on which the polling occurred
+    polling_hours: tuple, optional
+        The Eastern hours between which the poller runs
+    seed: int, optional
+        The random seed, so that the same inputs always generate the same data
+
+    Returns
+    -------
+    DataFrame
+        One row per poll at which each alert was seen, along with one poller
+        heartbeat row per poll
+    """
+    rng = np.random.default_rng(seed)
+    day_start = pd.Timestamp(polling_date, tz="US/Eastern")
+    polls = pd.date_range(
+        start=day_start + pd.Timedelta(hours=polling_hours[0], seconds=83),
+        end=day_start + pd.Timedelta(hours=polling_hours[1]),
+        freq="{}min".format(polling_interval),
+    ).tz_convert("UTC")
+    n_polls = len(polls)
+
+    # Each branch has either a single set of regular hours or none at all
+    location_ids = np.array(["loc{:05d}".format(i) for i in range(location_count)])
+    location_names = np.array(["Library {}".format(i) for i in range(location_count)])
+    location_opens = rng.choice(np.array(_REGULAR_OPENS, dtype=object), location_count)
+    location_closes = rng.choice(
+        np.array(_REGULAR_CLOSES, dtype=object), location_count
+    )
+    is_missing_hours = rng.random(location_count) < missing_hours_share
+    location_opens[is_missing_hours] = None
+    location_closes[is_missing_hours] = None
+
+    n_alerts = location_count * alerts_per_location
+    alert_locations = np.repeat(np.arange(location_count), alerts_per_location)
+    is_system = rng.random(n_alerts) < system_alert_share
+    is_extended = rng.random(n_alerts) < extended_closure_share
+
+    # Alerts are posted and taken down at random polls. Most of them are for a
+    # closure of a few hours within the polling window, but extended closures
+    # last for months on either side of the polling date.
+    first_poll = rng.integers(0, n_polls, n_alerts)
+    last_poll = np.minimum(first_poll + rng.integers(0, n_polls, n_alerts), n_polls - 1)
+    closure_start = polls[first_poll] + pd.to_timedelta(
+        rng.integers(-90, 90, n_alerts), unit="min"
+    )
+    closure_end = polls[last_poll] + pd.to_timedelta(
+        rng.integers(-90, 90, n_alerts), unit="min"
+    )
+    closure_end = closure_end.where(closure_end > closure_start, polls[last_poll])
+    closure_start = closure_start.where(
+        ~is_extended, closure_start - pd.Timedelta(days=90)
+    )
+    closure_end = closure_end.where(~is_extended, closure_end + pd.Timedelta(days=90))
+
+    polls_seen = last_poll - first_poll + 1
+    row_alerts = np.repeat(np.arange(n_alerts), polls_seen)
+    row_polls = np.arange(len(row_alerts)) - np.repeat(
+        np.cumsum(polls_seen) - polls_seen, polls_seen
+    )
+    row_polls += first_poll[row_alerts]
+    is_seen = rng.random(len(row_alerts)) >= missed_poll_share
+    is_seen[np.cumsum(polls_seen) - 1] = True
+    row_alerts = row_alerts[is_seen]
+    row_polls = row_polls[is_seen]
+
+    row_locations = alert_locations[row_alerts]
+    row_is_system = is_system[row_alerts]
+    alerts_df = pd.DataFrame(
+        {
+            "location_id": np.where(row_is_system, None, location_ids[row_locations]),
+            "name": np.where(row_is_system, None, location_names[row_locations]),
+            "alert_id": np.char.mod("%d", row_alerts).astype(object),
+            "closed_for": np.char.mod("Closure %d", row_alerts).astype(object),
+            "extended_closing": is_extended[row_alerts],
+            "alert_start": closure_start[row_alerts],
+            "alert_end": closure_end[row_alerts],
+            "polling_datetime": polls[row_polls],
+            "regular_open": np.where(
+                row_is_system, None, location_opens[row_locations]
+            ),
+            "regular_close": np.where(
+                row_is_system, None, location_closes[row_locations]
+            ),
+        },
+        columns=GET_ALERTS_COLUMNS,
+    )
+
+    # These are the fake alerts created by the LocationClosureAlertPoller to
+    # record each polling datetime
+    poller_df = pd.DataFrame(
+        {
+            "location_id": [_POLLER_LOCATION_ID] * n_polls,
+            "polling_datetime": polls,
+        },
+        columns=GET_ALERTS_COLUMNS,
+    ).astype({"alert_start": "datetime64[ns, UTC]", "alert_end": "datetime64[ns, UTC]"})
+    return pd.concat([poller_df, alerts_df], ignore_index=True)
+
+
+def generate_alert_rows(**kwargs):
+    """
+    Generates the same alerts as generate_alerts_df, but as the list of tuples
+    that RedshiftClient.execute_query returns. Missing values are None.
+    """
+    alerts_df = generate_alerts_df(**kwargs)
+    alerts_df = alerts_df.astype(object).where(alerts_df.notnull(), None)
+    return list(alerts_df.itertuples(index=False, name=None))
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import pickle
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.alert_generator import generate_alert_rows
+from benchmarks.run_benchmarks import _BENCHMARK_ENV_VARS
+
+_PATHS = ["rows", "dataframe"]
+
+# Run in a fresh interpreter for every measurement so that nothing has been
+# imported yet, as in a cold Lambda container. The input rows only hold
+# standard library types, so loading them doesn't import pandas.
+_CHILD_SCRIPT = """
+import json
+import pickle
+import sys
+import time
+
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+
+with open(sys.argv[2], "rb") as f:
+    raw_alerts = pickle.load(f)
+loaded = time.perf_counter()
+if sys.argv[1] == "rows":
+    lambda_function.get_closures_from_rows(raw_alerts)
+else:
+    import pandas as pd
+    from query_helper import GET_ALERTS_COLUMNS
+
+    lambda_function.get_closures(
+        pd.DataFrame(data=raw_alerts, columns=GET_ALERTS_COLUMNS)
+    )
+finished = time.perf_counter()
+print(
+    json.dumps(
+        {
+            "import_time": imported - start,
+            "first_result_time": (imported - start) + (finished - loaded),
+            "pandas_imported": "pandas" in sys.modules,
+        }
+    )
+)
+"""
+
+
+def measure_cold_start(path, rows_file, repeat=5):
+    """
+    Measures the time to import lambda_function and the time to the first
+    closures (import plus aggregation) for the given path, each in a fresh
+    Python process
+
+    Parameters
+    ----------
+    path: str
+        Either "rows", for get_closures_from_rows, or "dataframe", for
+        get_closures
+    rows_file: str
+        The path to the pickled alert rows
+    repeat: int, optional
+        The number of processes to start. The median of each time is reported.
+
+    Returns
+    -------
+    dict
+        The median import time and time to first result in seconds, and
+        whether pandas was imported
+    """
+    env = dict(os.environ, **_BENCHMARK_ENV_VARS)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.getcwd()] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _CHILD_SCRIPT, path, rows_file],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "path": path,
+        "import_time": statistics.median(run["import_time"] for run in runs),
+        "first_result_time": statistics.median(
+            run["first_result_time"] for run in runs
+        ),
+        "pandas_imported": runs[0]["pandas_imported"],
+    }
+
+
+def run_cold_start_benchmarks(location_counts, repeat=5, **generator_kwargs):
+    """
+    Measures the cold start of each aggregation path for each of the given
+    location counts
+
+    Parameters
+    ----------
+    location_counts: list<int>
+        The number of branches to generate alerts for in each run
+    repeat: int, optional
+        The number of fresh processes to measure each path in
+    generator_kwargs:
+        Any other arguments are passed to the alert generator
+
+    Returns
+    -------
+    list<dict>
+        The measurements for each path and location count
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for location_count in location_counts:
+            raw_alerts = [
+                tuple(
+                    value.to_pydatetime() if hasattr(value, "to_pydatetime") else value
+                    for value in row
+                )
+                for row in generate_alert_rows(
+                    location_count=location_count, **generator_kwargs
+                )
+            ]
+            rows_file = os.path.join(temp_dir, "{}.pickle".format(location_count))
+            with open(rows_file, "wb") as f:
+                pickle.dump(raw_alerts, f)
+            for path in _PATHS:
+                result = measure_cold_start(path, rows_file, repeat)
+                result["locations"] = location_count
+                result["rows"] = len(raw_alerts)
+                results.append(result)
+    return results
+
+
+def format_results(results):
+    lines = [
+        "{:>9}  {:>9}  {:<10}{:>12}  {:>18}  {:>7}".format(
+            "locations", "rows", "path", "import (s)", "first result (s)", "pandas"
+        )
+    ]
+    for result in results:
+        lines.append(
+            "{locations:>9}  {rows:>9}  {path:<10}{import_time:>12.4f}  "
+            "{first_result_time:>18.4f}  {pandas_imported!s:>7}".format(**result)
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the cold start of each closure aggregation path"
+    )
+    parser.add_argument("--locations", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--alerts-per-location", type=int, default=2)
+    parser.add_argument("--polling-interval", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="Optional path to also write the results to as JSON"
+    )
+    args = parser.parse_args()
+
+    results = run_cold_start_benchmarks(
+        args.locations,
+        repeat=args.repeat,
+        alerts_per_location=args.alerts_per_location,
+        polling_interval=args.polling_interval,
+        seed=args.seed,
+    )
+    print(format_results(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
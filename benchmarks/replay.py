@@ -0,0 +1,447 @@
+import argparse
+import csv
+import os
+import re
+import zlib
+
+from benchmarks.run_benchmarks import _BENCHMARK_ENV_VARS, LocalKmsClient
+from datetime import datetime, time, timezone
+from query_helper import (
+    CLOSURES_COLUMNS,
+    STATE_COLUMNS,
+    build_close_cursor_query,
+    build_delete_closures_for_date_query,
+    build_delete_consumed_alerts_query,
+    build_delete_state_query,
+    build_get_alerts_query,
+    build_get_current_hours_query,
+    build_get_hours_version_query,
+    build_get_incremental_alerts_query,
+    build_get_polling_datetimes_query,
+    build_get_reduced_alerts_query,
+    build_get_sorted_alerts_query,
+    build_get_staged_alerts_query,
+    build_get_state_query,
+    build_insert_state_query,
+    build_multi_row_insert_query,
+)
+from unittest import mock
+
+# The handler's table names when REDSHIFT_DB_NAME is production, which the
+# replay uses so that the names have no suffix
+HOURS_TABLE = "location_hours_v2"
+CLOSURES_TABLE = "location_closures_v2"
+CLOSURE_ALERTS_TABLE = "location_closure_alerts_v2"
+STATE_TABLE = "location_closure_aggregator_state_v2"
+
+# The columns of each snapshot file, which must have a header row
+STAGED_ALERTS_COLUMNS = [
+    "location_id",
+    "name",
+    "alert_id",
+    "closed_for",
+    "extended_closing",
+    "alert_start",
+    "alert_end",
+    "polling_datetime",
+]
+HOURS_COLUMNS = [
+    "location_id",
+    "weekday",
+    "regular_open",
+    "regular_close",
+    "is_current",
+]
+
+_DECLARE_CURSOR_PATTERN = re.compile(r"DECLARE (\w+) CURSOR FOR (.*)", re.DOTALL)
+_FETCH_CURSOR_PATTERN = re.compile(r"FETCH FORWARD (\d+) FROM (\w+);")
+
+
+def load_alerts_snapshot(path):
+    """
+    Loads a CSV snapshot of the closure alerts staging table, e.g. one written
+    by psql's \\copy with the CSV HEADER options. Empty values are NULL, and
+    timestamps without a UTC offset are taken to be in UTC.
+
+    Returns
+    -------
+    list<tuple>
+        The rows, in the column order of STAGED_ALERTS_COLUMNS
+    """
+    parsers = {
+        "extended_closing": _parse_bool,
+        "alert_start": _parse_datetime,
+        "alert_end": _parse_datetime,
+        "polling_datetime": _parse_datetime,
+    }
+    return _load_snapshot(path, STAGED_ALERTS_COLUMNS, parsers)
+
+
+def load_hours_snapshot(path):
+    """
+    Loads a CSV snapshot of the location hours table in the same format as
+    load_alerts_snapshot
+
+    Returns
+    -------
+    list<tuple>
+        The rows, in the column order of HOURS_COLUMNS
+    """
+    parsers = {
+        "regular_open": time.fromisoformat,
+        "regular_close": time.fromisoformat,
+        "is_current": _parse_bool,
+    }
+    return _load_snapshot(path, HOURS_COLUMNS, parsers)
+
+
+class ReplayRedshiftClient:
+    """
+    Stands in for RedshiftClient by applying each query the lambda builds to
+    in-memory copies of the staging, hours, closures, and state tables. Only
+    the exact queries that query_helper builds for the replay's tables are
+    understood, so a change to a query's shape that the replay doesn't know
+    about fails rather than being silently ignored.
+    """
+
+    def __init__(self, alerts, hours):
+        self.alerts = list(alerts)
+        self.hours = list(hours)
+        self.closures = []
+        self.state = []
+        self.transactions = []
+        self.conn = ReplayConnection(self)
+        self._queries = {
+            build_get_alerts_query(HOURS_TABLE, CLOSURE_ALERTS_TABLE): (
+                lambda: self._join_hours(self.alerts)
+            ),
+            build_get_sorted_alerts_query(HOURS_TABLE, CLOSURE_ALERTS_TABLE): (
+                lambda: _sort_alert_rows(self._join_hours(self.alerts))
+            ),
+            build_get_reduced_alerts_query(HOURS_TABLE, CLOSURE_ALERTS_TABLE): (
+                lambda: self._reduce(self._join_hours(self.alerts))
+            ),
+            build_get_incremental_alerts_query(
+                HOURS_TABLE, CLOSURE_ALERTS_TABLE, STATE_TABLE
+            ): lambda: self._join_hours(self._new_alerts()),
+            build_get_staged_alerts_query(CLOSURE_ALERTS_TABLE): lambda: self.alerts,
+            build_get_staged_alerts_query(
+                CLOSURE_ALERTS_TABLE, STATE_TABLE
+            ): self._new_alerts,
+            build_get_current_hours_query(HOURS_TABLE): lambda: [
+                row[:4] for row in self.hours if row[4]
+            ],
+            build_get_hours_version_query(HOURS_TABLE): lambda: [
+                (
+                    len(self.hours),
+                    sum(1 for row in self.hours if row[4]),
+                    sum(
+                        zlib.crc32(repr(row[:4]).encode())
+                        for row in self.hours
+                        if row[4]
+                    ),
+                )
+            ],
+            build_get_polling_datetimes_query(CLOSURE_ALERTS_TABLE): lambda: [
+                (polling_datetime,)
+                for polling_datetime in sorted({row[7] for row in self.alerts})
+            ],
+            build_get_state_query(STATE_TABLE): lambda: [
+                tuple(row) for row in self.state
+            ],
+        }
+
+    def connect(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+    def execute_query(self, query):
+        if query not in self._queries:
+            raise ReplayError("Unexpected query: {}".format(query))
+        return self._queries[query]()
+
+    def execute_transaction(self, queries):
+        self.transactions.append(queries)
+        for query, values in queries:
+            value_count = 0 if values is None else len(values)
+            if query == "DELETE FROM {};".format(CLOSURE_ALERTS_TABLE):
+                self.alerts = []
+            elif query == build_delete_consumed_alerts_query(
+                CLOSURE_ALERTS_TABLE, value_count
+            ):
+                self.alerts = [row for row in self.alerts if row[7] not in values]
+            elif query == build_delete_closures_for_date_query(CLOSURES_TABLE):
+                self.closures = [row for row in self.closures if row[5] != values[0]]
+            elif query == build_multi_row_insert_query(
+                CLOSURES_TABLE, value_count // len(CLOSURES_COLUMNS)
+            ):
+                self.closures.extend(_split_rows(values, len(CLOSURES_COLUMNS)))
+            elif query == build_delete_state_query(STATE_TABLE):
+                self.state = []
+            elif query == build_insert_state_query(
+                STATE_TABLE, value_count // len(STATE_COLUMNS)
+            ):
+                self.state.extend(_split_rows(values, len(STATE_COLUMNS)))
+            else:
+                raise ReplayError("Unexpected query: {}".format(query))
+
+    def _join_hours(self, alerts):
+        from hours_index import join_hours
+
+        # As in the alerts query, only the current hours are joined, and
+        # Redshift ignores the blank padding of the weekday names
+        return join_hours(
+            alerts,
+            {
+                (row[0], row[1].rstrip()): (row[2], row[3])
+                for row in self.hours
+                if row[4] and row[1] is not None
+            },
+        )
+
+    def _new_alerts(self):
+        watermark = max(
+            (row[STATE_COLUMNS.index("polling_datetime")] for row in self.state),
+            default=None,
+        )
+        return [row for row in self.alerts if watermark is None or row[7] > watermark]
+
+    def _reduce(self, raw_alerts):
+        import pandas as pd
+        from closure_engine import reduce_alerts
+        from lambda_function import _build_alerts_df
+
+        if len(raw_alerts) == 0:
+            return []
+        reduced_df = reduce_alerts(_build_alerts_df(raw_alerts))
+        return [
+            tuple(
+                (
+                    value.tz_convert("UTC").to_pydatetime()
+                    if isinstance(value, pd.Timestamp)
+                    else None if pd.isnull(value) else value
+                )
+                for value in row
+            )
+            for row in reduced_df.astype(object).itertuples(index=False, name=None)
+        ]
+
+
+class ReplayConnection:
+    """
+    Stands in for the connection's server-side cursors when streaming, and
+    for the transaction that the pipelined mode runs through a cursor. The
+    queries of that transaction are applied together when it is committed.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pending_queries = None
+
+    def cursor(self):
+        return ReplayCursor(self)
+
+    def commit(self):
+        if self.pending_queries is not None:
+            self.client.execute_transaction(self.pending_queries)
+        self.pending_queries = None
+
+    def rollback(self):
+        self.pending_queries = None
+
+
+class ReplayCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.client = connection.client
+        self.cursors = {}
+        self.rows = []
+
+    def execute(self, query, values=None):
+        declare = _DECLARE_CURSOR_PATTERN.fullmatch(query)
+        fetch = _FETCH_CURSOR_PATTERN.fullmatch(query)
+        if declare:
+            self.cursors[declare.group(1)] = iter(
+                self.client.execute_query(declare.group(2))
+            )
+        elif fetch:
+            rows = self.cursors[fetch.group(2)]
+            self.rows = [row for _, row in zip(range(int(fetch.group(1))), rows)]
+        elif query in [build_close_cursor_query(name) for name in self.cursors]:
+            self.cursors = {}
+        elif query == "BEGIN TRANSACTION;":
+            self.connection.pending_queries = []
+        elif query == "END TRANSACTION;":
+            pass
+        elif self.connection.pending_queries is not None:
+            # The writes are checked against the queries the replay knows when
+            # the transaction is committed
+            self.connection.pending_queries.append((query, values))
+        else:
+            raise ReplayError("Unexpected query: {}".format(query))
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def replay(alerts, hours):
+    """
+    Runs lambda_handler against the snapshot rows, with every query applied to
+    a ReplayRedshiftClient rather than Redshift. The mode is picked with the
+    same environment variables as in Lambda, except that the closures are
+    always written to the local tables rather than staged in S3, alert
+    snapshots are written to ALERTS_SNAPSHOT_DIR rather than S3, and
+    DO_NOT_UPDATE is ignored.
+
+    Parameters
+    ----------
+    alerts: list<tuple>
+        The rows of the closure alerts staging table
+    hours: list<tuple>
+        The rows of the location hours table
+
+    Returns
+    -------
+    tuple
+        The ReplayRedshiftClient, which holds the resulting tables and the
+        transactions that were executed, and the run's RunMetrics
+    """
+    for name, value in _BENCHMARK_ENV_VARS.items():
+        os.environ.setdefault(name, value)
+    os.environ["ENVIRONMENT"] = "replay"
+    os.environ["REDSHIFT_DB_NAME"] = "production"
+    os.environ["DO_NOT_UPDATE"] = "False"
+    os.environ.pop("CLOSURES_STAGING_BUCKET", None)
+    os.environ.pop("ALERTS_SNAPSHOT_BUCKET", None)
+
+    # These are imported here so that the log level above is respected
+    import connection_cache
+    import hours_index
+    import idempotency
+    import lambda_function
+    import metrics
+
+    connection_cache.clear_cache()
+    hours_index.clear_cache()
+    idempotency.clear_cache()
+    client = ReplayRedshiftClient(alerts, hours)
+    with mock.patch.object(
+        connection_cache, "KmsClient", LocalKmsClient
+    ), mock.patch.object(connection_cache, "RedshiftClient", lambda *args: client):
+        lambda_function.lambda_handler(None, None)
+    return client, metrics.current_run()
+
+
+def format_replay(client, run_metrics):
+    lines = ["Stage timings (ms):"]
+    lines.extend(
+        "  {:<20}{:>12.3f}".format(stage, elapsed)
+        for stage, elapsed in run_metrics.timings.items()
+    )
+    lines.append("Counts:")
+    lines.extend(
+        "  {:<28}{:>12,}".format(name, value)
+        for name, value in run_metrics.counts.items()
+    )
+    lines.append("Transactions:")
+    for i, queries in enumerate(client.transactions):
+        lines.append("  Transaction {}:".format(i + 1))
+        lines.extend(
+            "    {} ({} values)".format(
+                " ".join(query.split())[:80], 0 if values is None else len(values)
+            )
+            for query, values in queries
+        )
+    lines.append("Closures ({}):".format(len(client.closures)))
+    lines.extend(
+        "  " + ", ".join("" if value is None else str(value) for value in closure)
+        for closure in client.closures
+    )
+    return "\n".join(lines)
+
+
+def _load_snapshot(path, columns, parsers):
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        missing_columns = set(columns) - set(reader.fieldnames or [])
+        if missing_columns:
+            raise ReplayError(
+                "Snapshot {} is missing columns: {}".format(
+                    path, ", ".join(sorted(missing_columns))
+                )
+            )
+        return [
+            tuple(
+                (None if row[column] == "" else parsers.get(column, str)(row[column]))
+                for column in columns
+            )
+            for row in reader
+        ]
+
+
+def _parse_bool(value):
+    return value.lower() in ["t", "true", "1"]
+
+
+def _parse_datetime(value):
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def _sort_alert_rows(rows):
+    # Sorts the rows the same way as the sorted alerts query, with NULLs last
+    return sorted(
+        rows,
+        key=lambda row: (
+            row[0] is None,
+            row[0] or "",
+            row[2] is None,
+            row[2] or "",
+            row[7],
+        ),
+    )
+
+
+def _split_rows(values, column_count):
+    return [values[i : i + column_count] for i in range(0, len(values), column_count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Replay the lambda against snapshots of the closure alerts staging "
+            "table and location hours table, without any network access"
+        )
+    )
+    parser.add_argument("alerts", help="CSV snapshot of the staging table")
+    parser.add_argument("hours", help="CSV snapshot of the location hours table")
+    parser.add_argument(
+        "--output", help="Optional path to also write the closures to as CSV"
+    )
+    args = parser.parse_args()
+
+    client, run_metrics = replay(
+        load_alerts_snapshot(args.alerts), load_hours_snapshot(args.hours)
+    )
+    print(format_replay(client, run_metrics))
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CLOSURES_COLUMNS)
+            writer.writerows(client.closures)
+
+
+class ReplayError(Exception):
+    def __init__(self, message=None):
+        self.message = message
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,470 @@
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from benchmarks.alert_generator import generate_alert_rows
+from unittest import mock
+
+# The handler needs these to be set, but none of them are used to connect to
+# anything since the KMS and Redshift clients are replaced with local ones
+_BENCHMARK_ENV_VARS = {
+    "ENVIRONMENT": "benchmark",
+    "REDSHIFT_DB_NAME": "benchmark",
+    "REDSHIFT_DB_HOST": "benchmark_host",
+    "REDSHIFT_DB_USER": "benchmark_user",
+    "REDSHIFT_DB_PASSWORD": "benchmark_password",
+    "DO_NOT_UPDATE": "False",
+    "LOG_LEVEL": "warning",
+}
+
+
+class LocalKmsClient:
+    """Stands in for KmsClient by returning each value unchanged"""
+
+    def decrypt(self, encrypted_text):
+        return encrypted_text
+
+    def close(self):
+        pass
+
+
+class LocalRedshiftClient:
+    """
+    Stands in for RedshiftClient by returning the given rows from every query
+    and recording, rather than executing, each transaction
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.transactions = []
+
+    def connect(self):
+        pass
+
+    def execute_query(self, query):
+        return self.rows
+
+    def execute_transaction(self, queries):
+        self.transactions.append(queries)
+
+    def close_connection(self):
+        pass
+
+
+class LatencyRedshiftClient(LocalRedshiftClient):
+    """
+    Stands in for RedshiftClient across a network by sleeping for the given
+    round trip latency on every call to Redshift. The rows are served sorted
+    as the sorted alerts query sorts them, either all at once or a batch at a
+    time through a server-side cursor.
+    """
+
+    def __init__(self, rows, latency):
+        from benchmarks.replay import _sort_alert_rows
+
+        super().__init__(_sort_alert_rows(rows))
+        self.latency = latency
+        self.conn = LatencyConnection(self)
+
+    def execute_query(self, query):
+        time.sleep(self.latency)
+        if query.strip().startswith("SELECT DISTINCT polling_datetime"):
+            return [(row,) for row in sorted({row[7] for row in self.rows})]
+        return self.rows
+
+    def execute_transaction(self, queries):
+        # Each query, along with the BEGIN and END, is a round trip
+        time.sleep(self.latency * (len(queries) + 2))
+        super().execute_transaction(queries)
+
+
+class LatencyConnection:
+    def __init__(self, client):
+        self.client = client
+
+    def cursor(self):
+        return LatencyCursor(self.client)
+
+    def commit(self):
+        time.sleep(self.client.latency)
+
+    def rollback(self):
+        time.sleep(self.client.latency)
+
+
+class LatencyCursor:
+    def __init__(self, client):
+        self.client = client
+        self.position = 0
+        self.results = []
+
+    def execute(self, query, values=None):
+        time.sleep(self.client.latency)
+        if query.startswith("FETCH FORWARD"):
+            batch_size = int(query.split()[2])
+            self.results = self.client.rows[self.position : self.position + batch_size]
+            self.position += len(self.results)
+
+    def fetchall(self):
+        return self.results
+
+    def close(self):
+        pass
+
+
+class DecodingRedshiftClient:
+    """
+    Stands in for RedshiftClient decoding the alerts off the wire. The rows are
+    held as text, and every fetch decodes fresh Python objects for the rows it
+    returns, either all at once or a batch at a time through a server-side
+    cursor, so that memory is measured as if the rows came from the driver.
+    """
+
+    def __init__(self, rows):
+        self.encoded_rows = [
+            tuple(None if value is None else str(value) for value in row)
+            for row in rows
+        ]
+        self.position = 0
+        self.results = []
+        self.conn = self
+
+    def execute_query(self, query):
+        return _decode_rows(self.encoded_rows)
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        if query.startswith("FETCH FORWARD"):
+            batch_size = int(query.split()[2])
+            self.results = _decode_rows(
+                self.encoded_rows[self.position : self.position + batch_size]
+            )
+            self.position += len(self.results)
+
+    def fetchall(self):
+        return self.results
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _decode_rows(encoded_rows):
+    from datetime import datetime, time
+
+    decoders = [str, str, str, str, lambda text: text == "True"]
+    decoders += [datetime.fromisoformat] * 3 + [time.fromisoformat] * 2
+    return [
+        tuple(
+            None if text is None else decode(text)
+            for decode, text in zip(decoders, row)
+        )
+        for row in encoded_rows
+    ]
+
+
+def measure(stage, func, rows, repeat=1):
+    """
+    Runs func once per repeat to time it and then once more under tracemalloc
+    to find its peak memory. A fresh input is built by calling func's setup
+    each time, so setup is never measured.
+
+    Parameters
+    ----------
+    stage: str
+        The name of the pipeline stage
+    func: function
+        Takes no arguments and returns a function that runs the stage
+    rows: int
+        The number of input rows, used to calculate the throughput
+    repeat: int, optional
+        The number of timed runs. The fastest is reported.
+
+    Returns
+    -------
+    dict
+        The stage's wall time in seconds, peak memory in MiB, and rows/sec
+    """
+    timings = []
+    for _ in range(repeat):
+        run = func()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    run = func()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    wall_time = min(timings)
+    return {
+        "stage": stage,
+        "rows": rows,
+        "wall_time": wall_time,
+        "peak_memory_mib": peak / 2**20,
+        "rows_per_sec": rows / wall_time if wall_time > 0 else float("inf"),
+    }
+
+
+def run_benchmarks(
+    location_counts,
+    repeat=1,
+    reference_max_rows=50000,
+    batch_size=5000,
+    latency=0.02,
+    **generator_kwargs,
+):
+    """
+    Benchmarks each pipeline stage against synthetic alerts for each of the
+    given location counts
+
+    Parameters
+    ----------
+    location_counts: list<int>
+        The number of branches to generate alerts for in each run
+    repeat: int, optional
+        The number of timed runs of each stage
+    reference_max_rows: int, optional
+        The reference get_closures implementation is slow, so it is only run
+        for inputs with at most this many rows
+    batch_size: int, optional
+        The ALERTS_BATCH_SIZE of the streamed and pipelined handler runs
+    latency: float, optional
+        The round trip latency, in seconds, of each call to Redshift in the
+        streamed and pipelined handler runs
+    generator_kwargs:
+        Any other arguments are passed to the alert generator
+
+    Returns
+    -------
+    list<dict>
+        The measurements for each stage and location count
+    """
+    os.environ.update(_BENCHMARK_ENV_VARS)
+
+    # This is imported here so that the log level above is respected
+    import lambda_function
+    import pandas as pd
+    from closure_engine import build_alerts_df
+    from query_helper import GET_ALERTS_COLUMNS
+
+    results = []
+    for location_count in location_counts:
+        raw_alerts = generate_alert_rows(
+            location_count=location_count, **generator_kwargs
+        )
+        n_rows = len(raw_alerts)
+        alerts_df = pd.DataFrame(data=raw_alerts, columns=GET_ALERTS_COLUMNS)
+        typed_df = build_alerts_df(raw_alerts)
+
+        stages = [
+            (
+                "build_dataframe",
+                lambda: lambda: pd.DataFrame(
+                    data=raw_alerts, columns=GET_ALERTS_COLUMNS
+                ),
+            ),
+            (
+                "get_closures",
+                lambda: lambda df=alerts_df.copy(): lambda_function.get_closures(df),
+            ),
+            ("build_typed_dataframe", lambda: lambda: build_alerts_df(raw_alerts)),
+            (
+                "get_closures_typed",
+                lambda: lambda df=typed_df.copy(): lambda_function.get_closures(df),
+            ),
+            (
+                "get_closures_parallel",
+                lambda: _parallel_run(typed_df.copy()),
+            ),
+        ]
+        if n_rows <= reference_max_rows:
+            stages.append(
+                (
+                    "get_closures_reference",
+                    lambda: lambda df=alerts_df.copy(): (
+                        lambda_function.get_closures_reference(df)
+                    ),
+                )
+            )
+        stages.append(
+            ("fetch_typed_dataframe", lambda: _fetch_run(raw_alerts, columnar=False))
+        )
+        stages.append(("fetch_columns", lambda: _fetch_run(raw_alerts, columnar=True)))
+        stages.append(("lambda_handler", lambda: _handler_run(raw_alerts)))
+        stages.append(
+            (
+                "lambda_handler_streamed",
+                lambda: _latency_handler_run(raw_alerts, batch_size, latency),
+            )
+        )
+        stages.append(
+            (
+                "lambda_handler_pipelined",
+                lambda: _latency_handler_run(
+                    raw_alerts, batch_size, latency, pipelined=True
+                ),
+            )
+        )
+
+        for stage, func in stages:
+            result = measure(stage, func, n_rows, repeat)
+            result["locations"] = location_count
+            results.append(result)
+    return results
+
+
+def _parallel_run(alerts_df):
+    import lambda_function
+
+    def run():
+        # Every input is sharded, with one shard per vCPU (and at least two),
+        # so that the crossover with the serial path is visible
+        with mock.patch.dict(
+            os.environ,
+            {
+                "PARALLEL_MODE": "True",
+                "PARALLEL_MIN_ROWS": "0",
+                "PARALLEL_WORKERS": str(max(2, os.cpu_count() or 1)),
+            },
+        ):
+            lambda_function.get_closures(alerts_df)
+
+    return run
+
+
+def _fetch_run(raw_alerts, columnar):
+    import lambda_function
+    from closure_engine import build_alerts_df
+
+    client = DecodingRedshiftClient(raw_alerts)
+
+    def run():
+        # Both paths end with the same typed DataFrame, fetched either as one
+        # list of row tuples or as typed column buffers filled batch by batch
+        if columnar:
+            lambda_function._fetch_alert_columns(client, "hours", "alerts")
+        else:
+            build_alerts_df(lambda_function._fetch_alerts(client, "hours", "alerts"))
+
+    return run
+
+
+def _handler_run(raw_alerts):
+    import connection_cache
+    import lambda_function
+
+    def run():
+        # Each run is measured as if it were in a cold container
+        connection_cache.clear_cache()
+        with mock.patch.object(
+            connection_cache, "KmsClient", LocalKmsClient
+        ), mock.patch.object(
+            connection_cache,
+            "RedshiftClient",
+            lambda *args: LocalRedshiftClient(raw_alerts),
+        ):
+            lambda_function.lambda_handler(None, None)
+
+    return run
+
+
+def _latency_handler_run(raw_alerts, batch_size, latency, pipelined=False):
+    import connection_cache
+    import lambda_function
+
+    def run():
+        connection_cache.clear_cache()
+        with mock.patch.object(
+            connection_cache, "KmsClient", LocalKmsClient
+        ), mock.patch.object(
+            connection_cache,
+            "RedshiftClient",
+            lambda *args: LatencyRedshiftClient(raw_alerts, latency),
+        ), mock.patch.dict(
+            os.environ,
+            {
+                "ALERTS_BATCH_SIZE": str(batch_size),
+                "PIPELINE_MODE": str(pipelined),
+            },
+        ):
+            lambda_function.lambda_handler(None, None)
+
+    return run
+
+
+def format_results(results):
+    lines = [
+        "{:>9}  {:>9}  {:<24}{:>10}  {:>10}  {:>12}".format(
+            "locations", "rows", "stage", "wall (s)", "peak (MiB)", "rows/sec"
+        )
+    ]
+    for result in results:
+        lines.append(
+            "{locations:>9}  {rows:>9}  {stage:<24}{wall_time:>10.4f}  "
+            "{peak_memory_mib:>10.1f}  {rows_per_sec:>12,.0f}".format(**result)
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark closure aggregation against synthetic alerts"
+    )
+    parser.add_argument(
+        "--locations", type=int, nargs="+", default=[10, 100, 1000, 5000]
+    )
+    parser.add_argument("--alerts-per-location", type=int, default=2)
+    parser.add_argument("--polling-interval", type=int, default=5)
+    parser.add_argument("--system-alert-share", type=float, default=0.05)
+    parser.add_argument("--extended-closure-share", type=float, default=0.05)
+    parser.add_argument("--missing-hours-share", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--reference-max-rows", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=5000,
+        help="The ALERTS_BATCH_SIZE of the streamed and pipelined handler runs",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="The simulated round trip latency to Redshift, in seconds",
+    )
+    parser.add_argument(
+        "--output", help="Optional path to also write the results to as JSON"
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.locations,
+        repeat=args.repeat,
+        reference_max_rows=args.reference_max_rows,
+        batch_size=args.batch_size,
+        latency=args.latency,
+        alerts_per_location=args.alerts_per_location,
+        polling_interval=args.polling_interval,
+        system_alert_share=args.system_alert_share,
+        extended_closure_share=args.extended_closure_share,
+        missing_hours_share=args.missing_hours_share,
+        seed=args.seed,
+    )
+    print(format_results(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,838 @@
+import metrics
+import numpy as np
+import os
+import pandas as pd
+
+from closure_record import Closure
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta
+from poll_runs import PollRuns
+from query_helper import GET_ALERTS_COLUMNS
+
+_POLLER_LOCATION_ID = "location_closure_alert_poller"
+
+_NS_PER_SECOND = 10**9
+
+# Wall clock offsets (from midnight) used to decide whether a system-wide
+# closure lasts the full day, i.e. 00:00:59 and 23:59:00
+_FULL_DAY_START_OFFSET = 59 * _NS_PER_SECOND
+_FULL_DAY_END_OFFSET = (23 * 60 + 59) * 60 * _NS_PER_SECOND
+_DAY_END_OFFSET = _FULL_DAY_END_OFFSET + 59 * _NS_PER_SECOND
+
+# Each of these repeats on every poll at which an alert was seen, so they are
+# stored as categoricals rather than as one Python string per row
+_CATEGORICAL_COLUMNS = ["location_id", "name", "alert_id", "closed_for"]
+
+_DATETIME_COLUMNS = ["alert_start", "alert_end", "polling_datetime"]
+
+_HOURS_COLUMNS = ["regular_open", "regular_close"]
+
+# The polling date and datetimes shared by every shard, set once in each worker
+# process by _set_shard_context rather than sent along with each shard
+_shard_context = None
+
+
+def build_alerts_df(raw_alerts):
+    """
+    Builds a compactly typed DataFrame from the rows of the alerts query. The
+    string columns are categoricals, the datetime columns are converted to
+    US/Eastern once here, and the regular hours are stored as nullable integer
+    offsets in seconds from midnight (so any fraction of a second is dropped).
+    aggregate_closures accepts these frames as well as ones built directly
+    from the rows.
+
+    Parameters
+    ----------
+    raw_alerts: list<tuple>
+        The rows of the alerts query
+
+    Returns
+    -------
+    DataFrame
+        The alerts, with the columns of the alerts query
+    """
+    values = list(zip(*raw_alerts)) or [()] * len(GET_ALERTS_COLUMNS)
+    columns = dict(zip(GET_ALERTS_COLUMNS, values))
+    for column in _CATEGORICAL_COLUMNS:
+        columns[column] = pd.Categorical(columns[column])
+    for column in _DATETIME_COLUMNS:
+        columns[column] = pd.to_datetime(
+            pd.Series(columns[column]), utc=True
+        ).dt.tz_convert("US/Eastern")
+    for column in _HOURS_COLUMNS:
+        columns[column] = _to_seconds(columns[column])
+    columns["extended_closing"] = pd.array(columns["extended_closing"], dtype="boolean")
+    return pd.DataFrame(columns, columns=GET_ALERTS_COLUMNS)
+
+
+class AlertColumns:
+    """
+    Builds the same compactly typed DataFrame as build_alerts_df from batches
+    of rows of the alerts query, such as those fetched through a server-side
+    cursor. Each batch is converted into typed NumPy buffers column by column
+    as soon as it is added: category codes for the string columns, UTC
+    nanosecond epochs for the datetime columns, and values plus a mask for the
+    regular hours and extended_closing. Only one batch of row tuples is held
+    at a time, and the DataFrame is built on the concatenated buffers without
+    copying them again.
+    """
+
+    def __init__(self):
+        self.row_count = 0
+        self._categories = {column: {} for column in _CATEGORICAL_COLUMNS}
+        self._buffers = {column: [] for column in GET_ALERTS_COLUMNS}
+        self._masks = {column: [] for column in _HOURS_COLUMNS + ["extended_closing"]}
+
+    def append(self, raw_alerts):
+        """Converts a batch of rows of the alerts query into the buffers"""
+        if len(raw_alerts) == 0:
+            return
+        for column, values in zip(GET_ALERTS_COLUMNS, zip(*raw_alerts)):
+            if column in _CATEGORICAL_COLUMNS:
+                # Codes are handed out in order of first appearance and only
+                # remapped to the sorted categories once every row is in
+                codes = self._categories[column]
+                self._buffers[column].append(
+                    np.fromiter(
+                        (
+                            -1 if v is None else codes.setdefault(v, len(codes))
+                            for v in values
+                        ),
+                        dtype=np.int32,
+                        count=len(values),
+                    )
+                )
+            elif column in _DATETIME_COLUMNS:
+                self._buffers[column].append(
+                    _to_ns(pd.to_datetime(pd.Series(values), utc=True))
+                )
+            else:
+                array = (
+                    _to_seconds(values)
+                    if column in _HOURS_COLUMNS
+                    else pd.array(values, dtype="boolean")
+                )
+                self._buffers[column].append(
+                    array.to_numpy(dtype=array.dtype.numpy_dtype, na_value=0)
+                )
+                self._masks[column].append(array.isna())
+        self.row_count += len(raw_alerts)
+
+    def to_df(self):
+        """Returns the alerts added so far as a DataFrame like build_alerts_df's"""
+        columns = {}
+        for column in _CATEGORICAL_COLUMNS:
+            codes = _concatenate(self._buffers[column], np.int32)
+            categories = np.array(list(self._categories[column]), dtype=object)
+            order = np.argsort(categories)
+            ranks = np.empty(len(order), dtype=np.int32)
+            ranks[order] = np.arange(len(order), dtype=np.int32)
+            is_present = codes >= 0
+            codes[is_present] = ranks[codes[is_present]]
+            columns[column] = pd.Categorical.from_codes(codes, categories[order])
+        for column in _DATETIME_COLUMNS:
+            columns[column] = pd.DatetimeIndex(
+                _concatenate(self._buffers[column], np.int64),
+                dtype=pd.DatetimeTZDtype("ns", "US/Eastern"),
+                copy=False,
+            ).array
+        for column in _HOURS_COLUMNS:
+            columns[column] = pd.arrays.IntegerArray(
+                _concatenate(self._buffers[column], np.int32),
+                _concatenate(self._masks[column], bool),
+            )
+        columns["extended_closing"] = pd.arrays.BooleanArray(
+            _concatenate(self._buffers["extended_closing"], bool),
+            _concatenate(self._masks["extended_closing"], bool),
+        )
+        return pd.DataFrame(columns, columns=GET_ALERTS_COLUMNS, copy=False)
+
+
+def aggregate_closures(alerts_df, polling_date, polling_datetimes=None):
+    """
+    Columnar version of the closure aggregation. Rather than looping over each
+    (alert_id, location_id) group in Python, every group is reduced to its most
+    recently polled row up front and the clamping, inference, and full day
+    logic is applied to all of the groups at once.
+
+    Parameters
+    ----------
+    alerts_df: DataFrame
+        The closure alerts for a single day, with the datetime columns already
+        converted to US/Eastern
+    polling_date: date
+        The date on which the alerts were polled
+    polling_datetimes: sequence, optional
+        Every distinct datetime at which the poller ran that day. This only
+        needs to be provided when alerts_df holds a subset of the day's alerts,
+        as otherwise the polling datetimes are taken from alerts_df.
+
+    Returns
+    -------
+    list<Closure>
+        The closures, sorted by (alert_id, location_id). The list is empty if
+        there are no closures.
+    """
+    grouped = alerts_df.groupby(
+        ["alert_id", "location_id"], dropna=False, observed=True
+    )
+
+    # We assume the most recently polled version of the alert is the most
+    # accurate and use it as the primary data source
+    last_alerts = alerts_df.loc[grouped["polling_datetime"].idxmax().to_numpy()]
+    return _aggregate_last_alerts(
+        last_alerts.reset_index(drop=True),
+        polling_date,
+        _compact_polls(
+            grouped.ngroup().to_numpy(),
+            _to_ns(alerts_df["polling_datetime"]),
+            polling_datetimes,
+            len(last_alerts),
+        ),
+        grouped["polling_datetime"].min().reset_index(drop=True),
+        grouped["polling_datetime"].max().reset_index(drop=True),
+    )
+
+
+def aggregate_reduced_closures(reduced_df, polling_date, polling_datetimes=None):
+    """
+    Version of aggregate_closures for the output of the reduced alerts query,
+    which has already been reduced to one row per (alert_id, location_id) group
+    in Redshift
+
+    Parameters
+    ----------
+    reduced_df: DataFrame
+        The reduced closure alerts for a single day, with the datetime columns
+        already converted to US/Eastern
+    polling_date: date
+        The date on which the alerts were polled
+    polling_datetimes: sequence, optional
+        Every distinct datetime at which the poller ran that day. By default
+        these are taken from the polling datetimes of every group.
+
+    Returns
+    -------
+    list<Closure>
+        The closures, in the same order as aggregate_closures returns them
+    """
+    last_alerts = reduced_df.sort_values(
+        ["alert_id", "location_id"], na_position="last", kind="stable"
+    ).reset_index(drop=True)
+    group_polls = last_alerts["polling_datetimes"].str.split(",")
+    alert_polls = pd.to_datetime(
+        group_polls.explode().to_numpy(), format="%Y-%m-%d %H:%M:%S.%f", utc=True
+    )
+    return _aggregate_last_alerts(
+        last_alerts,
+        polling_date,
+        _compact_polls(
+            np.repeat(np.arange(len(last_alerts)), group_polls.str.len().to_numpy()),
+            _to_ns(alert_polls),
+            polling_datetimes,
+            len(last_alerts),
+        ),
+        last_alerts["first_polling_datetime"],
+        last_alerts["polling_datetime"],
+    )
+
+
+def aggregate_tracked_closures(
+    last_alerts, polling_date, poll_runs, first_seen, last_seen
+):
+    """
+    Version of aggregate_closures for alerts whose polls were tracked as they
+    arrived rather than read back from the staging table, such as those kept by
+    live_closures.LiveClosures
+
+    Parameters
+    ----------
+    last_alerts: list<tuple>
+        Each (alert_id, location_id) group's most recently polled row of the
+        alerts query, sorted by (alert_id, location_id) with missing values last
+    polling_date: date
+        The date on which the alerts were polled
+    poll_runs: PollRuns
+        The runs of polls at which each group's alert was seen
+    first_seen: ndarray<int64>
+        The UTC nanosecond epoch of the first poll at which each group was seen
+    last_seen: ndarray<int64>
+        The UTC nanosecond epoch of the last poll at which each group was seen
+
+    Returns
+    -------
+    list<Closure>
+        The closures, in the same order as aggregate_closures returns them
+    """
+    eastern = pd.DatetimeTZDtype("ns", "US/Eastern")
+    return _aggregate_last_alerts(
+        build_alerts_df(last_alerts),
+        polling_date,
+        poll_runs,
+        pd.Series(pd.DatetimeIndex(first_seen, dtype=eastern)),
+        pd.Series(pd.DatetimeIndex(last_seen, dtype=eastern)),
+    )
+
+
+def reduce_alerts(alerts_df):
+    """
+    Reduces the closure alerts for a single day to one row per (alert_id,
+    location_id) group, in the same shape as the reduced alerts query returns
+
+    Parameters
+    ----------
+    alerts_df: DataFrame
+        The closure alerts, with tz-aware datetime columns
+
+    Returns
+    -------
+    DataFrame
+        The reduced alerts, with the columns of the reduced alerts query
+    """
+    grouped = alerts_df.groupby(
+        ["alert_id", "location_id"], dropna=False, observed=True
+    )
+    reduced_df = alerts_df.loc[grouped["polling_datetime"].idxmax().to_numpy()]
+    reduced_df = reduced_df.reset_index(drop=True)
+    reduced_df["first_polling_datetime"] = grouped["polling_datetime"].min().to_numpy()
+    reduced_df["poll_count"] = grouped.size().to_numpy()
+
+    # Each group's distinct polling datetimes, in UTC and in order
+    polls_df = pd.DataFrame(
+        {
+            "group_id": grouped.ngroup().to_numpy(),
+            "poll": _format_utc(alerts_df["polling_datetime"]),
+        }
+    ).drop_duplicates()
+    reduced_df["polling_datetimes"] = (
+        polls_df.sort_values(["group_id", "poll"])
+        .groupby("group_id")["poll"]
+        .agg(",".join)
+        .to_numpy(dtype=object)
+    )
+    return reduced_df
+
+
+def merge_reduced_alerts(earlier_df, later_df):
+    """
+    Merges two sets of reduced alerts for the same day, such as those from an
+    earlier run and those polled since. Each group keeps the row polled most
+    recently (the earlier one if both were polled at the same time), its first
+    polling datetime overall, its total poll count, and the union of its
+    polling datetimes.
+    """
+    alerts_df = pd.concat([earlier_df, later_df], ignore_index=True)
+    for column in ["alert_start", "alert_end", "polling_datetime"]:
+        alerts_df[column] = pd.to_datetime(alerts_df[column], utc=True)
+    alerts_df["first_polling_datetime"] = pd.to_datetime(
+        alerts_df["first_polling_datetime"], utc=True
+    )
+
+    grouped = alerts_df.groupby(
+        ["alert_id", "location_id"], dropna=False, observed=True
+    )
+    merged_df = alerts_df.loc[grouped["polling_datetime"].idxmax().to_numpy()]
+    merged_df = merged_df.reset_index(drop=True)
+    merged_df["first_polling_datetime"] = (
+        grouped["first_polling_datetime"].min().to_numpy()
+    )
+    merged_df["poll_count"] = grouped["poll_count"].sum().to_numpy()
+    merged_df["polling_datetimes"] = (
+        grouped["polling_datetimes"]
+        .agg(lambda polls: ",".join(sorted(set(",".join(polls).split(",")))))
+        .to_numpy(dtype=object)
+    )
+    return merged_df
+
+
+def _compact_polls(group_ids, alert_polls, polling_datetimes, n_groups):
+    """
+    Compacts the polling datetime of each time a group's alert was seen into
+    runs of consecutive polls, so that the rows themselves aren't needed once
+    the groups' last rows have been taken
+    """
+    polls = np.unique(
+        alert_polls if polling_datetimes is None else _to_ns(polling_datetimes)
+    )
+    return PollRuns(group_ids, alert_polls, polls, n_groups)
+
+
+def _aggregate_last_alerts(last_alerts, polling_date, poll_runs, first_seen, last_seen):
+    """
+    Applies the clamping, inference, and full day logic to every group at once,
+    given each group's most recently polled row along with the runs of polls
+    at which the group's alert was seen. When SPLIT_CLOSURES_MODE is True, a
+    group whose alert was missing from some of the polls within its closure
+    gets one closure per run of polls at which it was seen rather than a
+    single closure spanning the first and last of them.
+    """
+    n_groups = len(last_alerts)
+    split_runs = os.environ.get("SPLIT_CLOSURES_MODE", False) == "True"
+    is_split = np.zeros(n_groups, dtype=bool)
+
+    # These are fake alerts created by the LocationClosureAlertPoller for the
+    # purpose of recording each polling datetime
+    location_ids = last_alerts["location_id"]
+    is_poller = (location_ids == _POLLER_LOCATION_ID).fillna(False).to_numpy(bool)
+    is_location = ~is_poller & location_ids.notnull().to_numpy()
+    has_hours = (
+        last_alerts["regular_open"].notnull() & last_alerts["regular_close"].notnull()
+    ).to_numpy()
+
+    day_start = _localize(polling_date, np.zeros(1, dtype=np.int64))[0]
+    day_end = _localize(polling_date, np.array([_DAY_END_OFFSET]))[0]
+    next_day_start = _localize(
+        polling_date + timedelta(days=1), np.zeros(1, dtype=np.int64)
+    )[0]
+
+    alert_start = _to_ns(last_alerts["alert_start"])
+    alert_end = _to_ns(last_alerts["alert_end"])
+    alert_start_wall, alert_start_offset = _wall_clock(last_alerts["alert_start"])
+    alert_end_wall, alert_end_offset = _wall_clock(last_alerts["alert_end"])
+    is_active = (alert_start < next_day_start) & (alert_end >= day_start)
+
+    closure_start = np.full(n_groups, None, dtype=object)
+    closure_end = np.full(n_groups, None, dtype=object)
+    is_full_day = np.ones(n_groups, dtype=bool)
+
+    # If there is no location id, this is a system-wide alert (or an error) and
+    # we assume the stated closure hours are correct. The closure is clamped to
+    # the current date.
+    is_system = ~is_poller & ~is_location & is_active
+    starts_later = alert_start > day_start
+    ends_earlier = alert_end < day_end
+    closure_start[is_system] = np.where(starts_later, alert_start_wall, "00:00:00")[
+        is_system
+    ]
+    closure_end[is_system] = np.where(ends_earlier, alert_end_wall, "23:59:59")[
+        is_system
+    ]
+    start_offset = np.where(starts_later, alert_start_offset, 0)
+    end_offset = np.where(ends_earlier, alert_end_offset, _DAY_END_OFFSET)
+    is_full_day[is_system] = (
+        (start_offset <= _FULL_DAY_START_OFFSET) & (end_offset >= _FULL_DAY_END_OFFSET)
+    )[is_system]
+
+    # If the library's regular hours are not available (e.g. when the library
+    # is under an extended closure), we assume an active alert lasts the full
+    # day and record only the date of the closure without times
+    is_missing_hours = is_location & ~has_hours & is_active
+    is_regular_hours = is_location & has_hours
+    is_inferred = np.zeros(n_groups, dtype=bool)
+
+    if is_regular_hours.any():
+        regular_open, open_wall = _localize_times(
+            polling_date, last_alerts["regular_open"], is_regular_hours
+        )
+        regular_close, close_wall = _localize_times(
+            polling_date, last_alerts["regular_close"], is_regular_hours
+        )
+
+        # Ignore alerts that occur outside of a library's regular hours
+        is_regular_hours &= (alert_start < regular_close) & (alert_end > regular_open)
+
+        # Clamp the closure to the library's regular hours
+        starts_later = alert_start > regular_open
+        ends_earlier = alert_end < regular_close
+        start = np.where(starts_later, alert_start, regular_open)
+        end = np.where(ends_earlier, alert_end, regular_close)
+        start_wall = np.where(starts_later, alert_start_wall, open_wall)
+        end_wall = np.where(ends_earlier, alert_end_wall, close_wall)
+
+        # If the stated closure doesn't match what's seen by the poller, infer
+        # the real closure from the polling times. Because an alert being up
+        # outside the scheduled closure does not indicate that the library is
+        # actually closed at the time (i.e. an alert can be up for a future/past
+        # closure), we will only ever infer that the closure is shorter than
+        # listed.
+        window_firsts, window_stops = poll_runs.window(start, end)
+        is_inferred = is_regular_hours & (
+            poll_runs.count_seen_within(window_firsts, window_stops)
+            < window_stops - window_firsts
+        )
+
+        clamped_start, clamped_end = start, end
+        clamped_start_wall, clamped_end_wall = start_wall, end_wall
+        first_poll = _to_ns(first_seen)
+        last_poll = _to_ns(last_seen)
+        starts_later = is_inferred & (first_poll > start)
+        ends_earlier = is_inferred & (last_poll < end)
+        start = np.where(starts_later, first_poll, start)
+        end = np.where(ends_earlier, last_poll, end)
+        start_wall = np.where(starts_later, _wall_clock(first_seen)[0], start_wall)
+        end_wall = np.where(ends_earlier, _wall_clock(last_seen)[0], end_wall)
+
+        closure_start[is_regular_hours] = start_wall[is_regular_hours]
+        closure_end[is_regular_hours] = end_wall[is_regular_hours]
+        is_full_day[is_regular_hours] = (
+            (start <= regular_open) & (end >= regular_close)
+        )[is_regular_hours]
+
+        if split_runs and is_inferred.any():
+            # Each run of polls within the clamped closure becomes a closure of
+            # its own, running from the run's first poll to its last. Groups
+            # that weren't seen at any poll within it keep the single closure.
+            is_piece = poll_runs.overlapping(window_firsts, window_stops)
+            is_piece &= is_inferred[poll_runs.groups]
+            is_split = np.bincount(
+                poll_runs.groups[is_piece], minlength=n_groups
+            ).astype(bool)
+            piece_groups = poll_runs.groups[is_piece]
+            piece_first = poll_runs.polls[poll_runs.firsts[is_piece]]
+            piece_last = poll_runs.polls[poll_runs.lasts[is_piece]]
+            poll_walls = _wall_clock(
+                pd.to_datetime(poll_runs.polls, utc=True).tz_convert("US/Eastern")
+            )[0]
+            starts_later = piece_first > clamped_start[piece_groups]
+            ends_earlier = piece_last < clamped_end[piece_groups]
+            piece_start = np.where(
+                starts_later, piece_first, clamped_start[piece_groups]
+            )
+            piece_end = np.where(ends_earlier, piece_last, clamped_end[piece_groups])
+            piece_start_wall = np.where(
+                starts_later,
+                poll_walls[poll_runs.firsts[is_piece]],
+                clamped_start_wall[piece_groups],
+            )
+            piece_end_wall = np.where(
+                ends_earlier,
+                poll_walls[poll_runs.lasts[is_piece]],
+                clamped_end_wall[piece_groups],
+            )
+            piece_full_day = (piece_start <= regular_open[piece_groups]) & (
+                piece_end >= regular_close[piece_groups]
+            )
+
+    keep = is_system | is_missing_hours | is_regular_hours
+    metrics.count("AlertGroups", np.count_nonzero(~is_poller))
+    metrics.count("SystemClosures", np.count_nonzero(is_system))
+    metrics.count("MissingHoursClosures", np.count_nonzero(is_missing_hours))
+    metrics.count("RegularHoursClosures", np.count_nonzero(is_regular_hours))
+    metrics.count("InferredClosures", np.count_nonzero(is_inferred))
+    metrics.count(
+        "DroppedInactive",
+        np.count_nonzero(~is_poller & ~(is_location & has_hours) & ~is_active),
+    )
+    metrics.count(
+        "DroppedOutsideRegularHours",
+        np.count_nonzero(is_location & has_hours & ~is_regular_hours),
+    )
+    if is_split.any():
+        metrics.count("SplitClosures", np.count_nonzero(is_split))
+
+        # Each split group's row is repeated once per run, in time order
+        repeats = np.where(is_split, np.bincount(piece_groups, minlength=n_groups), 1)
+        rows = np.repeat(np.arange(n_groups), repeats)
+        is_piece_row = is_split[rows]
+        closure_start = closure_start[rows]
+        closure_end = closure_end[rows]
+        is_full_day = is_full_day[rows]
+        closure_start[is_piece_row] = piece_start_wall
+        closure_end[is_piece_row] = piece_end_wall
+        is_full_day[is_piece_row] = piece_full_day
+        keep = keep[rows]
+        rows = rows[keep]
+    else:
+        rows = np.flatnonzero(keep)
+
+    closures = last_alerts.iloc[rows]
+    return list(
+        map(
+            Closure._make,
+            zip(
+                _to_list(closures["location_id"]),
+                _to_list(closures["name"]),
+                _to_list(closures["alert_id"]),
+                _to_list(closures["closed_for"]),
+                _to_list(closures["extended_closing"]),
+                [polling_date.isoformat()] * len(closures),
+                closure_start[keep].tolist(),
+                closure_end[keep].tolist(),
+                is_full_day[keep].tolist(),
+            ),
+        )
+    )
+
+
+def aggregate_closure_batches(alert_batches, polling_date, polling_datetimes):
+    """
+    Streaming version of aggregate_closures. The alerts arrive in batches
+    ordered such that each (alert_id, location_id) group's rows are contiguous,
+    and each group is aggregated as soon as its last row has arrived, so only
+    one batch (plus the rows of a group that spans batches) is held at a time.
+
+    Parameters
+    ----------
+    alert_batches: iterable<DataFrame>
+        The closure alerts for a single day, with the datetime columns already
+        converted to US/Eastern
+    polling_date: date
+        The date on which the alerts were polled
+    polling_datetimes: sequence
+        Every distinct datetime at which the poller ran that day
+
+    Returns
+    -------
+    list<Closure>
+        The closures, in the same order as aggregate_closures returns them
+    """
+    closures = []
+    pending_df = None
+    for batch_df in alert_batches:
+        complete_df, pending_df = split_complete_groups(pending_df, batch_df)
+        if len(complete_df) > 0:
+            closures.extend(
+                aggregate_closures(complete_df, polling_date, polling_datetimes)
+            )
+    if pending_df is not None and len(pending_df) > 0:
+        closures.extend(
+            aggregate_closures(
+                pending_df.reset_index(drop=True), polling_date, polling_datetimes
+            )
+        )
+
+    closures.sort(key=_group_sort_key)
+    return closures
+
+
+def split_complete_groups(pending_df, batch_df):
+    """
+    Splits a batch of alerts ordered such that each (alert_id, location_id)
+    group's rows are contiguous into the groups that are complete and the
+    final group, which may continue into the next batch
+
+    Parameters
+    ----------
+    pending_df: DataFrame or None
+        The rows of the group left pending by the previous batch, if any
+    batch_df: DataFrame
+        The next batch of alerts
+
+    Returns
+    -------
+    tuple<DataFrame>
+        The rows of the complete groups, and the rows of the final group
+    """
+    if pending_df is not None:
+        batch_df = pd.concat([pending_df, batch_df], ignore_index=True)
+    if len(batch_df) == 0:
+        return batch_df, pending_df
+
+    last_alert = batch_df.iloc[-1]
+    is_last_group = _is_group(batch_df, last_alert["alert_id"], "alert_id") & (
+        _is_group(batch_df, last_alert["location_id"], "location_id")
+    )
+    return batch_df[~is_last_group].reset_index(drop=True), batch_df[is_last_group]
+
+
+def aggregate_sharded_closures(alerts_df, polling_date, shard_count):
+    """
+    Parallel version of aggregate_closures. The alerts are hash partitioned by
+    location_id, so that every (alert_id, location_id) group falls within a
+    single shard, and the shards are aggregated in a process pool with one
+    worker per shard. The polling datetimes of the whole day, which every
+    group is checked against, are sent to each worker once when it starts.
+
+    Parameters
+    ----------
+    alerts_df: DataFrame
+        The closure alerts for a single day, with the datetime columns already
+        converted to US/Eastern
+    polling_date: date
+        The date on which the alerts were polled
+    shard_count: int
+        The number of shards, and so of worker processes
+
+    Returns
+    -------
+    list<Closure>
+        The closures, in the same order as aggregate_closures returns them
+
+    Raises
+    ------
+    OSError
+        If the process pool can't be started
+    """
+    shard_ids = pd.util.hash_pandas_object(
+        alerts_df["location_id"], index=False
+    ).to_numpy() % np.uint64(shard_count)
+    shards = [
+        alerts_df[shard_ids == shard_id].reset_index(drop=True)
+        for shard_id in range(shard_count)
+        if np.any(shard_ids == shard_id)
+    ]
+    polling_datetimes = pd.DatetimeIndex(alerts_df["polling_datetime"].unique())
+
+    with ProcessPoolExecutor(
+        max_workers=len(shards),
+        mp_context=get_process_pool_context(),
+        initializer=_set_shard_context,
+        initargs=(polling_date, polling_datetimes),
+    ) as executor:
+        shard_results = list(executor.map(_aggregate_shard, shards))
+
+    # Counts made in the workers are added to this process's run so that they
+    # match those of the serial path
+    closures = []
+    for shard_closures, shard_counts in shard_results:
+        closures.extend(shard_closures)
+        for name, value in shard_counts.items():
+            metrics.count(name, value)
+    closures.sort(key=_group_sort_key)
+    return closures
+
+
+def get_process_pool_context():
+    """
+    Returns the multiprocessing context to start process pool workers with.
+    Forking while other threads are running can deadlock the forked worker on
+    a lock another thread held. That includes the threads of the environments
+    thread pool and native threads such as pyarrow's allocator thread, so the
+    workers are then started from a fork server instead. Otherwise None is
+    returned, for the platform's default.
+    """
+    import multiprocessing
+    import threading
+
+    try:
+        # Native threads aren't listed by the threading module
+        thread_count = len(os.listdir("/proc/self/task"))
+    except OSError:
+        thread_count = threading.active_count()
+    if thread_count > 1:
+        return multiprocessing.get_context("forkserver")
+    return None
+
+
+def _set_shard_context(polling_date, polling_datetimes):
+    global _shard_context
+    _shard_context = (polling_date, polling_datetimes)
+
+
+def _aggregate_shard(shard_df):
+    """Aggregates one shard in a worker, returning its closures and counts"""
+    polling_date, polling_datetimes = _shard_context
+    shard_run = metrics.start_run()
+    closures = aggregate_closures(shard_df, polling_date, polling_datetimes)
+    return closures, shard_run.counts
+
+
+def _is_group(alerts_df, value, column):
+    if pd.isnull(value):
+        return alerts_df[column].isnull()
+    return alerts_df[column] == value
+
+
+def _group_sort_key(closure):
+    """Sorts closures by (alert_id, location_id), with missing values last"""
+    alert_id, location_id = closure[2], closure[0]
+    return (
+        pd.isnull(alert_id),
+        "" if pd.isnull(alert_id) else alert_id,
+        pd.isnull(location_id),
+        "" if pd.isnull(location_id) else location_id,
+    )
+
+
+def _to_list(values):
+    """Returns the values as Python objects, with any missing values as None"""
+    return values.astype(object).where(values.notnull(), None).tolist()
+
+
+def _concatenate(buffers, dtype):
+    """Concatenates the buffers, which may be empty, into a single array"""
+    if len(buffers) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(buffers)
+
+
+def _to_ns(timestamps):
+    """Returns the UTC nanosecond epoch of each tz-aware timestamp"""
+    return pd.DatetimeIndex(timestamps).as_unit("ns").asi8
+
+
+def _format_utc(timestamps):
+    """Formats each timestamp in UTC the way the reduced alerts query does"""
+    return (
+        pd.DatetimeIndex(timestamps)
+        .tz_convert("UTC")
+        .strftime("%Y-%m-%d %H:%M:%S.%f")
+        .to_numpy(dtype=object)
+    )
+
+
+def _wall_clock(timestamps):
+    """
+    Returns the ISO formatted Eastern wall clock time of each timestamp (as
+    time.isoformat() would format it) along with its nanosecond offset from
+    midnight
+    """
+    wall = pd.DatetimeIndex(timestamps).tz_localize(None).floor("us")
+    offsets = (wall - wall.normalize()).as_unit("ns").asi8
+    formatted = pd.Series(wall.strftime("%H:%M:%S.%f"), dtype=object)
+    formatted = formatted.where(wall.microsecond != 0, formatted.str[:-7])
+    return formatted.to_numpy(dtype=object), offsets
+
+
+def _localize(local_date, offsets):
+    """
+    Localizes each wall clock offset on the given date to US/Eastern the same
+    way pytz's localize does by default: ambiguous times resolve to standard
+    time and non-existent times keep their standard time UTC offset
+    """
+    midnight = np.datetime64(datetime.combine(local_date, datetime.min.time()), "ns")
+    naive = pd.DatetimeIndex(midnight + offsets.astype("timedelta64[ns]"))
+    localized = naive.tz_localize(
+        "US/Eastern",
+        ambiguous=np.zeros(len(naive), dtype=bool),
+        nonexistent=pd.Timedelta(hours=1),
+    )
+    return localized.as_unit("ns").asi8
+
+
+def _to_seconds(times):
+    """Converts each datetime.time to its whole seconds since midnight"""
+    seconds = {
+        t: (t.hour * 60 + t.minute) * 60 + t.second for t in set(times) if t is not None
+    }
+    return pd.array([seconds.get(t) for t in times], dtype="Int32")
+
+
+def _localize_times(local_date, times, mask):
+    """
+    Combines each datetime.time (or offset in seconds from midnight) under the
+    mask with the given date and localizes it to US/Eastern, returning the
+    nanosecond epochs along with the ISO formatted wall clock times
+    """
+    masked_times = times[mask]
+    if pd.api.types.is_integer_dtype(masked_times.dtype):
+        seconds = masked_times.to_numpy(dtype=np.int64)
+        unique_seconds, inverse = np.unique(seconds, return_inverse=True)
+        unique_walls = np.array(
+            [
+                time(second // 3600, second // 60 % 60, second % 60).isoformat()
+                for second in unique_seconds.tolist()
+            ],
+            dtype=object,
+        )
+        epochs = np.zeros(len(times), dtype=np.int64)
+        walls = np.full(len(times), None, dtype=object)
+        epochs[mask] = _localize(local_date, seconds * _NS_PER_SECOND)
+        walls[mask] = unique_walls[inverse]
+        return epochs, walls
+
+    unique_times = masked_times.unique()
+    offsets = {
+        t: ((t.hour * 60 + t.minute) * 60 + t.second) * _NS_PER_SECOND
+        + t.microsecond * 1000
+        for t in unique_times
+    }
+    wall = {t: t.isoformat() for t in unique_times}
+
+    epochs = np.zeros(len(times), dtype=np.int64)
+    walls = np.full(len(times), None, dtype=object)
+    epochs[mask] = _localize(
+        local_date, masked_times.map(offsets).to_numpy(dtype=np.int64)
+    )
+    walls[mask] = masked_times.map(wall).to_numpy(dtype=object)
+    return epochs, walls
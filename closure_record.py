@@ -0,0 +1,28 @@
+from collections import namedtuple
+from query_helper import CLOSURES_COLUMNS
+
+
+class Closure(namedtuple("Closure", CLOSURES_COLUMNS)):
+    """
+    A single row of the closures table. The fields are taken from
+    CLOSURES_COLUMNS, so they are always in the order the insert and COPY
+    queries list the columns, and each record can be passed to the writer as
+    is. Missing values are None.
+
+    Fields
+    ------
+    location_id: str
+    name: str
+    alert_id: str
+    closed_for: str
+    is_extended_closure: bool
+    closure_date: str
+        The ISO formatted date of the closure
+    closure_start: str
+        The ISO formatted Eastern wall clock time at which the closure starts
+    closure_end: str
+        The ISO formatted Eastern wall clock time at which the closure ends
+    is_full_day: bool
+    """
+
+    __slots__ = ()
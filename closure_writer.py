@@ -0,0 +1,183 @@
+import boto3
+import csv
+import gzip
+import math
+import os
+import uuid
+
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+from io import BytesIO, StringIO
+from nypl_py_utils.functions.log_helper import create_log
+from query_helper import (
+    CLOSURES_COLUMNS,
+    STATE_COLUMNS,
+    build_copy_query,
+    build_insert_state_query,
+    build_multi_row_insert_query,
+)
+
+logger = create_log("closure_writer")
+
+# Redshift limits a single statement to 32767 query parameters
+_MAX_QUERY_PARAMETERS = 32767
+
+_DEFAULT_INSERT_BATCH_SIZE = 1000
+_DEFAULT_COPY_MIN_ROWS = 10000
+
+# How missing values are written to the staged file. This must match the
+# NULL AS option in the COPY query.
+_STAGED_NULL_VALUE = "\\N"
+
+
+def build_closure_write_queries(closures_table, closures):
+    """
+    Builds the queries to write the closures to Redshift, picking between
+    multi-row INSERTs and a COPY from a file staged in S3 based on the number
+    of closures. The COPY is only used when CLOSURES_STAGING_BUCKET and
+    CLOSURES_COPY_IAM_ROLE are set and there are at least
+    CLOSURES_COPY_MIN_ROWS closures, and the file is not uploaded when
+    DO_NOT_UPDATE is set, as the queries are then only logged.
+
+    Parameters
+    ----------
+    closures_table: str
+        The name of the table to write the closures to
+    closures: list<Closure>
+        The closures to write
+
+    Returns
+    -------
+    list<tuple>
+        The (query, values) pairs to pass to RedshiftClient.execute_transaction
+    """
+    bucket = os.environ.get("CLOSURES_STAGING_BUCKET")
+    iam_role = os.environ.get("CLOSURES_COPY_IAM_ROLE")
+    copy_min_rows = int(
+        os.environ.get("CLOSURES_COPY_MIN_ROWS", _DEFAULT_COPY_MIN_ROWS)
+    )
+    if bucket and iam_role and len(closures) >= copy_min_rows:
+        key = "{table}/{timestamp}-{id}.csv.gz".format(
+            table=closures_table,
+            timestamp=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H%M%S"),
+            id=uuid.uuid4().hex,
+        )
+        if os.environ.get("DO_NOT_UPDATE", False) == "True":
+            logger.info(
+                "Not staging {count} closures at s3://{bucket}/{key}".format(
+                    count=len(closures), bucket=bucket, key=key
+                )
+            )
+        else:
+            stage_closures(closures, bucket, key)
+        s3_path = "s3://{bucket}/{key}".format(bucket=bucket, key=key)
+        return [(build_copy_query(closures_table, s3_path, iam_role), None)]
+
+    batch_size = int(
+        os.environ.get("CLOSURES_INSERT_BATCH_SIZE", _DEFAULT_INSERT_BATCH_SIZE)
+    )
+    return build_insert_queries(closures_table, closures, batch_size)
+
+
+def build_insert_queries(closures_table, closures, batch_size):
+    """
+    Splits the closures into batches of at most batch_size rows (and at most
+    Redshift's query parameter limit) and builds one multi-row INSERT per batch
+    """
+    batch_size = _cap_batch_size(batch_size, len(CLOSURES_COLUMNS))
+    logger.info(
+        "Inserting {count} closures in batches of {size}".format(
+            count=len(closures), size=batch_size
+        )
+    )
+    return _build_batched_inserts(
+        closures,
+        batch_size,
+        lambda row_count: build_multi_row_insert_query(closures_table, row_count),
+    )
+
+
+def build_state_insert_queries(state_table, state_rows):
+    """
+    Builds the multi-row INSERTs to write the incremental state rows, in
+    batches of at most CLOSURES_INSERT_BATCH_SIZE rows
+    """
+    batch_size = _cap_batch_size(
+        int(os.environ.get("CLOSURES_INSERT_BATCH_SIZE", _DEFAULT_INSERT_BATCH_SIZE)),
+        len(STATE_COLUMNS),
+    )
+    return _build_batched_inserts(
+        state_rows,
+        batch_size,
+        lambda row_count: build_insert_state_query(state_table, row_count),
+    )
+
+
+def serialize_closures(closures):
+    """Writes the closures to a gzipped CSV in the format the COPY expects"""
+    output = StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    for closure in closures:
+        writer.writerow([_format_staged_value(value) for value in closure])
+    return gzip.compress(output.getvalue().encode("utf-8"))
+
+
+def stage_closures(closures, bucket, key):
+    """Uploads the serialized closures to S3 so they can be COPY'd"""
+    logger.info(
+        "Staging {count} closures at s3://{bucket}/{key}".format(
+            count=len(closures), bucket=bucket, key=key
+        )
+    )
+    try:
+        s3_client = boto3.client(
+            "s3", region_name=os.environ.get("AWS_REGION", "us-east-1")
+        )
+        s3_client.upload_fileobj(BytesIO(serialize_closures(closures)), bucket, key)
+        s3_client.close()
+    except ClientError as e:
+        logger.error(
+            "Error staging closures at s3://{bucket}/{key}: {error}".format(
+                bucket=bucket, key=key, error=e
+            )
+        )
+        raise ClosureWriterError(
+            "Error staging closures at s3://{bucket}/{key}: {error}".format(
+                bucket=bucket, key=key, error=e
+            )
+        ) from None
+
+
+def _cap_batch_size(batch_size, column_count):
+    # Redshift limits the number of parameters in a single statement
+    return max(1, min(batch_size, _MAX_QUERY_PARAMETERS // column_count))
+
+
+def _build_batched_inserts(rows, batch_size, build_query):
+    queries = []
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i : i + batch_size]
+        values = [_null_if_missing(value) for row in batch for value in row]
+        queries.append((build_query(len(batch)), values))
+    return queries
+
+
+def _null_if_missing(value):
+    # Rows built through a DataFrame can hold NaN rather than None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _format_staged_value(value):
+    value = _null_if_missing(value)
+    if value is None:
+        return _STAGED_NULL_VALUE
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+
+class ClosureWriterError(Exception):
+    def __init__(self, message=None):
+        self.message = message
@@ -0,0 +1,109 @@
+import os
+import time
+
+from nypl_py_utils.classes.kms_client import KmsClient
+from nypl_py_utils.classes.redshift_client import RedshiftClient
+from nypl_py_utils.functions.log_helper import create_log
+
+logger = create_log("connection_cache")
+
+_DEFAULT_SECRETS_CACHE_TTL = 3600
+
+_HEALTH_CHECK_QUERY = "SELECT 1;"
+
+# Both of these live for as long as Lambda keeps the container warm, so they
+# are shared by every invocation the container handles
+_decrypted_secrets = {}
+_redshift_clients = {}
+
+
+def decrypt_secrets(encrypted_secrets):
+    """
+    Decrypts each of the KMS encrypted secrets. Values decrypted by earlier
+    invocations in the same container are reused for up to SECRETS_CACHE_TTL
+    seconds (an hour by default, and 0 disables the cache), and a KMS client
+    is only created if at least one secret needs to be decrypted.
+
+    Parameters
+    ----------
+    encrypted_secrets: list<str>
+        The base 64 KMS encrypted secrets
+
+    Returns
+    -------
+    list<str>
+        The decrypted secrets, in the same order
+    """
+    ttl = float(os.environ.get("SECRETS_CACHE_TTL", _DEFAULT_SECRETS_CACHE_TTL))
+    now = time.monotonic()
+    expired_secrets = [
+        secret
+        for secret in dict.fromkeys(encrypted_secrets)
+        if secret not in _decrypted_secrets or _decrypted_secrets[secret][1] <= now
+    ]
+    if len(expired_secrets) > 0:
+        kms_client = KmsClient()
+        for secret in expired_secrets:
+            _decrypted_secrets[secret] = (kms_client.decrypt(secret), now + ttl)
+        kms_client.close()
+    else:
+        logger.info("Reusing cached secrets")
+    return [_decrypted_secrets[secret][0] for secret in encrypted_secrets]
+
+
+def get_redshift_client(host, database, user, password):
+    """
+    Returns a connected RedshiftClient. The connection made by an earlier
+    invocation in the same container is reused if it passes a health check
+    and was made with the same credentials, once any transaction the earlier
+    invocation left open has been rolled back. Otherwise it is closed and a
+    new connection is made.
+    """
+    key = (host, database, user)
+    cached_client, cached_password = _redshift_clients.pop(key, (None, None))
+    if cached_client is not None:
+        if cached_password == password and _is_healthy(cached_client):
+            logger.info("Reusing {} database connection".format(database))
+            _redshift_clients[key] = (cached_client, password)
+            return cached_client
+        _close_quietly(cached_client)
+
+    redshift_client = RedshiftClient(host, database, user, password)
+    redshift_client.connect()
+    _redshift_clients[key] = (redshift_client, password)
+    return redshift_client
+
+
+def clear_cache():
+    """Forgets every cached secret and closes every cached connection"""
+    for redshift_client, _ in _redshift_clients.values():
+        _close_quietly(redshift_client)
+    _redshift_clients.clear()
+    _decrypted_secrets.clear()
+
+
+def _is_healthy(redshift_client):
+    if redshift_client.conn is None:
+        return False
+    try:
+        cursor = redshift_client.conn.cursor()
+        try:
+            cursor.execute(_HEALTH_CHECK_QUERY)
+            cursor.fetchall()
+        finally:
+            cursor.close()
+        # Autocommit is off and RedshiftClient.execute_query never commits, so
+        # a run that only read leaves its transaction open. It's ended here so
+        # that this run doesn't read that run's snapshot of the tables.
+        redshift_client.conn.rollback()
+        return True
+    except Exception as e:
+        logger.info("Cached database connection failed health check: {}".format(e))
+        return False
+
+
+def _close_quietly(redshift_client):
+    try:
+        redshift_client.close_connection()
+    except Exception:
+        pass
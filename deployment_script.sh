@@ -7,5 +7,19 @@ pip install --target ./package -r requirements.txt
 cd package
 zip -r ../deployment-package.zip .
 cd ..
+zip deployment-package.zip alert_snapshots.py
+zip deployment-package.zip closure_engine.py
+zip deployment-package.zip closure_record.py
+zip deployment-package.zip closure_writer.py
+zip deployment-package.zip connection_cache.py
+zip deployment-package.zip hours_index.py
+zip deployment-package.zip idempotency.py
 zip deployment-package.zip lambda_function.py
-zip deployment-package.zip query_helper.py
\ No newline at end of file
+zip deployment-package.zip live_closures.py
+zip deployment-package.zip metrics.py
+zip deployment-package.zip pipeline.py
+zip deployment-package.zip poll_runs.py
+zip deployment-package.zip polling_index.py
+zip deployment-package.zip profiling.py
+zip deployment-package.zip query_helper.py
+zip deployment-package.zip row_engine.py
\ No newline at end of file
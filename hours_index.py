@@ -0,0 +1,113 @@
+import os
+import time
+
+from nypl_py_utils.functions.log_helper import create_log
+from pytz import timezone
+from query_helper import build_get_current_hours_query, build_get_hours_version_query
+
+logger = create_log("hours_index")
+
+_EASTERN_TIMEZONE = timezone("US/Eastern")
+
+_DEFAULT_HOURS_CACHE_TTL = 3600
+
+# Lives for as long as Lambda keeps the container warm, so the location hours
+# are shared by every invocation the container handles
+_hours_indexes = {}
+
+
+def get_hours_index(redshift_client, hours_table):
+    """
+    Returns the current regular hours of each location, keyed by (location_id,
+    weekday). The hours loaded by an earlier invocation in the same container
+    are reused for up to HOURS_CACHE_TTL seconds (an hour by default, and 0
+    disables the cache), as long as the hours table's row counts show it
+    hasn't changed since.
+
+    Parameters
+    ----------
+    redshift_client: RedshiftClient
+        A connected client for the database holding the hours table
+    hours_table: str
+        The name of the location hours table
+
+    Returns
+    -------
+    dict
+        The (regular_open, regular_close) times of each (location_id, weekday)
+        pair, where the weekday is the full English name, e.g. "Monday"
+    """
+    ttl = float(os.environ.get("HOURS_CACHE_TTL", _DEFAULT_HOURS_CACHE_TTL))
+    now = time.monotonic()
+    if ttl <= 0:
+        return _load_hours_index(redshift_client, hours_table)
+
+    version = tuple(
+        redshift_client.execute_query(build_get_hours_version_query(hours_table))[0]
+    )
+    cached_index, cached_version, expires_at = _hours_indexes.get(
+        hours_table, (None, None, None)
+    )
+    if cached_index is not None and cached_version == version and expires_at > now:
+        logger.info("Reusing cached location hours")
+        return cached_index
+
+    hours_index = _load_hours_index(redshift_client, hours_table)
+    _hours_indexes[hours_table] = (hours_index, version, now + ttl)
+    return hours_index
+
+
+def join_hours(raw_alerts, hours_index):
+    """
+    Adds the regular hours of each alert's location on the Eastern weekday it
+    was polled to the end of each row, as the hours join in the alerts query
+    does. Rows without matching hours get None for both.
+
+    Parameters
+    ----------
+    raw_alerts: list<tuple>
+        The rows of the staged alerts query
+    hours_index: dict
+        The location hours, as returned by get_hours_index
+
+    Returns
+    -------
+    list<tuple>
+        The rows in the column order of the alerts query
+    """
+    weekdays = {}
+    joined_alerts = []
+    for raw_alert in raw_alerts:
+        polling_datetime = raw_alert[7]
+        weekday = weekdays.get(polling_datetime)
+        if weekday is None:
+            weekday = polling_datetime.astimezone(_EASTERN_TIMEZONE).strftime("%A")
+            weekdays[polling_datetime] = weekday
+        joined_alerts.append(
+            tuple(raw_alert) + hours_index.get((raw_alert[0], weekday), (None, None))
+        )
+    return joined_alerts
+
+
+def _load_hours_index(redshift_client, hours_table):
+    logger.info("Loading location hours")
+    hours_index = {}
+    for (
+        location_id,
+        weekday,
+        regular_open,
+        regular_close,
+    ) in redshift_client.execute_query(build_get_current_hours_query(hours_table)):
+        # Redshift ignores trailing blanks when comparing strings, and the
+        # weekday names from TO_CHAR are blank-padded
+        if weekday is not None:
+            hours_index[(location_id, weekday.rstrip())] = (
+                regular_open,
+                regular_close,
+            )
+    return hours_index
+
+
+def clear_cache():
+    """Forgets the cached location hours"""
+    _hours_indexes.clear()
@@ -0,0 +1,120 @@
+import hashlib
+import metrics
+
+from nypl_py_utils.functions.log_helper import create_log
+
+logger = create_log("idempotency")
+
+# Lives for as long as Lambda keeps the container warm, so that a retried
+# invocation can reuse the closures computed for the same alerts. Only the most
+# recent run's closures are kept for each staging table, along with the
+# fingerprint of its alerts, so that the environments processed at once don't
+# replace each other's.
+_cached_closures = {}
+
+
+def fingerprint_rows(rows):
+    """
+    Returns a SHA-256 hex digest of the rows that doesn't depend on their
+    order, e.g. of the rows of the alerts query or of a batch of closures
+
+    Parameters
+    ----------
+    rows: iterable<tuple>
+        The rows, each of which is a tuple (or namedtuple) of plain values
+
+    Returns
+    -------
+    str
+        The 64 character hex digest
+    """
+    digest = hashlib.sha256()
+    for row in sorted(repr(tuple(row)) for row in rows):
+        digest.update(row.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def fingerprint_alerts_df(alerts_df):
+    """
+    Returns a SHA-256 hex digest of the alerts that doesn't depend on their
+    order, computed from the hash of each row of the DataFrame rather than from
+    Python row tuples. This differs from the fingerprint_rows digest of the
+    same alerts, so the two aren't interchangeable.
+
+    Parameters
+    ----------
+    alerts_df: DataFrame
+        The alerts, as built by build_alerts_df or AlertColumns
+
+    Returns
+    -------
+    str
+        The 64 character hex digest
+    """
+    import pandas as pd
+
+    # The datetimes are hashed as integers, so they are put in the same unit
+    # however the DataFrame was built
+    alerts_df = alerts_df.assign(
+        **{
+            column: values.dt.as_unit("ns")
+            for column, values in alerts_df.items()
+            if isinstance(values.dtype, pd.DatetimeTZDtype)
+        }
+    )
+    row_hashes = pd.util.hash_pandas_object(alerts_df, index=False).sort_values()
+    return hashlib.sha256(row_hashes.to_numpy().tobytes()).hexdigest()
+
+
+def clear_cache():
+    """Forgets the cached closures"""
+    _cached_closures.clear()
+
+
+class RetryCache:
+    """
+    Lets a retried invocation reuse the closures computed for the same alerts
+    rather than aggregating them again. The closures are inserted in the same
+    transaction that deletes the alerts they came from, so a retry after that
+    transaction was committed finds none of those alerts left to write twice.
+    A retry after a failed write, though, reads the same alerts again, and
+    the closures computed for them are kept in the warm container for it.
+    """
+
+    def __init__(self, closure_alerts_table):
+        self.closure_alerts_table = closure_alerts_table
+        self.alerts_fingerprint = None
+        self.is_cached = False
+        self.cached_closures = None
+
+    def check_alerts(self, alerts_fingerprint):
+        """
+        Records the fingerprint of the run's alerts and looks up whether
+        closures are cached for them
+
+        Returns
+        -------
+        bool
+            Whether closures are cached for the alerts, in which case they are
+            held in cached_closures
+        """
+        self.alerts_fingerprint = alerts_fingerprint
+        cached_fingerprint, cached_closures = _cached_closures.get(
+            self.closure_alerts_table, (None, None)
+        )
+        if alerts_fingerprint == cached_fingerprint:
+            self.is_cached = True
+            self.cached_closures = cached_closures
+            metrics.count("RetriedAlerts")
+            logger.info(
+                "Reusing the cached closures for alerts {}".format(alerts_fingerprint)
+            )
+        return self.is_cached
+
+    def record(self, closures):
+        """Caches the closures aggregated from the run's alerts"""
+        _cached_closures[self.closure_alerts_table] = (
+            self.alerts_fingerprint,
+            closures,
+        )
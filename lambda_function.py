@@ -1,37 +1,294 @@
 import json
+import metrics
 import os
-import pandas as pd
 
+from alert_snapshots import read_alerts_snapshot, write_alerts_snapshot
+from closure_record import Closure
+from closure_writer import build_closure_write_queries, build_state_insert_queries
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from connection_cache import decrypt_secrets, get_redshift_client
 from datetime import datetime, time
-from nypl_py_utils.classes.kms_client import KmsClient
-from nypl_py_utils.classes.redshift_client import RedshiftClient
-from nypl_py_utils.functions.config_helper import load_env_file
+from functools import partial
+from hours_index import get_hours_index, join_hours
+from idempotency import RetryCache, fingerprint_alerts_df, fingerprint_rows
+from live_closures import update_live_closures
 from nypl_py_utils.functions.log_helper import create_log
+from polling_index import PollingTimeIndex
+from pipeline import write_pipelined_closures
+from profiling import profile_run
 from pytz import timezone
-from query_helper import build_get_alerts_query, build_insert_query
+from query_helper import (
+    ALERTS_CURSOR_NAME,
+    GET_ALERTS_COLUMNS,
+    GET_REDUCED_ALERTS_COLUMNS,
+    STATE_COLUMNS,
+    build_close_cursor_query,
+    build_declare_cursor_query,
+    build_delete_closures_for_date_query,
+    build_delete_consumed_alerts_query,
+    build_delete_state_query,
+    build_fetch_cursor_query,
+    build_get_alerts_query,
+    build_get_incremental_alerts_query,
+    build_get_polling_datetimes_query,
+    build_get_reduced_alerts_query,
+    build_get_sorted_alerts_query,
+    build_get_staged_alerts_query,
+    build_get_state_query,
+)
+from row_engine import aggregate_closure_rows, localize_cache_stats, to_eastern
+
+# pandas (and the columnar engine built on it) takes up most of the cold start,
+# so it is only imported by the functions that need it and never by the
+# small-input path
 
 logger = create_log("lambda_function")
 
 _EASTERN_TIMEZONE = timezone("US/Eastern")
 
+_UTC_TIMEZONE = timezone("UTC")
+
+# The ways in which a run can fetch and aggregate the staged alerts, one of
+# which _get_run_mode picks
+_INCREMENTAL_MODE = "incremental"
+_PIPELINED_MODE = "pipelined"
+_STREAMING_MODE = "streaming"
+_REDUCED_MODE = "reduced"
+_COLUMNAR_MODE = "columnar"
+_DEFAULT_MODE = "default"
+
+# The modes that never hold every staged alert at once, which the snapshots
+# need, and those that can fingerprint the alerts for the retry cache
+_UNSNAPSHOTTED_MODES = [_PIPELINED_MODE, _STREAMING_MODE, _REDUCED_MODE]
+_RETRY_CACHE_MODES = [_COLUMNAR_MODE, _DEFAULT_MODE]
+
+_RunMode = namedtuple("_RunMode", ["name", "backfill", "idempotent"])
+
+_DEFAULT_FAST_PATH_MAX_ROWS = 20000
+
+_DEFAULT_PARALLEL_MIN_ROWS = 200000
+
+_DEFAULT_COLUMNAR_FETCH_BATCH_SIZE = 50000
+
+
+def get_closures_from_rows(raw_alerts):
+    # Aggregates the rows returned by the alerts query without building a
+    # DataFrame. Used for small inputs, such as days when the only alerts are
+    # the poller's own rows.
+    logger.info("Aggregating closures from rows")
+    if len(raw_alerts) == 0:
+        return None
+
+    alerts = to_eastern(raw_alerts)
+    polling_index = PollingTimeIndex(alert[7] for alert in alerts)
+    polling_date = _get_polling_date(polling_index[0], polling_index[-1])
+    closures = aggregate_closure_rows(alerts, polling_date, polling_index)
+    cache_stats = localize_cache_stats()
+    logger.info(
+        "Localization cache hit rate: {hit_rate:.1%} ({hits} hits, {misses} "
+        "misses, {size} entries)".format(**cache_stats)
+    )
+    return None if len(closures) == 0 else closures
+
+
+def get_closures(alerts_df, sharded=True):
+    # Accepts either the rows of the alerts query or the rows of the reduced
+    # alerts query, which holds one row per alert group. Unless sharded is
+    # False, large inputs of the former are aggregated in parallel when
+    # PARALLEL_MODE is set.
+    from closure_engine import aggregate_reduced_closures
 
-def get_closures(alerts_df):
     logger.info("Aggregating closures")
     if len(alerts_df) == 0:
         return None
 
-    # Each polling session should only encompass one day
-    alerts_df["polling_datetime"] = alerts_df["polling_datetime"].dt.tz_convert(
-        "US/Eastern"
+    if "polling_datetimes" in alerts_df.columns:
+        polling_date = _convert_reduced_to_eastern(alerts_df)
+        closures = aggregate_reduced_closures(alerts_df, polling_date)
+    else:
+        polling_date, _ = _convert_to_eastern(alerts_df)
+        closures = _aggregate_shards(alerts_df, polling_date, sharded)
+    return None if len(closures) == 0 else closures
+
+
+def get_streamed_closures(redshift_client, hours_table, closure_alerts_table):
+    # Streams the alerts from Redshift in batches of ALERTS_BATCH_SIZE rows
+    # rather than loading them all at once, so that memory use doesn't grow
+    # with the size of the staging table. The distinct polling datetimes are
+    # fetched first, as every alert group is checked against them.
+    import pandas as pd
+    from closure_engine import aggregate_closure_batches, build_alerts_df
+
+    logger.info("Aggregating streamed closures")
+    polling_datetimes = _fetch_polling_datetimes(redshift_client, closure_alerts_table)
+    if len(polling_datetimes) == 0:
+        return None
+
+    polling_date = _get_polling_date(polling_datetimes.min(), polling_datetimes.max())
+    alert_batches = (
+        build_alerts_df(raw_alerts)
+        for raw_alerts in _count_alert_rows(
+            _fetch_alert_batches(
+                redshift_client,
+                build_get_sorted_alerts_query(hours_table, closure_alerts_table),
+                int(os.environ["ALERTS_BATCH_SIZE"]),
+            )
+        )
     )
-    alerts_df["alert_start"] = alerts_df["alert_start"].dt.tz_convert("US/Eastern")
-    alerts_df["alert_end"] = alerts_df["alert_end"].dt.tz_convert("US/Eastern")
-    polling_datetimes = alerts_df["polling_datetime"].unique()
-    polling_date = polling_datetimes.min().date()
-    if polling_date != polling_datetimes.max().date():
-        logger.error("Polling occurred over multiple days")
-        raise LocationClosureAggregatorError("Polling occurred over multiple days")
+    closures = aggregate_closure_batches(alert_batches, polling_date, polling_datetimes)
+    return None if len(closures) == 0 else closures
+
+
+def run_closure_pipeline(
+    redshift_client, hours_table, closures_table, closure_alerts_table
+):
+    # Streams the alerts as get_streamed_closures does, but writes each batch
+    # of closures as soon as it has been aggregated, so that fetching,
+    # aggregating, and writing overlap. Returns the number of closures written.
+    logger.info("Aggregating pipelined closures")
+
+    polling_datetimes = _fetch_polling_datetimes(redshift_client, closure_alerts_table)
+    polling_date = (
+        None
+        if len(polling_datetimes) == 0
+        else _get_polling_date(polling_datetimes.min(), polling_datetimes.max())
+    )
+    return write_pipelined_closures(
+        redshift_client,
+        build_get_sorted_alerts_query(hours_table, closure_alerts_table),
+        closures_table,
+        closure_alerts_table,
+        polling_date,
+        polling_datetimes,
+    )
+
+
+def get_closures_by_day(alerts_df):
+    # Used to catch up after missed runs, when the staging table holds alerts
+    # from more than one day. Each day is aggregated separately (in parallel
+    # when possible) and the closures from all of the days are returned
+    # together in date order.
+    logger.info("Aggregating closures by day")
+    if len(alerts_df) == 0:
+        return None
+
+    polling_dates = alerts_df["polling_datetime"].dt.tz_convert("US/Eastern").dt.date
+    daily_alerts = [
+        day_df.reset_index(drop=True)
+        for _, day_df in alerts_df.groupby(polling_dates, sort=True)
+    ]
+    logger.info(f"Aggregating closures for {len(daily_alerts)} days")
+    closures = [
+        closure
+        for day_closures in _aggregate_days(daily_alerts)
+        if day_closures is not None
+        for closure in day_closures
+    ]
+    return None if len(closures) == 0 else closures
+
+
+def get_closures_from_snapshots(snapshot_paths):
+    # Re-aggregates the alerts in local snapshots written by earlier runs. The
+    # snapshots are combined first, as incremental runs write several per day,
+    # and the closures for every day are returned in date order.
+    import pandas as pd
+
+    logger.info(f"Aggregating closures from {len(snapshot_paths)} snapshots")
+    if len(snapshot_paths) == 0:
+        return None
+
+    alerts_df = pd.concat(
+        [read_alerts_snapshot(path) for path in snapshot_paths], ignore_index=True
+    )
+    return get_closures_by_day(alerts_df)
+
+
+def get_incremental_queries(
+    redshift_client, hours_table, closures_table, closure_alerts_table, state_table
+):
+    # Aggregates only the alerts polled since the previous run, so that the
+    # lambda can run throughout the day. The reduced alerts for the most recent
+    # day are kept in the state table and merged with the next run's alerts,
+    # and each day's closures are rewritten from the merged alerts. The latest
+    # polling datetime in the state table is the watermark: only alerts polled
+    # after it are read, and only the polls that were read are deleted.
+    import pandas as pd
+    from closure_engine import merge_reduced_alerts, reduce_alerts
 
+    logger.info("Aggregating closures incrementally")
+    raw_alerts = _fetch_alerts(
+        redshift_client, hours_table, closure_alerts_table, state_table
+    )
+    if len(raw_alerts) == 0:
+        logger.info("No new closure alerts")
+        return []
+    _snapshot_alerts(raw_alerts, closure_alerts_table)
+
+    with metrics.stage("BuildDataFrame"):
+        alerts_df = _build_alerts_df(raw_alerts)
+    with metrics.stage("StateQuery"):
+        state_df = pd.DataFrame(
+            data=redshift_client.execute_query(build_get_state_query(state_table)),
+            columns=STATE_COLUMNS,
+        )
+    queries = []
+    for polling_date, day_df in alerts_df.groupby(
+        alerts_df["polling_datetime"].dt.date, sort=True
+    ):
+        with metrics.stage("Aggregate"):
+            reduced_df = reduce_alerts(day_df.reset_index(drop=True))
+            day_state_df = state_df[state_df["polling_date"] == polling_date]
+            if len(day_state_df) > 0:
+                reduced_df = merge_reduced_alerts(
+                    day_state_df.drop(columns="polling_date"), reduced_df
+                )
+            logger.info(f"Aggregating closures for {polling_date}")
+            closures = get_closures(reduced_df.copy())
+        queries.append(
+            (
+                build_delete_closures_for_date_query(closures_table),
+                [polling_date.isoformat()],
+            )
+        )
+        if closures is not None:
+            metrics.count("Closures", len(closures))
+            with metrics.stage("BuildWriteQueries"):
+                queries.extend(build_closure_write_queries(closures_table, closures))
+
+    # Only the most recent day can receive more alerts, so only its reduced
+    # alerts are kept
+    reduced_df.insert(0, "polling_date", polling_date)
+    state_rows = (
+        reduced_df.astype(object).where(reduced_df.notnull(), None).values.tolist()
+    )
+    queries.append((build_delete_state_query(state_table), None))
+    queries.extend(build_state_insert_queries(state_table, state_rows))
+    polling_datetimes = [
+        polling_datetime.to_pydatetime()
+        for polling_datetime in alerts_df["polling_datetime"].drop_duplicates()
+    ]
+    queries.append(
+        (
+            build_delete_consumed_alerts_query(
+                closure_alerts_table, len(polling_datetimes)
+            ),
+            polling_datetimes,
+        )
+    )
+    return queries
+
+
+def get_closures_reference(alerts_df):
+    # Original group-by-group implementation of get_closures. It is no longer
+    # used by the lambda but is kept as a reference for the columnar engine.
+    import pandas as pd
+
+    logger.info("Aggregating closures")
+    if len(alerts_df) == 0:
+        return None
+
+    polling_date, polling_datetimes = _convert_to_eastern(alerts_df)
     day_start = _EASTERN_TIMEZONE.localize(
         datetime(polling_date.year, polling_date.month, polling_date.day, 0, 0, 0)
     )
@@ -40,7 +297,7 @@ def get_closures(alerts_df):
     )
     closures = []
     for ids, alert_group in alerts_df.groupby(
-        ["alert_id", "location_id"], dropna=False
+        ["alert_id", "location_id"], dropna=False, observed=True
     ):
         # These are fake alerts created by the LocationClosureAlertPoller for
         # the purpose of recording each polling datetime
@@ -130,70 +387,549 @@ def get_closures(alerts_df):
             )
             closures.append(closure)
 
+    return None if len(closures) == 0 else [Closure(**closure) for closure in closures]
+
+
+def _aggregate_days(daily_alerts):
+    if len(daily_alerts) == 1:
+        return [get_closures(daily_alerts[0])]
+
+    # Each day is already aggregated in its own process, so the days aren't
+    # also split into shards
+    from closure_engine import get_process_pool_context
+
+    max_workers = min(len(daily_alerts), os.cpu_count() or 1)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=get_process_pool_context()
+        ) as executor:
+            return list(
+                executor.map(partial(get_closures, sharded=False), daily_alerts)
+            )
+    except OSError as e:
+        # The Lambda runtime does not provide /dev/shm, which process pools
+        # need, so fall back to aggregating each day in turn
+        logger.warning(f"Unable to start process pool, aggregating serially: {e}")
+        return [get_closures(day_df, sharded=False) for day_df in daily_alerts]
+
+
+def _aggregate_shards(alerts_df, polling_date, sharded):
+    # Splits the alerts by location across PARALLEL_WORKERS processes (one per
+    # vCPU by default) when there are at least PARALLEL_MIN_ROWS of them, as
+    # below that starting the workers takes longer than it saves
+    from closure_engine import aggregate_closures, aggregate_sharded_closures
+
+    shard_count = int(os.environ.get("PARALLEL_WORKERS", os.cpu_count() or 1))
+    min_rows = int(os.environ.get("PARALLEL_MIN_ROWS", _DEFAULT_PARALLEL_MIN_ROWS))
+    if (
+        not sharded
+        or os.environ.get("PARALLEL_MODE", False) != "True"
+        or shard_count < 2
+        or len(alerts_df) < min_rows
+    ):
+        return aggregate_closures(alerts_df, polling_date)
+
+    logger.info(f"Aggregating closures in {shard_count} shards")
+    try:
+        return aggregate_sharded_closures(alerts_df, polling_date, shard_count)
+    except OSError as e:
+        logger.warning(f"Unable to start process pool, aggregating serially: {e}")
+        return aggregate_closures(alerts_df, polling_date)
+
+
+def _fetch_polling_datetimes(redshift_client, closure_alerts_table):
+    import pandas as pd
+
+    return pd.to_datetime(
+        [
+            row[0]
+            for row in redshift_client.execute_query(
+                build_get_polling_datetimes_query(closure_alerts_table)
+            )
+        ],
+        utc=True,
+    ).tz_convert("US/Eastern")
+
+
+def _fetch_alert_batches(redshift_client, query, batch_size):
+    # RedshiftClient.execute_query fetches every row at once, so a server-side
+    # cursor is used instead to fetch the rows a batch at a time
+    cursor = redshift_client.conn.cursor()
+    try:
+        cursor.execute(build_declare_cursor_query(ALERTS_CURSOR_NAME, query))
+        while True:
+            cursor.execute(build_fetch_cursor_query(ALERTS_CURSOR_NAME, batch_size))
+            raw_alerts = cursor.fetchall()
+            if len(raw_alerts) == 0:
+                break
+            yield raw_alerts
+        cursor.execute(build_close_cursor_query(ALERTS_CURSOR_NAME))
+        redshift_client.conn.commit()
+    except Exception as e:
+        redshift_client.conn.rollback()
+        logger.error(f"Error streaming closure alerts: {e}")
+        raise LocationClosureAggregatorError(
+            f"Error streaming closure alerts: {e}"
+        ) from None
+    finally:
+        cursor.close()
+
+
+def _count_alert_rows(alert_batches):
+    for raw_alerts in alert_batches:
+        metrics.count("AlertRows", len(raw_alerts))
+        yield raw_alerts
+
+
+def _build_alerts_df(raw_alerts):
+    # Unlike closure_engine.build_alerts_df, this keeps the regular hours as
+    # datetime.time values, as the incremental mode writes them back to the
+    # state table
+    import pandas as pd
+
+    alerts_df = pd.DataFrame(data=raw_alerts, columns=GET_ALERTS_COLUMNS)
+    for column in ["alert_start", "alert_end", "polling_datetime"]:
+        alerts_df[column] = pd.to_datetime(alerts_df[column], utc=True).dt.tz_convert(
+            "US/Eastern"
+        )
+    return alerts_df
+
+
+def _convert_to_eastern(alerts_df):
+    # Frames from closure_engine.build_alerts_df are already in US/Eastern
+    for column in ["polling_datetime", "alert_start", "alert_end"]:
+        if str(alerts_df[column].dt.tz) != "US/Eastern":
+            alerts_df[column] = alerts_df[column].dt.tz_convert("US/Eastern")
+    polling_datetimes = alerts_df["polling_datetime"].unique()
     return (
-        None if len(closures) == 0 else pd.DataFrame.from_dict(closures).values.tolist()
+        _get_polling_date(polling_datetimes.min(), polling_datetimes.max()),
+        polling_datetimes,
     )
 
 
-def lambda_handler(event, context):
-    if os.environ["ENVIRONMENT"] == "devel":
-        load_env_file("devel", "config/{}.yaml")
+def _convert_reduced_to_eastern(reduced_df):
+    import pandas as pd
 
-    logger.info("Starting lambda processing")
-    kms_client = KmsClient()
-    redshift_client = RedshiftClient(
-        kms_client.decrypt(os.environ["REDSHIFT_DB_HOST"]),
-        os.environ["REDSHIFT_DB_NAME"],
-        kms_client.decrypt(os.environ["REDSHIFT_DB_USER"]),
-        kms_client.decrypt(os.environ["REDSHIFT_DB_PASSWORD"]),
-    )
-    kms_client.close()
-
-    hours_table = "location_hours_v2"
-    closures_table = "location_closures_v2"
-    closure_alerts_table = "location_closure_alerts_v2"
-    if os.environ["REDSHIFT_DB_NAME"] != "production":
-        db_suffix = "_{}".format(os.environ["REDSHIFT_DB_NAME"])
-        hours_table += db_suffix
-        closures_table += db_suffix
-        closure_alerts_table += db_suffix
-
-    redshift_client.connect()
-    raw_alerts = redshift_client.execute_query(
-        build_get_alerts_query(hours_table, closure_alerts_table)
+    for column in [
+        "alert_start",
+        "alert_end",
+        "polling_datetime",
+        "first_polling_datetime",
+    ]:
+        reduced_df[column] = pd.to_datetime(reduced_df[column], utc=True).dt.tz_convert(
+            "US/Eastern"
+        )
+    return _get_polling_date(
+        reduced_df["first_polling_datetime"].min(),
+        reduced_df["polling_datetime"].max(),
     )
-    alerts_df = pd.DataFrame(
-        data=raw_alerts,
-        columns=[
-            "location_id",
-            "name",
-            "alert_id",
-            "closed_for",
-            "extended_closing",
-            "alert_start",
-            "alert_end",
-            "polling_datetime",
-            "regular_open",
-            "regular_close",
-        ],
+
+
+def _get_polling_date(first_polling_datetime, last_polling_datetime):
+    # Each polling session should only encompass one day
+    polling_date = first_polling_datetime.date()
+    if polling_date != last_polling_datetime.date():
+        logger.error("Polling occurred over multiple days")
+        raise LocationClosureAggregatorError("Polling occurred over multiple days")
+    return polling_date
+
+
+def _fetch_alerts(redshift_client, hours_table, closure_alerts_table, state_table=None):
+    # With HOURS_INDEX_MODE on, the staged alerts are read with a plain scan and
+    # joined to the location hours (cached in the container) in Python rather
+    # than in Redshift. If a state table is given, only alerts newer than its
+    # watermark are read.
+    if os.environ.get("HOURS_INDEX_MODE", False) == "True":
+        with metrics.stage("LoadHours"):
+            hours_index = get_hours_index(redshift_client, hours_table)
+        with metrics.stage("AlertsQuery"):
+            raw_alerts = redshift_client.execute_query(
+                build_get_staged_alerts_query(closure_alerts_table, state_table)
+            )
+        with metrics.stage("JoinHours"):
+            raw_alerts = join_hours(raw_alerts, hours_index)
+    elif state_table is not None:
+        with metrics.stage("AlertsQuery"):
+            raw_alerts = redshift_client.execute_query(
+                build_get_incremental_alerts_query(
+                    hours_table, closure_alerts_table, state_table
+                )
+            )
+    else:
+        with metrics.stage("AlertsQuery"):
+            raw_alerts = redshift_client.execute_query(
+                build_get_alerts_query(hours_table, closure_alerts_table)
+            )
+    metrics.count("AlertRows", len(raw_alerts))
+    return raw_alerts
+
+
+def _get_run_mode():
+    # Picks how the run fetches and aggregates the staged alerts from the mode
+    # environment variables, which are only read here. Settings that the
+    # picked mode can't honor fail the run rather than being dropped.
+    backfill = os.environ.get("BACKFILL_MODE", False) == "True"
+    streaming = not backfill and bool(os.environ.get("ALERTS_BATCH_SIZE"))
+    pipelined = os.environ.get("PIPELINE_MODE", False) == "True"
+    if os.environ.get("INCREMENTAL_MODE", False) == "True":
+        name = _INCREMENTAL_MODE
+    elif pipelined and streaming:
+        name = _PIPELINED_MODE
+    elif streaming:
+        name = _STREAMING_MODE
+    elif not backfill and os.environ.get("REDUCED_ALERTS_MODE", False) == "True":
+        name = _REDUCED_MODE
+    elif os.environ.get("COLUMNAR_FETCH_MODE", False) == "True":
+        name = _COLUMNAR_MODE
+    else:
+        name = _DEFAULT_MODE
+    idempotent = os.environ.get("IDEMPOTENCY_MODE", False) == "True"
+
+    if pipelined and not streaming and not backfill and name != _INCREMENTAL_MODE:
+        error = "PIPELINE_MODE needs ALERTS_BATCH_SIZE to be set"
+    elif os.environ.get("ALERTS_SNAPSHOT_FORMAT") and name in _UNSNAPSHOTTED_MODES:
+        error = f"Alert snapshots can't be written in {name} mode"
+    elif idempotent and name not in _RETRY_CACHE_MODES:
+        error = f"IDEMPOTENCY_MODE isn't supported in {name} mode"
+    else:
+        return _RunMode(name, backfill, idempotent)
+    logger.error(error)
+    raise LocationClosureAggregatorError(error)
+
+
+def _get_run_closures(
+    redshift_client, run_mode, hours_table, closure_alerts_table, retry_cache=None
+):
+    # Aggregates every alert in the staging table using the given streaming,
+    # reduced, columnar, or default mode. If a retry cache is given, closures
+    # cached for the same alerts by an earlier attempt are reused.
+    if run_mode.name == _STREAMING_MODE:
+        # The alerts are fetched as they are aggregated, so the two are timed
+        # together
+        with metrics.stage("Aggregate"):
+            closures = get_streamed_closures(
+                redshift_client, hours_table, closure_alerts_table
+            )
+    elif run_mode.name == _REDUCED_MODE:
+        import pandas as pd
+
+        with metrics.stage("AlertsQuery"):
+            raw_alerts = redshift_client.execute_query(
+                build_get_reduced_alerts_query(hours_table, closure_alerts_table)
+            )
+        metrics.count("AlertRows", len(raw_alerts))
+        with metrics.stage("BuildDataFrame"):
+            alerts_df = pd.DataFrame(
+                data=raw_alerts, columns=GET_REDUCED_ALERTS_COLUMNS
+            )
+        with metrics.stage("Aggregate"):
+            closures = get_closures(alerts_df)
+    elif run_mode.name == _COLUMNAR_MODE:
+        alerts_df = _fetch_alert_columns(
+            redshift_client, hours_table, closure_alerts_table
+        )
+        if retry_cache is not None and len(alerts_df) > 0:
+            with metrics.stage("Fingerprint"):
+                is_cached = retry_cache.check_alerts(fingerprint_alerts_df(alerts_df))
+            if is_cached:
+                return retry_cache.cached_closures
+        if os.environ.get("ALERTS_SNAPSHOT_FORMAT") and len(alerts_df) > 0:
+            with metrics.stage("Snapshot"):
+                write_alerts_snapshot(alerts_df, closure_alerts_table)
+        with metrics.stage("Aggregate"):
+            if run_mode.backfill:
+                closures = get_closures_by_day(alerts_df)
+            else:
+                closures = get_closures(alerts_df)
+    else:
+        raw_alerts = _fetch_alerts(redshift_client, hours_table, closure_alerts_table)
+        if retry_cache is not None and len(raw_alerts) > 0:
+            with metrics.stage("Fingerprint"):
+                is_cached = retry_cache.check_alerts(fingerprint_rows(raw_alerts))
+            if is_cached:
+                return retry_cache.cached_closures
+        alerts_df = _snapshot_alerts(raw_alerts, closure_alerts_table)
+        fast_path_max_rows = int(
+            os.environ.get("FAST_PATH_MAX_ROWS", _DEFAULT_FAST_PATH_MAX_ROWS)
+        )
+        if not run_mode.backfill and len(raw_alerts) <= fast_path_max_rows:
+            with metrics.stage("Aggregate"):
+                closures = get_closures_from_rows(raw_alerts)
+        else:
+            if alerts_df is None:
+                from closure_engine import build_alerts_df
+
+                with metrics.stage("BuildDataFrame"):
+                    alerts_df = build_alerts_df(raw_alerts)
+            with metrics.stage("Aggregate"):
+                if run_mode.backfill:
+                    closures = get_closures_by_day(alerts_df)
+                else:
+                    closures = get_closures(alerts_df)
+    return closures
+
+
+def _fetch_alert_columns(redshift_client, hours_table, closure_alerts_table):
+    # Fetches the alerts COLUMNAR_FETCH_BATCH_SIZE rows at a time through a
+    # server-side cursor and converts each batch into typed column buffers as it
+    # arrives, so the rows are never all held as Python tuples at once. The
+    # conversion is timed along with the fetching, as the two are interleaved.
+    from closure_engine import AlertColumns
+
+    batch_size = int(
+        os.environ.get("COLUMNAR_FETCH_BATCH_SIZE", _DEFAULT_COLUMNAR_FETCH_BATCH_SIZE)
     )
-    closures = get_closures(alerts_df)
-    queries = []
-    if closures is not None:
-        placeholder = ", ".join(["%s"] * len(closures[0]))
-        insert_query = build_insert_query(closures_table, placeholder)
-        queries.append((insert_query, closures))
-    queries.append(("DELETE FROM {};".format(closure_alerts_table), None))
+    hours_index = None
+    if os.environ.get("HOURS_INDEX_MODE", False) == "True":
+        with metrics.stage("LoadHours"):
+            hours_index = get_hours_index(redshift_client, hours_table)
+        query = build_get_staged_alerts_query(closure_alerts_table)
+    else:
+        query = build_get_alerts_query(hours_table, closure_alerts_table)
+
+    alert_columns = AlertColumns()
+    with metrics.stage("AlertsQuery"):
+        for raw_alerts in _fetch_alert_batches(redshift_client, query, batch_size):
+            if hours_index is not None:
+                raw_alerts = join_hours(raw_alerts, hours_index)
+            alert_columns.append(raw_alerts)
+    metrics.count("AlertRows", alert_columns.row_count)
+    with metrics.stage("BuildDataFrame"):
+        return alert_columns.to_df()
+
+
+def _snapshot_alerts(raw_alerts, closure_alerts_table):
+    # Writes the alerts to a columnar snapshot before they are deleted when
+    # ALERTS_SNAPSHOT_FORMAT is set, and returns the DataFrame built for it
+    if not os.environ.get("ALERTS_SNAPSHOT_FORMAT") or len(raw_alerts) == 0:
+        return None
+
+    from closure_engine import build_alerts_df
+
+    with metrics.stage("BuildDataFrame"):
+        alerts_df = build_alerts_df(raw_alerts)
+    with metrics.stage("Snapshot"):
+        write_alerts_snapshot(alerts_df, closure_alerts_table)
+    return alerts_df
+
+
+def _decrypt_credentials():
+    with metrics.stage("DecryptSecrets"):
+        return decrypt_secrets(
+            [
+                os.environ["REDSHIFT_DB_HOST"],
+                os.environ["REDSHIFT_DB_USER"],
+                os.environ["REDSHIFT_DB_PASSWORD"],
+            ]
+        )
+
+
+def _connect(database=None, credentials=None):
+    # Decrypts the credentials, unless they were already decrypted, and
+    # connects to the database (REDSHIFT_DB_NAME by default). The connection is
+    # kept open for any later invocations in this container.
+    host, user, password = credentials or _decrypt_credentials()
+    with metrics.stage("Connect"):
+        return get_redshift_client(
+            host, database or os.environ["REDSHIFT_DB_NAME"], user, password
+        )
+
+
+def _table_name(table, database=None):
+    # Tables outside of production are suffixed with the database name
+    database = database or os.environ["REDSHIFT_DB_NAME"]
+    if database == "production":
+        return table
+    return "{}_{}".format(table, database)
+
+
+def _process_alerts(database=None, credentials=None):
+    # Aggregates the staged alerts and writes the resulting closures
+    run_mode = _get_run_mode()
+    redshift_client = _connect(database, credentials)
+    hours_table = _table_name("location_hours_v2", database)
+    closures_table = _table_name("location_closures_v2", database)
+    closure_alerts_table = _table_name("location_closure_alerts_v2", database)
+    state_table = _table_name("location_closure_aggregator_state_v2", database)
+
+    if run_mode.name == _INCREMENTAL_MODE:
+        queries = get_incremental_queries(
+            redshift_client,
+            hours_table,
+            closures_table,
+            closure_alerts_table,
+            state_table,
+        )
+    elif run_mode.name == _PIPELINED_MODE:
+        # The closures are written as they are aggregated, in a transaction of
+        # the pipeline's own, so every stage is timed together
+        with metrics.stage("Pipeline"):
+            closure_count = run_closure_pipeline(
+                redshift_client, hours_table, closures_table, closure_alerts_table
+            )
+        metrics.count("Closures", closure_count)
+        return
+    else:
+        retry_cache = None
+        if run_mode.idempotent:
+            retry_cache = RetryCache(closure_alerts_table)
+        closures = _get_run_closures(
+            redshift_client, run_mode, hours_table, closure_alerts_table, retry_cache
+        )
+        if retry_cache is not None and retry_cache.alerts_fingerprint is not None:
+            retry_cache.record(closures)
+        queries = []
+        if closures is not None:
+            metrics.count("Closures", len(closures))
+            with metrics.stage("BuildWriteQueries"):
+                queries.extend(build_closure_write_queries(closures_table, closures))
+        queries.append(("DELETE FROM {};".format(closure_alerts_table), None))
     if os.environ.get("DO_NOT_UPDATE", False) == "True":
         logger.info(f"The following queries were created: {queries}")
-    else:
-        redshift_client.execute_transaction(queries)
-    redshift_client.close_connection()
+    elif len(queries) > 0:
+        with metrics.stage("Write"):
+            redshift_client.execute_transaction(queries)
+
+
+def lambda_handler(event, context):
+    if os.environ["ENVIRONMENT"] == "devel":
+        from nypl_py_utils.functions.config_helper import load_env_file
 
+        load_env_file("devel", "config/{}.yaml")
+
+    logger.info("Starting lambda processing")
+    metrics.start_run(Environment=os.environ["ENVIRONMENT"])
+    databases = event.get("environments") if isinstance(event, dict) else None
+    if databases:
+        # A scheduled event may list several databases to process at once
+        with profile_run():
+            results = _process_environments(databases)
+        metrics.emit()
+        failed = [r["database"] for r in results if r["status"] != "succeeded"]
+        if len(failed) > 0:
+            logger.error(f"Failed to process environments: {failed}")
+            raise LocationClosureAggregatorError(
+                f"Failed to process environments: {failed}"
+            )
+        logger.info("Finished lambda processing")
+        return {
+            "statusCode": 200,
+            "body": json.dumps(
+                {"message": "Job ran successfully.", "environments": results}
+            ),
+        }
+
+    with profile_run():
+        _process_alerts()
+
+    metrics.emit()
     logger.info("Finished lambda processing")
     return {"statusCode": 200, "body": json.dumps({"message": "Job ran successfully."})}
 
 
+def _process_environments(databases):
+    # Processes each database's staged alerts concurrently, each in a thread
+    # with its own connection, transaction, and metrics. The credentials are
+    # decrypted once and shared, and a failure in one database doesn't stop
+    # the others.
+    if len(set(databases)) != len(databases):
+        logger.error(f"Duplicate environments: {databases}")
+        raise LocationClosureAggregatorError(f"Duplicate environments: {databases}")
+    credentials = _decrypt_credentials()
+    runs = [
+        metrics.RunMetrics(
+            {"Environment": os.environ["ENVIRONMENT"], "Database": database}
+        )
+        for database in databases
+    ]
+    max_workers = int(os.environ.get("ENVIRONMENTS_MAX_WORKERS", len(databases)))
+
+    def process_environment(database, run):
+        with metrics.use_run(run):
+            _process_alerts(database, credentials)
+
+    with metrics.stage("Environments"):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(process_environment, database, run)
+                for database, run in zip(databases, runs)
+            ]
+            errors = [future.exception() for future in futures]
+
+    results = []
+    for database, run, error in zip(databases, runs, errors):
+        metrics.emit(run)
+        result = {
+            "database": database,
+            "status": "succeeded" if error is None else "failed",
+            "timings": {stage: round(ms, 3) for stage, ms in run.timings.items()},
+            "counts": run.counts,
+        }
+        if error is not None:
+            result["error"] = getattr(error, "message", None) or str(error)
+            logger.error(f"Error processing {database}: {result['error']}")
+        else:
+            logger.info(f"Finished processing {database}")
+        results.append(result)
+    return results
+
+
+def live_lambda_handler(event, context):
+    # Updates the live closure state with a single poll's alerts and returns
+    # the provisional closures for the day so far. The event's "alerts" are the
+    # rows the LocationClosureAlertPoller writes to the staging table, keyed by
+    # column name, with ISO formatted datetimes (in UTC unless they have an
+    # offset).
+    logger.info("Starting live closure update")
+    metrics.start_run(Environment=os.environ["ENVIRONMENT"])
+    redshift_client = _connect()
+    with metrics.stage("LoadHours"):
+        hours_index = get_hours_index(redshift_client, _table_name("location_hours_v2"))
+    with metrics.stage("JoinHours"):
+        raw_alerts = join_hours(_parse_poll_batch(event["alerts"]), hours_index)
+    metrics.count("AlertRows", len(raw_alerts))
+    with metrics.stage("LiveUpdate"):
+        live_closures = update_live_closures(
+            raw_alerts, _table_name("location_closure_alerts_v2")
+        )
+    with metrics.stage("Aggregate"):
+        closures = live_closures.get_closures() or []
+    metrics.count("Closures", len(closures))
+
+    metrics.emit()
+    logger.info("Finished live closure update")
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "polling_date": (
+                    None
+                    if live_closures.polling_date is None
+                    else live_closures.polling_date.isoformat()
+                ),
+                "closures": [closure._asdict() for closure in closures],
+            }
+        ),
+    }
+
+
+def _parse_poll_batch(alerts):
+    # Converts the poller's alert records to rows of the staged alerts query.
+    # As with a TIMESTAMPTZ in Redshift, datetimes without a UTC offset are
+    # taken to be in UTC.
+    columns = GET_ALERTS_COLUMNS[:8]
+    raw_alerts = []
+    for alert in alerts:
+        row = [alert.get(column) for column in columns]
+        for i in range(5, 8):
+            if isinstance(row[i], str):
+                row[i] = datetime.fromisoformat(row[i])
+                if row[i].tzinfo is None:
+                    row[i] = row[i].replace(tzinfo=_UTC_TIMEZONE)
+        raw_alerts.append(tuple(row))
+    return raw_alerts
+
+
 class LocationClosureAggregatorError(Exception):
     def __init__(self, message=None):
         self.message = message
@@ -0,0 +1,369 @@
+import json
+import os
+
+from datetime import date, datetime, time, timedelta
+from nypl_py_utils.functions.log_helper import create_log
+from pytz import timezone, utc
+from query_helper import GET_ALERTS_COLUMNS
+
+logger = create_log("live_closures")
+
+_DEFAULT_STATE_DIR = "/tmp"
+
+_EASTERN_TIMEZONE = timezone("US/Eastern")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+# What S3 returns when a conditional put finds the object has changed
+_CONFLICT_ERROR_CODES = {"PreconditionFailed", "ConditionalRequestConflict"}
+
+# Lives for as long as Lambda keeps the container warm, so that without an S3
+# bucket each staging table's state is only loaded once per container
+_live_closures = {}
+
+_ALERT_ID = GET_ALERTS_COLUMNS.index("alert_id")
+_LOCATION_ID = GET_ALERTS_COLUMNS.index("location_id")
+_POLLING_DATETIME = GET_ALERTS_COLUMNS.index("polling_datetime")
+_DATETIME_INDEXES = [
+    GET_ALERTS_COLUMNS.index(column)
+    for column in ["alert_start", "alert_end", "polling_datetime"]
+]
+_TIME_INDEXES = [
+    GET_ALERTS_COLUMNS.index(column) for column in ["regular_open", "regular_close"]
+]
+
+
+class AlertState:
+    """
+    What is kept of a single (alert_id, location_id) group between polls: its
+    most recently polled row, the runs of consecutive polls at which it was
+    seen, as [first, last] positions within the day's polls, and the number of
+    polls it was missing from since it was first seen
+    """
+
+    __slots__ = ("row", "runs", "missed_polls")
+
+    def __init__(self, row, runs, missed_polls=0):
+        self.row = row
+        self.runs = runs
+        self.missed_polls = missed_polls
+
+
+class LiveClosures:
+    """
+    Aggregates closures as the poller runs rather than once the day is over.
+    Each poll's batch of alert rows updates the state of every alert group it
+    holds, in time proportional to the size of the batch, and the provisional
+    closures for the day so far can be read off the state at any time. Once
+    every poll of the day has been added, they are identical to the closures
+    get_closures returns for the same rows.
+
+    A batch from a later day starts the state over, and batches must arrive in
+    polling order.
+
+    Attributes
+    ----------
+    etag: str or None
+        The S3 ETag of the saved copy the state was loaded from, or None if
+        it wasn't loaded from S3 or no copy had been saved
+    """
+
+    def __init__(self):
+        self.polling_date = None
+        self.polls = []
+        self.alerts = {}
+        self.etag = None
+
+    def update(self, raw_alerts):
+        """
+        Adds a single poll's alert rows to the state
+
+        Parameters
+        ----------
+        raw_alerts: list<tuple>
+            The rows of the alerts query for a single polling datetime, with
+            tz-aware datetimes. The poll may be split across several batches.
+        """
+        if len(raw_alerts) == 0:
+            return
+        polling_datetime = raw_alerts[0][_POLLING_DATETIME]
+        if any(row[_POLLING_DATETIME] != polling_datetime for row in raw_alerts):
+            logger.error("Poll batch holds more than one polling datetime")
+            raise LiveClosuresError("Poll batch holds more than one polling datetime")
+
+        polling_date = polling_datetime.astimezone(_EASTERN_TIMEZONE).date()
+        if self.polling_date is None or polling_date > self.polling_date:
+            if self.polling_date is not None:
+                logger.info(f"Starting live closures for {polling_date}")
+            self.polling_date = polling_date
+            self.polls = []
+            self.alerts = {}
+        poll = _to_ns(polling_datetime)
+        if polling_date < self.polling_date or (
+            len(self.polls) > 0 and poll < self.polls[-1]
+        ):
+            logger.error(f"Poll batch at {polling_datetime} arrived out of order")
+            raise LiveClosuresError(
+                f"Poll batch at {polling_datetime} arrived out of order"
+            )
+        if len(self.polls) == 0 or poll > self.polls[-1]:
+            self.polls.append(poll)
+        position = len(self.polls) - 1
+
+        for row in raw_alerts:
+            key = (row[_ALERT_ID], row[_LOCATION_ID])
+            alert = self.alerts.get(key)
+            if alert is None:
+                self.alerts[key] = AlertState(tuple(row), [[position, position]])
+                continue
+            last_run = alert.runs[-1]
+            if last_run[1] == position:
+                # The group was already seen at this poll, and as with
+                # get_closures the first of its rows is kept
+                continue
+            alert.row = tuple(row)
+            if last_run[1] == position - 1:
+                last_run[1] = position
+            else:
+                alert.missed_polls += position - last_run[1] - 1
+                alert.runs.append([position, position])
+
+    def get_closures(self):
+        """
+        Returns the provisional closures for the day so far
+
+        Returns
+        -------
+        list<Closure> or None
+            The closures, in the same order as get_closures returns them, or
+            None if there are none
+        """
+        if len(self.alerts) == 0:
+            return None
+
+        import numpy as np
+        from closure_engine import aggregate_tracked_closures
+        from poll_runs import PollRuns
+
+        keys = sorted(
+            self.alerts,
+            key=lambda key: (
+                key[0] is None,
+                key[0] or "",
+                key[1] is None,
+                key[1] or "",
+            ),
+        )
+        groups, firsts, lasts = [], [], []
+        for group, key in enumerate(keys):
+            for first, last in self.alerts[key].runs:
+                groups.append(group)
+                firsts.append(first)
+                lasts.append(last)
+        polls = np.array(self.polls, dtype=np.int64)
+        closures = aggregate_tracked_closures(
+            [self.alerts[key].row for key in keys],
+            self.polling_date,
+            PollRuns.from_runs(groups, firsts, lasts, polls, len(keys)),
+            polls[[self.alerts[key].runs[0][0] for key in keys]],
+            polls[[self.alerts[key].runs[-1][1] for key in keys]],
+        )
+        return None if len(closures) == 0 else closures
+
+    def to_json(self):
+        """Serializes the state to a JSON string"""
+        return json.dumps(
+            {
+                "polling_date": (
+                    None if self.polling_date is None else self.polling_date.isoformat()
+                ),
+                "polls": self.polls,
+                "alerts": [
+                    [_encode_row(alert.row), alert.runs, alert.missed_polls]
+                    for alert in self.alerts.values()
+                ],
+            }
+        )
+
+    @classmethod
+    def from_json(cls, serialized):
+        """Deserializes state written by to_json"""
+        state = json.loads(serialized)
+        live_closures = cls()
+        if state["polling_date"] is not None:
+            live_closures.polling_date = date.fromisoformat(state["polling_date"])
+        live_closures.polls = state["polls"]
+        for row, runs, missed_polls in state["alerts"]:
+            row = _decode_row(row)
+            live_closures.alerts[(row[_ALERT_ID], row[_LOCATION_ID])] = AlertState(
+                row, runs, missed_polls
+            )
+        return live_closures
+
+
+def update_live_closures(raw_alerts, closure_alerts_table):
+    """
+    Adds a single poll's alert rows to the live closure state for the staging
+    table and saves it. With LIVE_STATE_BUCKET set, the saved state is loaded
+    for every update, as consecutive polls may be handled by different
+    containers, and the update fails rather than overwrite a state another
+    update saved in the meantime. Otherwise the state is saved in this
+    container only, so it is kept in memory after it is first loaded.
+
+    Parameters
+    ----------
+    raw_alerts: list<tuple>
+        The rows of the alerts query for a single polling datetime
+    closure_alerts_table: str
+        The name of the staging table the poller writes the alerts to
+
+    Returns
+    -------
+    LiveClosures
+        The updated state
+    """
+    if os.environ.get("LIVE_STATE_BUCKET"):
+        live_closures = load_live_closures(closure_alerts_table)
+    else:
+        logger.warning(
+            "LIVE_STATE_BUCKET is not set, so the live closure state is only "
+            "saved in this container and starts over in any other container"
+        )
+        live_closures = _live_closures.get(closure_alerts_table)
+        if live_closures is None:
+            live_closures = load_live_closures(closure_alerts_table)
+    try:
+        live_closures.update(raw_alerts)
+        save_live_closures(live_closures, closure_alerts_table)
+    except Exception:
+        # The state in the container may no longer match the saved state, so
+        # it's loaded again by the next update
+        _live_closures.pop(closure_alerts_table, None)
+        raise
+    _live_closures[closure_alerts_table] = live_closures
+    return live_closures
+
+
+def clear_cache():
+    """Forgets every live closure state kept in the container"""
+    _live_closures.clear()
+
+
+def load_live_closures(closure_alerts_table):
+    """
+    Loads the live closure state for the staging table from the
+    LIVE_STATE_BUCKET S3 bucket if it is set, or otherwise from LIVE_STATE_DIR
+    (/tmp by default). A new state is returned if none has been saved.
+    """
+    name = _state_name(closure_alerts_table)
+    bucket = os.environ.get("LIVE_STATE_BUCKET")
+    try:
+        if bucket:
+            import boto3
+
+            s3_client = boto3.client(
+                "s3", region_name=os.environ.get("AWS_REGION", "us-east-1")
+            )
+            try:
+                response = s3_client.get_object(Bucket=bucket, Key=name)
+            except s3_client.exceptions.NoSuchKey:
+                return LiveClosures()
+            finally:
+                s3_client.close()
+            live_closures = LiveClosures.from_json(
+                response["Body"].read().decode("utf-8")
+            )
+            live_closures.etag = response["ETag"]
+            return live_closures
+        else:
+            path = os.path.join(
+                os.environ.get("LIVE_STATE_DIR", _DEFAULT_STATE_DIR), name
+            )
+            if not os.path.exists(path):
+                return LiveClosures()
+            with open(path) as f:
+                serialized = f.read()
+        return LiveClosures.from_json(serialized)
+    except Exception as e:
+        logger.error(f"Error loading live closure state: {e}")
+        raise LiveClosuresError(f"Error loading live closure state: {e}") from None
+
+
+def save_live_closures(live_closures, closure_alerts_table):
+    """
+    Saves the live closure state to wherever load_live_closures reads it from.
+    In S3, the state is only saved if the saved copy is still the one it was
+    loaded from (or there still is none).
+    """
+    name = _state_name(closure_alerts_table)
+    bucket = os.environ.get("LIVE_STATE_BUCKET")
+    try:
+        serialized = live_closures.to_json()
+        if bucket:
+            import boto3
+
+            s3_client = boto3.client(
+                "s3", region_name=os.environ.get("AWS_REGION", "us-east-1")
+            )
+            condition = (
+                {"IfNoneMatch": "*"}
+                if live_closures.etag is None
+                else {"IfMatch": live_closures.etag}
+            )
+            try:
+                response = s3_client.put_object(
+                    Bucket=bucket,
+                    Key=name,
+                    Body=serialized.encode("utf-8"),
+                    **condition,
+                )
+            finally:
+                s3_client.close()
+            live_closures.etag = response["ETag"]
+        else:
+            path = os.path.join(
+                os.environ.get("LIVE_STATE_DIR", _DEFAULT_STATE_DIR), name
+            )
+            with open(path, "w") as f:
+                f.write(serialized)
+    except Exception as e:
+        error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        if error_code in _CONFLICT_ERROR_CODES:
+            logger.error("Live closure state was saved by another update")
+            raise LiveClosuresError(
+                "Live closure state was saved by another update"
+            ) from None
+        logger.error(f"Error saving live closure state: {e}")
+        raise LiveClosuresError(f"Error saving live closure state: {e}") from None
+
+
+def _state_name(closure_alerts_table):
+    return "{}-live-closures.json".format(closure_alerts_table)
+
+
+def _to_ns(polling_datetime):
+    """Returns the UTC nanosecond epoch of the tz-aware datetime"""
+    return (polling_datetime - _EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def _encode_row(row):
+    return [
+        value.isoformat() if isinstance(value, (datetime, time)) else value
+        for value in row
+    ]
+
+
+def _decode_row(row):
+    row = list(row)
+    for i in _DATETIME_INDEXES:
+        if row[i] is not None:
+            row[i] = datetime.fromisoformat(row[i])
+    for i in _TIME_INDEXES:
+        if row[i] is not None:
+            row[i] = time.fromisoformat(row[i])
+    return tuple(row)
+
+
+class LiveClosuresError(Exception):
+    def __init__(self, message=None):
+        self.message = message
@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_NAMESPACE = "LocationClosureAggregator"
+
+# The number of stages open in the process while tracemalloc is tracing.
+# tracemalloc keeps a single peak for the whole process, which a stage resets,
+# so only a stage that isn't nested in another can reset and record it.
+_open_stage_count = 0
+_open_stage_lock = threading.Lock()
+
+
+class RunMetrics:
+    """
+    Collects the timing of each stage of an invocation along with counts of
+    what was processed, and formats them as a CloudWatch embedded metric
+    format (EMF) record
+
+    Parameters
+    ----------
+    dimensions: dict, optional
+        The dimensions, e.g. the environment, to publish the metrics under
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dimensions or {}
+        self.timings = {}
+        self.counts = {}
+        self.memory_peaks = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block, adding to any earlier time for the stage.
+        While tracemalloc is tracing (i.e. when profiling), the peak memory
+        traced during the block is recorded as well, but only for a stage that
+        isn't nested in another one and outside of use_run, as the stages of
+        environments processed at once overlap.
+        """
+        global _open_stage_count
+
+        is_tracing = tracemalloc.is_tracing() and _context_run.get() is None
+        if is_tracing:
+            with _open_stage_lock:
+                is_top_level = _open_stage_count == 0
+                _open_stage_count += 1
+                if is_top_level:
+                    tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            if is_tracing:
+                with _open_stage_lock:
+                    _open_stage_count -= 1
+                    if is_top_level:
+                        self.memory_peaks[name] = max(
+                            self.memory_peaks.get(name, 0),
+                            tracemalloc.get_traced_memory()[1],
+                        )
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def to_emf(self, timestamp=None):
+        """
+        Returns the metrics as a single EMF record. Each stage's time is
+        published as <stage>Time in milliseconds and each count as is.
+        """
+        values = {
+            "{}Time".format(stage): round(elapsed, 3)
+            for stage, elapsed in self.timings.items()
+        }
+        units = {name: "Milliseconds" for name in values}
+        values.update(self.counts)
+        units.update({name: "Count" for name in self.counts})
+        record = {
+            "_aws": {
+                "Timestamp": int(
+                    (time.time() if timestamp is None else timestamp) * 1000
+                ),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": _NAMESPACE,
+                        "Dimensions": [sorted(self.dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": units[name]} for name in values
+                        ],
+                    }
+                ],
+            },
+        }
+        record.update(self.dimensions)
+        record.update(values)
+        return record
+
+
+# The metrics of the current invocation. Lambda only runs one invocation at a
+# time per container, so this is replaced at the start of each one.
+_current_run = RunMetrics()
+
+# The metrics a thread collects in place of the invocation's, e.g. for one of
+# several environments processed concurrently. A context variable rather than
+# a thread local, so that asyncio tasks and asyncio.to_thread inherit it.
+_context_run = ContextVar("context_run", default=None)
+
+
+def start_run(**dimensions):
+    """Starts collecting the metrics of a new invocation"""
+    global _current_run
+    _current_run = RunMetrics(dimensions)
+    return _current_run
+
+
+def current_run():
+    return _context_run.get() or _current_run
+
+
+@contextmanager
+def use_run(run):
+    """
+    Collects the metrics of the enclosed block, in the current thread (or
+    asyncio task) only, in the given RunMetrics rather than the invocation's
+    """
+    token = _context_run.set(run)
+    try:
+        yield run
+    finally:
+        _context_run.reset(token)
+
+
+def stage(name):
+    return current_run().stage(name)
+
+
+def count(name, value=1):
+    current_run().count(name, value)
+
+
+def emit(run=None):
+    """
+    Writes the current invocation's metrics, or those of the given run, to
+    stdout as one JSON line, which CloudWatch extracts the metrics from. It is
+    printed directly, as the log formatter's prefix would stop CloudWatch from
+    parsing it.
+    """
+    record = (run or current_run()).to_emf()
+    print(json.dumps(record))
+    return record
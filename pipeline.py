@@ -0,0 +1,202 @@
+import asyncio
+import metrics
+import os
+
+from closure_writer import build_closure_write_queries
+from concurrent.futures import ThreadPoolExecutor
+from nypl_py_utils.functions.log_helper import create_log
+from query_helper import (
+    ALERTS_CURSOR_NAME,
+    build_close_cursor_query,
+    build_declare_cursor_query,
+    build_fetch_cursor_query,
+)
+
+logger = create_log("pipeline")
+
+_DEFAULT_QUEUE_SIZE = 2
+
+
+def write_pipelined_closures(
+    redshift_client,
+    alerts_query,
+    closures_table,
+    closure_alerts_table,
+    polling_date,
+    polling_datetimes,
+):
+    """
+    Aggregates and writes the closures with the fetching of the alerts, their
+    aggregation, and the writing of the closures overlapped rather than run one
+    after another. A producer fetches the alerts ALERTS_BATCH_SIZE rows at a
+    time through a server-side cursor, an aggregator turns each batch's
+    complete alert groups into closures, and a writer inserts each batch of
+    closures as soon as it is ready. They are connected by queues of at most
+    PIPELINE_QUEUE_SIZE batches (2 by default), so a slow stage holds back the
+    ones before it rather than letting batches pile up in memory.
+
+    Every driver call runs in turn on a single thread, as the connection can
+    only be used by one thread at a time, while the aggregation runs on
+    another. The inserts and the deletion of the alerts are committed in a
+    single transaction at the end, and nothing is written if any stage fails.
+
+    Parameters
+    ----------
+    redshift_client: RedshiftClient
+        A connected client
+    alerts_query: str
+        The alerts query, ordered such that each (alert_id, location_id)
+        group's rows are contiguous
+    closures_table: str
+        The name of the table to write the closures to
+    closure_alerts_table: str
+        The name of the staging table, which is emptied once the closures are
+        written
+    polling_date: date
+        The date on which the alerts were polled
+    polling_datetimes: sequence
+        Every distinct datetime at which the poller ran that day
+
+    Returns
+    -------
+    int
+        The number of closures written
+    """
+    return asyncio.run(
+        _run_pipeline(
+            redshift_client,
+            alerts_query,
+            closures_table,
+            closure_alerts_table,
+            polling_date,
+            polling_datetimes,
+        )
+    )
+
+
+async def _run_pipeline(
+    redshift_client,
+    alerts_query,
+    closures_table,
+    closure_alerts_table,
+    polling_date,
+    polling_datetimes,
+):
+    from closure_engine import (
+        aggregate_closures,
+        build_alerts_df,
+        split_complete_groups,
+    )
+
+    loop = asyncio.get_running_loop()
+    batch_size = int(os.environ["ALERTS_BATCH_SIZE"])
+    queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", _DEFAULT_QUEUE_SIZE))
+    do_not_update = os.environ.get("DO_NOT_UPDATE", False) == "True"
+    alert_batches = asyncio.Queue(maxsize=queue_size)
+    closure_batches = asyncio.Queue(maxsize=queue_size)
+    driver = ThreadPoolExecutor(max_workers=1)
+    cursor = redshift_client.conn.cursor()
+
+    def run_on_driver(func, *args):
+        return loop.run_in_executor(driver, func, *args)
+
+    async def execute(query, values=None):
+        await run_on_driver(_execute, cursor, query, values)
+
+    async def fetch_alerts():
+        await execute(build_declare_cursor_query(ALERTS_CURSOR_NAME, alerts_query))
+        fetch_query = build_fetch_cursor_query(ALERTS_CURSOR_NAME, batch_size)
+        while True:
+            raw_alerts = await run_on_driver(_fetch, cursor, fetch_query)
+            if len(raw_alerts) == 0:
+                break
+            metrics.count("AlertRows", len(raw_alerts))
+            await alert_batches.put(raw_alerts)
+        await execute(build_close_cursor_query(ALERTS_CURSOR_NAME))
+        await alert_batches.put(None)
+
+    def aggregate_batch(raw_alerts, pending_df):
+        complete_df, pending_df = split_complete_groups(
+            pending_df, build_alerts_df(raw_alerts)
+        )
+        if len(complete_df) == 0:
+            return [], pending_df
+        return (
+            aggregate_closures(complete_df, polling_date, polling_datetimes),
+            pending_df,
+        )
+
+    async def aggregate_alerts():
+        pending_df = None
+        while (raw_alerts := await alert_batches.get()) is not None:
+            closures, pending_df = await asyncio.to_thread(
+                aggregate_batch, raw_alerts, pending_df
+            )
+            if len(closures) > 0:
+                await closure_batches.put(closures)
+        if pending_df is not None and len(pending_df) > 0:
+            closures = await asyncio.to_thread(
+                aggregate_closures,
+                pending_df.reset_index(drop=True),
+                polling_date,
+                polling_datetimes,
+            )
+            if len(closures) > 0:
+                await closure_batches.put(closures)
+        await closure_batches.put(None)
+
+    async def write_closures():
+        closure_count = 0
+        while (closures := await closure_batches.get()) is not None:
+            closure_count += len(closures)
+            queries = build_closure_write_queries(closures_table, closures)
+            if do_not_update:
+                logger.info(f"The following queries were created: {queries}")
+                continue
+            for query, values in queries:
+                await execute(query, values)
+        return closure_count
+
+    try:
+        await execute("BEGIN TRANSACTION;")
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(fetch_alerts())
+            task_group.create_task(aggregate_alerts())
+            writer = task_group.create_task(write_closures())
+        delete_query = "DELETE FROM {};".format(closure_alerts_table)
+        if do_not_update:
+            logger.info(f"The following queries were created: {[delete_query]}")
+        else:
+            await execute(delete_query)
+        await execute("END TRANSACTION;")
+        await run_on_driver(redshift_client.conn.commit)
+    except Exception as e:
+        # The other stages have stopped by now, but a driver call may still be
+        # running, so the rollback waits for it on the driver thread
+        error = e.exceptions[0] if isinstance(e, ExceptionGroup) else e
+        await run_on_driver(redshift_client.conn.rollback)
+        logger.error(f"Error running closure pipeline: {error}")
+        raise PipelineError(f"Error running closure pipeline: {error}") from None
+    finally:
+        await run_on_driver(cursor.close)
+        driver.shutdown()
+
+    logger.info(f"Wrote {writer.result()} pipelined closures")
+    return writer.result()
+
+
+def _execute(cursor, query, values):
+    if values is None:
+        cursor.execute(query)
+    else:
+        cursor.execute(query, values)
+
+
+def _fetch(cursor, query):
+    cursor.execute(query)
+    return cursor.fetchall()
+
+
+class PipelineError(Exception):
+    def __init__(self, message=None):
+        self.message = message
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class PollRuns:
+    """
+    Compact record of when each alert group was seen, as runs of consecutive
+    positions within the sorted polling datetimes of the day. An alert that
+    stays up all day is a single run however many times it was polled, so
+    each group takes a few integers rather than a datetime per polled row, and
+    a gap (e.g. an alert taken down at noon and reposted at 3pm) splits the
+    group's polls into separate runs.
+
+    The runs are held in parallel arrays sorted by group and then by position,
+    so that every group's runs are contiguous and in time order.
+
+    Parameters
+    ----------
+    group_ids: ndarray<int>
+        The group of each time an alert was seen
+    alert_polls: ndarray<int64>
+        The UTC nanosecond epoch of each time an alert was seen
+    polls: ndarray<int64>
+        The sorted, distinct UTC nanosecond epochs of every poll that day
+    n_groups: int
+        The number of groups
+    """
+
+    __slots__ = ("polls", "n_groups", "groups", "firsts", "lasts")
+
+    def __init__(self, group_ids, alert_polls, polls, n_groups):
+        self.polls = polls
+        self.n_groups = n_groups
+
+        # Each (group, poll) pair is only counted once, even if the alert was
+        # somehow staged more than once for the same poll
+        poll_count = max(len(polls), 1)
+        positions = np.searchsorted(polls, alert_polls)
+        pairs = np.unique(group_ids.astype(np.int64) * poll_count + positions)
+        pair_groups = pairs // poll_count
+        pair_positions = pairs % poll_count
+
+        # A run starts wherever the group changes or a poll was skipped
+        is_run_start = np.ones(len(pairs), dtype=bool)
+        is_run_start[1:] = (pair_groups[1:] != pair_groups[:-1]) | (
+            pair_positions[1:] != pair_positions[:-1] + 1
+        )
+        run_starts = np.flatnonzero(is_run_start)
+        run_ends = np.append(run_starts[1:], len(pairs))[: len(run_starts)] - 1
+        self.groups = pair_groups[run_starts].astype(np.int32)
+        self.firsts = pair_positions[run_starts].astype(np.int32)
+        self.lasts = pair_positions[run_ends].astype(np.int32)
+
+    @classmethod
+    def from_runs(cls, groups, firsts, lasts, polls, n_groups):
+        """
+        Builds the record from runs that were already compacted, e.g. as they
+        were kept up to date poll by poll. The runs must be sorted by group and
+        then by position, with no two runs of a group adjacent or overlapping.
+        """
+        poll_runs = cls.__new__(cls)
+        poll_runs.polls = polls
+        poll_runs.n_groups = n_groups
+        poll_runs.groups = np.asarray(groups, dtype=np.int32)
+        poll_runs.firsts = np.asarray(firsts, dtype=np.int32)
+        poll_runs.lasts = np.asarray(lasts, dtype=np.int32)
+        return poll_runs
+
+    def __len__(self):
+        return len(self.groups)
+
+    def window(self, starts, ends):
+        """
+        Returns the (first, stop) range of positions of the polls strictly
+        between each group's start and end
+        """
+        firsts = np.searchsorted(self.polls, starts, side="right")
+        return firsts, np.maximum(firsts, np.searchsorted(self.polls, ends))
+
+    def count_seen_within(self, firsts, stops):
+        """
+        Counts the positions within each group's (first, stop) range at which
+        the group was seen
+        """
+        overlaps = np.minimum(self.lasts + 1, stops[self.groups]) - np.maximum(
+            self.firsts, firsts[self.groups]
+        )
+        return np.bincount(
+            self.groups, weights=np.maximum(overlaps, 0), minlength=self.n_groups
+        ).astype(np.int64)
+
+    def overlapping(self, firsts, stops):
+        """
+        Returns a mask of the runs that share at least one position with their
+        group's (first, stop) range
+        """
+        return (self.lasts >= firsts[self.groups]) & (self.firsts < stops[self.groups])
@@ -0,0 +1,100 @@
+from bisect import bisect_left, bisect_right
+
+
+class PollingTimeIndex:
+    """
+    Sorted index of the distinct datetimes at which the poller ran, built once
+    per run. Each polling datetime maps to its integer position, so checking
+    whether an alert was seen at every poll within a window is a binary search
+    plus a range count rather than a scan of every polling datetime.
+
+    Parameters
+    ----------
+    polling_datetimes: iterable<datetime>
+        The tz-aware polling datetimes. Duplicates are ignored.
+    """
+
+    def __init__(self, polling_datetimes):
+        self.polling_datetimes = sorted(set(polling_datetimes))
+        self._positions = {
+            polling_datetime: position
+            for position, polling_datetime in enumerate(self.polling_datetimes)
+        }
+
+    def __len__(self):
+        return len(self.polling_datetimes)
+
+    def __getitem__(self, position):
+        return self.polling_datetimes[position]
+
+    def position(self, polling_datetime):
+        """Returns the position of the polling datetime, which must be indexed"""
+        return self._positions[polling_datetime]
+
+    def positions(self, polling_datetimes):
+        """Returns the sorted, distinct positions of the polling datetimes"""
+        return sorted({self._positions[dt] for dt in polling_datetimes})
+
+    def runs(self, polling_datetimes):
+        """
+        Compacts the positions of the polling datetimes into sorted (first,
+        last) runs of consecutive positions, so that an alert seen at every
+        poll is a single run and a gap in its polls starts a new one
+        """
+        runs = []
+        for position in self.positions(polling_datetimes):
+            if len(runs) > 0 and runs[-1][1] == position - 1:
+                runs[-1] = (runs[-1][0], position)
+            else:
+                runs.append((position, position))
+        return runs
+
+    def window(self, start, end):
+        """
+        Returns the (first, stop) range of positions of the polling datetimes
+        strictly between start and end
+        """
+        first = bisect_right(self.polling_datetimes, start)
+        return first, max(first, bisect_left(self.polling_datetimes, end))
+
+    def count_within(self, start, end):
+        """Counts the polling datetimes strictly between start and end"""
+        first, stop = self.window(start, end)
+        return stop - first
+
+    def count_seen_within(self, seen_positions, start, end):
+        """
+        Counts the sorted positions at which an alert was seen that fall
+        strictly between start and end
+        """
+        first, stop = self.window(start, end)
+        return bisect_left(seen_positions, stop) - bisect_left(seen_positions, first)
+
+    def is_seen_throughout(self, seen_positions, start, end):
+        """
+        Returns whether an alert was seen at every poll strictly between start
+        and end, given the sorted positions at which it was seen
+        """
+        return self.count_seen_within(seen_positions, start, end) == (
+            self.count_within(start, end)
+        )
+
+    def is_seen_throughout_runs(self, runs, start, end):
+        """
+        Returns whether an alert was seen at every poll strictly between start
+        and end, given the runs of positions at which it was seen
+        """
+        first, stop = self.window(start, end)
+        seen = sum(
+            max(0, min(last + 1, stop) - max(run_first, first))
+            for run_first, last in runs
+        )
+        return seen == stop - first
+
+    def runs_within(self, runs, start, end):
+        """
+        Returns the runs that include at least one poll strictly between start
+        and end
+        """
+        first, stop = self.window(start, end)
+        return [run for run in runs if run[1] >= first and run[0] < stop]
@@ -0,0 +1,106 @@
+import cProfile
+import io
+import metrics
+import os
+import pstats
+import tracemalloc
+
+from contextlib import contextmanager
+from nypl_py_utils.functions.log_helper import create_log
+
+logger = create_log("profiling")
+
+_DEFAULT_PROFILE_TOP_N = 15
+
+
+@contextmanager
+def profile_run():
+    """
+    Profiles the enclosed block when the PROFILING_MODE environment variable
+    is set to True, and otherwise does nothing. cProfile records where the
+    CPU time goes and tracemalloc records the peak memory allocated, both
+    overall and within each metrics stage, along with the lines that hold the
+    most memory at the end of the block.
+
+    A summary of the top PROFILE_TOP_N functions (15 by default) and
+    allocation sites is logged. If PROFILE_OUTPUT_PATH is set, the full
+    cProfile stats are also written there, to be loaded with pstats.
+    """
+    if os.environ.get("PROFILING_MODE", False) != "True":
+        yield
+        return
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        if not was_tracing:
+            tracemalloc.stop()
+
+        top_n = int(os.environ.get("PROFILE_TOP_N", _DEFAULT_PROFILE_TOP_N))
+        stage_peaks = metrics.current_run().memory_peaks
+        logger.info(
+            format_summary(
+                profiler,
+                snapshot,
+                max([peak_memory] + list(stage_peaks.values())),
+                stage_peaks,
+                top_n,
+            )
+        )
+        output_path = os.environ.get("PROFILE_OUTPUT_PATH")
+        if output_path:
+            profiler.dump_stats(output_path)
+            logger.info(f"Wrote profile to {output_path}")
+
+
+def format_summary(profiler, snapshot, peak_memory, stage_peaks, top_n):
+    """
+    Formats the top functions by cumulative time and the top allocation sites
+    by size as a single log message
+
+    Parameters
+    ----------
+    profiler: cProfile.Profile
+        The stopped profiler
+    snapshot: tracemalloc.Snapshot
+        The allocations that were still held at the end of the profiled block
+    peak_memory: int
+        The peak memory traced during the block, in bytes
+    stage_peaks: dict<str, int>
+        The peak memory traced during each metrics stage, in bytes
+    top_n: int
+        The number of functions and allocation sites to include
+
+    Returns
+    -------
+    str
+        The summary
+    """
+    stats_stream = io.StringIO()
+    pstats.Stats(profiler, stream=stats_stream).strip_dirs().sort_stats(
+        pstats.SortKey.CUMULATIVE
+    ).print_stats(top_n)
+    lines = ["Peak traced memory: {:.1f} KiB".format(peak_memory / 1024)]
+    lines.extend(
+        "  {}: {:.1f} KiB".format(stage, peak / 1024)
+        for stage, peak in stage_peaks.items()
+    )
+    lines.append("Top allocation sites:")
+    lines.extend(
+        "  {}".format(statistic)
+        for statistic in snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        ).statistics("lineno")[:top_n]
+    )
+    lines.append("Top functions by cumulative time:")
+    lines.extend(line for line in stats_stream.getvalue().splitlines() if line.strip())
+    return "\n".join(lines)
@@ -1,3 +1,17 @@
+# The columns returned by the alerts query, in order
+GET_ALERTS_COLUMNS = [
+    "location_id",
+    "name",
+    "alert_id",
+    "closed_for",
+    "extended_closing",
+    "alert_start",
+    "alert_end",
+    "polling_datetime",
+    "regular_open",
+    "regular_close",
+]
+
 _GET_ALERTS_QUERY = """
     WITH current_location_hours AS (
         SELECT location_id, weekday, regular_open, regular_close
@@ -11,20 +25,290 @@ _GET_ALERTS_QUERY = """
     FROM {closure_alerts_table} LEFT JOIN current_location_hours
         ON {closure_alerts_table}.location_id = current_location_hours.location_id
         AND TO_CHAR({closure_alerts_table}.polling_datetime AT TIME ZONE
-            'America/New_York', 'Day') = current_location_hours.weekday;"""
+            'America/New_York', 'Day') = current_location_hours.weekday{where}{order_by};"""
+
+# Sorting by location and then alert keeps the rows of each alert group
+# together, which is needed to aggregate the groups as they are streamed
+_SORTED_ALERTS_ORDER_BY = """
+    ORDER BY {closure_alerts_table}.location_id, alert_id, polling_datetime"""
+
+# The columns returned by the reduced alerts query, in order. There is one row
+# per (alert_id, location_id) group: the most recently polled row, followed by
+# the group's first polling datetime, the number of rows polled, and each of
+# its distinct polling datetimes (in UTC) as a comma separated string.
+GET_REDUCED_ALERTS_COLUMNS = GET_ALERTS_COLUMNS + [
+    "first_polling_datetime",
+    "poll_count",
+    "polling_datetimes",
+]
+
+# The distinct polling datetimes are aggregated with LISTAGG, which is limited
+# to 65535 bytes per group, or a little over 2500 polls
+_GET_REDUCED_ALERTS_QUERY = """
+    WITH current_location_hours AS (
+        SELECT location_id, weekday, regular_open, regular_close
+        FROM {hours_table}
+        WHERE is_current
+    ), ranked_alerts AS (
+        SELECT
+            {closure_alerts_table}.location_id, name, alert_id, closed_for,
+            extended_closing, alert_start, alert_end, polling_datetime,
+            regular_open, regular_close,
+            ROW_NUMBER() OVER (
+                PARTITION BY alert_id, {closure_alerts_table}.location_id
+                ORDER BY polling_datetime DESC) AS poll_rank,
+            MIN(polling_datetime) OVER (
+                PARTITION BY alert_id, {closure_alerts_table}.location_id
+            ) AS first_polling_datetime,
+            COUNT(*) OVER (
+                PARTITION BY alert_id, {closure_alerts_table}.location_id
+            ) AS poll_count,
+            LISTAGG(DISTINCT {utc_polling_datetime}, ',')
+                WITHIN GROUP (ORDER BY {utc_polling_datetime}) OVER (
+                PARTITION BY alert_id, {closure_alerts_table}.location_id
+            ) AS polling_datetimes
+        FROM {closure_alerts_table} LEFT JOIN current_location_hours
+            ON {closure_alerts_table}.location_id = current_location_hours.location_id
+            AND TO_CHAR({closure_alerts_table}.polling_datetime AT TIME ZONE
+                'America/New_York', 'Day') = current_location_hours.weekday
+    )
+    SELECT
+        location_id, name, alert_id, closed_for, extended_closing, alert_start,
+        alert_end, polling_datetime, regular_open, regular_close,
+        first_polling_datetime, poll_count, polling_datetimes
+    FROM ranked_alerts
+    WHERE poll_rank = 1;"""
+
+_UTC_POLLING_DATETIME = (
+    "TO_CHAR(polling_datetime AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS.US')"
+)
+
+# The staged alerts without the location hours, which are joined to them in
+# Python instead when HOURS_INDEX_MODE is on
+_GET_STAGED_ALERTS_QUERY = """
+    SELECT
+        location_id, name, alert_id, closed_for, extended_closing, alert_start,
+        alert_end, polling_datetime
+    FROM {closure_alerts_table}{where};"""
+
+_GET_CURRENT_HOURS_QUERY = """
+    SELECT location_id, weekday, regular_open, regular_close
+    FROM {hours_table}
+    WHERE is_current;"""
+
+# A cheap stand-in for a version of the hours table. New hours are usually
+# added as new rows, with the rows they replace no longer marked as current,
+# which changes one of the counts. The sum of the checksums of the current rows
+# also changes when a current row's hours are updated in place.
+_GET_HOURS_VERSION_QUERY = """
+    SELECT
+        COUNT(*),
+        COUNT(CASE WHEN is_current THEN 1 END),
+        SUM(CASE WHEN is_current THEN CHECKSUM(
+            COALESCE(location_id, '') || '|' || COALESCE(weekday, '') || '|'
+            || COALESCE(CAST(regular_open AS VARCHAR), '') || '|'
+            || COALESCE(CAST(regular_close AS VARCHAR), '')
+        ) END)
+    FROM {hours_table};"""
+
+# Only the alerts polled after the latest polling datetime in the incremental
+# state table, i.e. those that have not yet been aggregated
+_INCREMENTAL_ALERTS_WHERE = """
+    WHERE {closure_alerts_table}.polling_datetime > (
+        SELECT COALESCE(MAX(polling_datetime), '1970-01-01 00:00:00+00'::TIMESTAMPTZ)
+        FROM {state_table})"""
+
+# The columns of the incremental state table, which holds the reduced alerts
+# of the most recent day aggregated in incremental mode
+STATE_COLUMNS = ["polling_date"] + GET_REDUCED_ALERTS_COLUMNS
+
+_GET_STATE_QUERY = "SELECT {columns} FROM {state_table};"
+
+_DELETE_STATE_QUERY = "DELETE FROM {state_table};"
+
+_DELETE_CLOSURES_FOR_DATE_QUERY = (
+    "DELETE FROM {closures_table} WHERE closure_date = %s;"
+)
+
+# Only the polls that were read, as a poll committed after the alerts were read
+# may still have an earlier polling datetime than the latest one read
+_DELETE_CONSUMED_ALERTS_QUERY = (
+    "DELETE FROM {closure_alerts_table} WHERE polling_datetime IN ({values});"
+)
+
+_GET_POLLING_DATETIMES_QUERY = """
+    SELECT DISTINCT polling_datetime FROM {closure_alerts_table};"""
+
+# The server-side cursor that the alerts are fetched through in batches
+ALERTS_CURSOR_NAME = "closure_alerts_cursor"
+
+_DECLARE_CURSOR_QUERY = "DECLARE {cursor_name} CURSOR FOR {query}"
+
+_FETCH_CURSOR_QUERY = "FETCH FORWARD {batch_size} FROM {cursor_name};"
+
+_CLOSE_CURSOR_QUERY = "CLOSE {cursor_name};"
+
+# The columns of the closures table, in the order they are inserted
+CLOSURES_COLUMNS = [
+    "location_id",
+    "name",
+    "alert_id",
+    "closed_for",
+    "is_extended_closure",
+    "closure_date",
+    "closure_start",
+    "closure_end",
+    "is_full_day",
+]
+
+_INSERT_STATE_QUERY = """
+    INSERT INTO {state_table} ({columns})
+    VALUES {values};"""
 
 _INSERT_QUERY = """
     INSERT INTO {closures_table} (
         location_id, name, alert_id, closed_for, is_extended_closure, closure_date,
         closure_start, closure_end, is_full_day
-    ) VALUES ({placeholder});"""
+    ) VALUES {values};"""
+
+_COPY_QUERY = """
+    COPY {closures_table} (
+        location_id, name, alert_id, closed_for, is_extended_closure, closure_date,
+        closure_start, closure_end, is_full_day
+    )
+    FROM '{s3_path}'
+    IAM_ROLE '{iam_role}'
+    FORMAT AS CSV
+    GZIP
+    NULL AS '\\\\N';"""
 
 
 def build_get_alerts_query(hours_table, closure_alerts_table):
     return _GET_ALERTS_QUERY.format(
-        hours_table=hours_table, closure_alerts_table=closure_alerts_table
+        hours_table=hours_table,
+        closure_alerts_table=closure_alerts_table,
+        where="",
+        order_by="",
+    )
+
+
+def build_get_sorted_alerts_query(hours_table, closure_alerts_table):
+    return _GET_ALERTS_QUERY.format(
+        hours_table=hours_table,
+        closure_alerts_table=closure_alerts_table,
+        where="",
+        order_by=_SORTED_ALERTS_ORDER_BY.format(
+            closure_alerts_table=closure_alerts_table
+        ),
+    )
+
+
+def build_get_incremental_alerts_query(hours_table, closure_alerts_table, state_table):
+    return _GET_ALERTS_QUERY.format(
+        hours_table=hours_table,
+        closure_alerts_table=closure_alerts_table,
+        where=_INCREMENTAL_ALERTS_WHERE.format(
+            closure_alerts_table=closure_alerts_table, state_table=state_table
+        ),
+        order_by="",
     )
 
 
+def build_get_staged_alerts_query(closure_alerts_table, state_table=None):
+    # Only the alerts newer than the incremental state's watermark are read
+    # when a state table is given
+    where = ""
+    if state_table is not None:
+        where = _INCREMENTAL_ALERTS_WHERE.format(
+            closure_alerts_table=closure_alerts_table, state_table=state_table
+        )
+    return _GET_STAGED_ALERTS_QUERY.format(
+        closure_alerts_table=closure_alerts_table, where=where
+    )
+
+
+def build_get_current_hours_query(hours_table):
+    return _GET_CURRENT_HOURS_QUERY.format(hours_table=hours_table)
+
+
+def build_get_hours_version_query(hours_table):
+    return _GET_HOURS_VERSION_QUERY.format(hours_table=hours_table)
+
+
+def build_get_state_query(state_table):
+    return _GET_STATE_QUERY.format(
+        columns=", ".join(STATE_COLUMNS), state_table=state_table
+    )
+
+
+def build_delete_state_query(state_table):
+    return _DELETE_STATE_QUERY.format(state_table=state_table)
+
+
+def build_insert_state_query(state_table, row_count):
+    return _INSERT_STATE_QUERY.format(
+        state_table=state_table,
+        columns=", ".join(STATE_COLUMNS),
+        values=_build_values_placeholder(len(STATE_COLUMNS), row_count),
+    )
+
+
+def build_delete_closures_for_date_query(closures_table):
+    return _DELETE_CLOSURES_FOR_DATE_QUERY.format(closures_table=closures_table)
+
+
+def build_delete_consumed_alerts_query(closure_alerts_table, polling_datetime_count):
+    return _DELETE_CONSUMED_ALERTS_QUERY.format(
+        closure_alerts_table=closure_alerts_table,
+        values=", ".join(["%s"] * polling_datetime_count),
+    )
+
+
+def build_get_reduced_alerts_query(hours_table, closure_alerts_table):
+    return _GET_REDUCED_ALERTS_QUERY.format(
+        hours_table=hours_table,
+        closure_alerts_table=closure_alerts_table,
+        utc_polling_datetime=_UTC_POLLING_DATETIME,
+    )
+
+
+def build_get_polling_datetimes_query(closure_alerts_table):
+    return _GET_POLLING_DATETIMES_QUERY.format(
+        closure_alerts_table=closure_alerts_table
+    )
+
+
+def build_declare_cursor_query(cursor_name, query):
+    return _DECLARE_CURSOR_QUERY.format(cursor_name=cursor_name, query=query)
+
+
+def build_fetch_cursor_query(cursor_name, batch_size):
+    return _FETCH_CURSOR_QUERY.format(cursor_name=cursor_name, batch_size=batch_size)
+
+
+def build_close_cursor_query(cursor_name):
+    return _CLOSE_CURSOR_QUERY.format(cursor_name=cursor_name)
+
+
 def build_insert_query(closures_table, placeholder):
-    return _INSERT_QUERY.format(closures_table=closures_table, placeholder=placeholder)
+    return _INSERT_QUERY.format(
+        closures_table=closures_table, values="({})".format(placeholder)
+    )
+
+
+def build_multi_row_insert_query(closures_table, row_count):
+    return _INSERT_QUERY.format(
+        closures_table=closures_table,
+        values=_build_values_placeholder(len(CLOSURES_COLUMNS), row_count),
+    )
+
+
+def build_copy_query(closures_table, s3_path, iam_role):
+    return _COPY_QUERY.format(
+        closures_table=closures_table, s3_path=s3_path, iam_role=iam_role
+    )
+
+
+def _build_values_placeholder(column_count, row_count):
+    row_placeholder = "({})".format(", ".join(["%s"] * column_count))
+    return ",\n        ".join([row_placeholder] * row_count)
@@ -0,0 +1,61 @@
+import lambda_function
+import pytest
+
+from benchmarks.alert_generator import generate_alert_rows, generate_alerts_df
+from query_helper import GET_ALERTS_COLUMNS
+from tests.test_closure_engine import normalize_closures
+
+
+class TestAlertGenerator:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("lambda_function.create_log")
+
+    def test_schema(self):
+        alerts_df = generate_alerts_df(location_count=5)
+
+        assert list(alerts_df.columns) == GET_ALERTS_COLUMNS
+        assert str(alerts_df["polling_datetime"].dt.tz) == "UTC"
+        assert str(alerts_df["alert_start"].dt.tz) == "UTC"
+        assert str(alerts_df["alert_end"].dt.tz) == "UTC"
+
+    def test_poller_rows(self):
+        alerts_df = generate_alerts_df(location_count=5, polling_interval=15)
+        poller_df = alerts_df[
+            alerts_df["location_id"] == "location_closure_alert_poller"
+        ]
+
+        assert len(poller_df) == 60
+        assert poller_df["polling_datetime"].is_unique
+        assert set(alerts_df["polling_datetime"]) == set(poller_df["polling_datetime"])
+
+    def test_shares(self):
+        alerts_df = generate_alerts_df(
+            location_count=20,
+            system_alert_share=1,
+            extended_closure_share=1,
+        )
+        alerts_df = alerts_df[
+            alerts_df["location_id"] != "location_closure_alert_poller"
+        ]
+
+        assert alerts_df["location_id"].isnull().all()
+        assert alerts_df["extended_closing"].all()
+
+        alerts_df = generate_alerts_df(location_count=20, missing_hours_share=1)
+        assert alerts_df["regular_open"].isnull().all()
+        assert alerts_df["regular_close"].isnull().all()
+
+    def test_seed(self):
+        assert generate_alert_rows(location_count=5, seed=1) == generate_alert_rows(
+            location_count=5, seed=1
+        )
+
+    def test_get_closures(self, test_instance):
+        alerts_df = generate_alerts_df(location_count=50, polling_interval=10)
+
+        closures = lambda_function.get_closures(alerts_df.copy())
+        assert len(closures) > 0
+        assert normalize_closures(closures) == normalize_closures(
+            lambda_function.get_closures_reference(alerts_df.copy())
+        )
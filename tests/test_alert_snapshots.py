@@ -0,0 +1,119 @@
+import alert_snapshots
+import os
+import pyarrow as pa
+import pytest
+
+from benchmarks.alert_generator import generate_alert_rows
+from closure_engine import build_alerts_df
+
+
+class TestAlertSnapshots:
+    @pytest.fixture
+    def test_instance(self, mocker, tmp_path):
+        mocker.patch("alert_snapshots.logger")
+        mocker.patch.dict(os.environ, {"ALERTS_SNAPSHOT_DIR": str(tmp_path)})
+        return build_alerts_df(generate_alert_rows(location_count=20))
+
+    @pytest.fixture
+    def mock_s3_client(self, mocker):
+        uploaded_files = {}
+        mock_s3_client = mocker.MagicMock()
+        mock_s3_client.upload_fileobj.side_effect = lambda fileobj, bucket, key: (
+            uploaded_files.update({"s3://{}/{}".format(bucket, key): fileobj.read()})
+        )
+        mocker.patch("boto3.client", return_value=mock_s3_client)
+        mock_s3_client.uploaded_files = uploaded_files
+        return mock_s3_client
+
+    @pytest.mark.parametrize("snapshot_format", ["parquet", "arrow"])
+    @pytest.mark.parametrize("compression", ["zstd", "lz4", "uncompressed"])
+    def test_round_trip(self, test_instance, mocker, snapshot_format, compression):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "ALERTS_SNAPSHOT_FORMAT": snapshot_format,
+                "ALERTS_SNAPSHOT_COMPRESSION": compression,
+            },
+        )
+
+        path = alert_snapshots.write_alerts_snapshot(test_instance, "alerts")
+
+        assert os.path.basename(path).startswith("alerts-")
+        assert path.endswith("." + snapshot_format)
+        assert alert_snapshots.read_alerts_snapshot(path).equals(test_instance)
+
+    def test_compression(self, test_instance, mocker):
+        sizes = {}
+        for compression in ["zstd", "uncompressed"]:
+            mocker.patch.dict(
+                os.environ,
+                {
+                    "ALERTS_SNAPSHOT_FORMAT": "arrow",
+                    "ALERTS_SNAPSHOT_COMPRESSION": compression,
+                },
+            )
+            path = alert_snapshots.write_alerts_snapshot(test_instance, "alerts")
+            sizes[compression] = os.path.getsize(path)
+
+        assert sizes["zstd"] < sizes["uncompressed"] / 4
+
+    def test_read_uncompressed_arrow_without_copying(self, test_instance, mocker):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "ALERTS_SNAPSHOT_FORMAT": "arrow",
+                "ALERTS_SNAPSHOT_COMPRESSION": "uncompressed",
+            },
+        )
+        path = alert_snapshots.write_alerts_snapshot(test_instance, "alerts")
+        allocated_bytes = pa.total_allocated_bytes()
+
+        table = alert_snapshots.read_alerts_table(path)
+
+        assert table.num_rows == len(test_instance)
+        assert pa.total_allocated_bytes() == allocated_bytes
+
+    def test_upload(self, test_instance, mocker, mock_s3_client, tmp_path):
+        mocker.patch.dict(
+            os.environ,
+            {"ALERTS_SNAPSHOT_FORMAT": "parquet", "ALERTS_SNAPSHOT_BUCKET": "bucket"},
+        )
+
+        location = alert_snapshots.write_alerts_snapshot(test_instance, "alerts")
+
+        assert location.startswith("s3://bucket/alerts-")
+        assert list(mock_s3_client.uploaded_files) == [location]
+        assert os.listdir(tmp_path) == []
+        path = tmp_path / "snapshot.parquet"
+        path.write_bytes(mock_s3_client.uploaded_files[location])
+        assert alert_snapshots.read_alerts_snapshot(str(path)).equals(test_instance)
+
+    def test_do_not_update(self, test_instance, mocker, mock_s3_client, tmp_path):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "ALERTS_SNAPSHOT_FORMAT": "parquet",
+                "ALERTS_SNAPSHOT_BUCKET": "bucket",
+                "DO_NOT_UPDATE": "True",
+            },
+        )
+
+        assert alert_snapshots.write_alerts_snapshot(test_instance, "alerts") is None
+        assert mock_s3_client.uploaded_files == {}
+        assert os.listdir(tmp_path) == []
+
+    def test_upload_error(self, test_instance, mocker, mock_s3_client):
+        mocker.patch.dict(
+            os.environ,
+            {"ALERTS_SNAPSHOT_FORMAT": "parquet", "ALERTS_SNAPSHOT_BUCKET": "bucket"},
+        )
+        mock_s3_client.upload_fileobj.side_effect = Exception("Access denied")
+
+        with pytest.raises(alert_snapshots.AlertSnapshotError):
+            alert_snapshots.write_alerts_snapshot(test_instance, "alerts")
+
+    def test_unknown_format(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"ALERTS_SNAPSHOT_FORMAT": "csv"})
+
+        with pytest.raises(alert_snapshots.AlertSnapshotError):
+            alert_snapshots.write_alerts_snapshot(test_instance, "alerts")
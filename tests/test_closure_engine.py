@@ -0,0 +1,465 @@
+import closure_engine
+import lambda_function
+import metrics
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+from benchmarks.alert_generator import generate_alert_rows
+from closure_record import Closure
+from datetime import time
+from query_helper import GET_ALERTS_COLUMNS
+
+_COLUMNS = [
+    "location_id",
+    "name",
+    "alert_id",
+    "closed_for",
+    "extended_closing",
+    "alert_start",
+    "alert_end",
+    "polling_datetime",
+    "regular_open",
+    "regular_close",
+]
+
+_HOURS = [
+    (time(9), time(17)),
+    (time(10, 30), time(18)),
+    (time(1, 30), time(20, 15, 30)),
+    (time(2, 30), time(23, 59, 59)),
+    (None, None),
+]
+
+
+def build_random_alerts(seed, polling_date):
+    rng = np.random.default_rng(seed)
+    polling_datetimes = pd.date_range(
+        start=pd.Timestamp(polling_date + " 00:01:23", tz="US/Eastern"),
+        end=pd.Timestamp(polling_date + " 23:58:00", tz="US/Eastern"),
+        freq="{}min".format(int(rng.integers(20, 90))),
+    )
+    day_start = polling_datetimes[0].normalize()
+    rows = [
+        ("location_closure_alert_poller",) + (None,) * 6 + (poll, None, None)
+        for poll in polling_datetimes
+    ]
+    locations = ["aa", "bb", "cc", None]
+    for alert_id in range(int(rng.integers(1, 12))):
+        location_count = int(rng.integers(1, 3))
+        for location_id in rng.choice(locations, location_count, replace=False):
+            hours = _HOURS[int(rng.integers(len(_HOURS)))]
+            start = day_start + pd.Timedelta(
+                seconds=int(rng.integers(-2 * 86400, 86400)),
+                microseconds=int(rng.choice([0, rng.integers(1, 10**6)])),
+            )
+            end = start + pd.Timedelta(seconds=int(rng.integers(1, 3 * 86400)))
+            first, last = np.sort(rng.integers(0, len(polling_datetimes), 2))
+            seen = [
+                poll
+                for poll in polling_datetimes[first : last + 1]
+                if rng.random() < 0.85
+            ] or [polling_datetimes[first]]
+            for i, poll in enumerate(seen):
+                rows.append(
+                    (
+                        location_id,
+                        None if location_id is None else "Library " + location_id,
+                        str(alert_id),
+                        "closed v{}".format(int(i > len(seen) // 2)),
+                        bool(rng.random() < 0.2),
+                        start,
+                        end,
+                        poll,
+                        hours[0],
+                        hours[1],
+                    )
+                )
+    alerts_df = pd.DataFrame(data=rows, columns=_COLUMNS)
+    return alerts_df.astype(
+        {
+            "extended_closing": "bool",
+            "alert_start": "datetime64[ns, UTC]",
+            "alert_end": "datetime64[ns, UTC]",
+            "polling_datetime": "datetime64[ns, UTC]",
+        }
+    )
+
+
+def normalize_closures(closures):
+    # NaN never equals itself, so missing values are compared as None
+    if closures is None:
+        return None
+    return [[None if pd.isnull(value) else value for value in row] for row in closures]
+
+
+def to_raw_alerts(alerts_df):
+    # Converts the alerts to the types returned by the Redshift client
+    return [
+        tuple(
+            (
+                None
+                if value is None or (not isinstance(value, str) and pd.isnull(value))
+                else value.to_pydatetime() if isinstance(value, pd.Timestamp) else value
+            )
+            for value in row
+        )
+        for row in alerts_df.itertuples(index=False)
+    ]
+
+
+def reduce_alerts(alerts_df):
+    # Reduces the alerts the same way as the reduced alerts query
+    grouped = alerts_df.groupby(["alert_id", "location_id"], dropna=False)
+    reduced_df = alerts_df.loc[grouped["polling_datetime"].idxmax().to_numpy()]
+    reduced_df = reduced_df.reset_index(drop=True)
+    reduced_df["first_polling_datetime"] = grouped["polling_datetime"].min().to_numpy()
+    reduced_df["poll_count"] = grouped.size().to_numpy()
+    reduced_df["polling_datetimes"] = (
+        grouped["polling_datetime"]
+        .agg(
+            lambda polls: ",".join(
+                sorted(
+                    polls.dt.tz_convert("UTC").dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+                    .unique()
+                )
+            )
+        )
+        .to_numpy()
+    )
+
+    # Redshift returns the groups in no particular order
+    return reduced_df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def build_gap_alerts():
+    # Polled hourly, with an alert at a library open from 10am to 6pm that was
+    # taken down after noon and reposted at 3pm
+    polls = pd.date_range(
+        "2023-01-01 08:00", "2023-01-01 20:00", freq="h", tz="US/Eastern"
+    )
+    rows = [
+        ("location_closure_alert_poller",) + (None,) * 6 + (poll, None, None)
+        for poll in polls
+    ]
+    rows.extend(
+        (
+            "aa",
+            "Library aa",
+            "1",
+            "closed",
+            False,
+            pd.Timestamp("2023-01-01 09:00", tz="US/Eastern"),
+            pd.Timestamp("2023-01-01 17:00", tz="US/Eastern"),
+            poll,
+            time(10),
+            time(18),
+        )
+        for poll in polls
+        if poll.hour in [9, 10, 11, 12, 15, 16, 17]
+    )
+    alerts_df = pd.DataFrame(data=rows, columns=_COLUMNS)
+    return alerts_df.astype(
+        {
+            "extended_closing": "bool",
+            "alert_start": "datetime64[ns, UTC]",
+            "alert_end": "datetime64[ns, UTC]",
+            "polling_datetime": "datetime64[ns, UTC]",
+        }
+    )
+
+
+class TestClosureEngine:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("lambda_function.create_log")
+
+    @pytest.mark.parametrize("seed", range(40))
+    @pytest.mark.parametrize("polling_date", ["2023-01-01", "2023-03-12", "2023-11-05"])
+    def test_matches_reference(self, test_instance, seed, polling_date):
+        alerts_df = build_random_alerts(seed, polling_date)
+
+        assert normalize_closures(
+            lambda_function.get_closures(alerts_df.copy())
+        ) == normalize_closures(
+            lambda_function.get_closures_reference(alerts_df.copy())
+        )
+
+    @pytest.mark.parametrize("seed", range(40))
+    @pytest.mark.parametrize("polling_date", ["2023-01-01", "2023-03-12", "2023-11-05"])
+    def test_typed_matches_reference(self, test_instance, seed, polling_date):
+        alerts_df = build_random_alerts(seed, polling_date)
+        typed_df = closure_engine.build_alerts_df(to_raw_alerts(alerts_df))
+
+        assert normalize_closures(
+            lambda_function.get_closures(typed_df)
+        ) == normalize_closures(
+            lambda_function.get_closures_reference(alerts_df.copy())
+        )
+
+    def test_build_alerts_df(self, test_instance):
+        raw_alerts = generate_alert_rows(location_count=20)
+        untyped_df = pd.DataFrame(data=raw_alerts, columns=GET_ALERTS_COLUMNS)
+
+        typed_df = closure_engine.build_alerts_df(raw_alerts)
+
+        assert list(typed_df.columns) == GET_ALERTS_COLUMNS
+        assert len(typed_df) == len(raw_alerts)
+        for column in ["location_id", "name", "alert_id", "closed_for"]:
+            assert isinstance(typed_df[column].dtype, pd.CategoricalDtype)
+        for column in ["alert_start", "alert_end", "polling_datetime"]:
+            assert str(typed_df[column].dt.tz) == "US/Eastern"
+        assert typed_df["regular_open"].dtype == "Int32"
+        assert typed_df["regular_open"].isnull().equals(
+            untyped_df["regular_open"].isnull()
+        )
+        first_open = untyped_df["regular_open"].dropna().iloc[0]
+        assert typed_df["regular_open"].dropna().iloc[0] == (
+            first_open.hour * 3600 + first_open.minute * 60 + first_open.second
+        )
+        assert (
+            typed_df.memory_usage(deep=True).sum()
+            < untyped_df.memory_usage(deep=True).sum() / 2
+        )
+
+    # Each of these seeds generates at least one system-wide closure
+    @pytest.mark.parametrize("seed", range(3))
+    def test_closure_records(self, test_instance, seed):
+        alerts_df = build_random_alerts(seed, "2023-01-01")
+        raw_alerts = to_raw_alerts(alerts_df)
+
+        for closures in [
+            lambda_function.get_closures(alerts_df.copy()),
+            lambda_function.get_closures(closure_engine.build_alerts_df(raw_alerts)),
+            lambda_function.get_closures_from_rows(raw_alerts),
+        ]:
+            assert all(isinstance(closure, Closure) for closure in closures)
+            # Missing values are None rather than NaN
+            assert normalize_closures(closures) == [list(c) for c in closures]
+            assert any(closure.location_id is None for closure in closures)
+
+    def test_build_alerts_df_empty(self, test_instance):
+        typed_df = closure_engine.build_alerts_df([])
+
+        assert list(typed_df.columns) == GET_ALERTS_COLUMNS
+        assert len(typed_df) == 0
+        assert lambda_function.get_closures(typed_df) is None
+
+    @pytest.mark.parametrize("batch_size", [1, 37, 100000])
+    def test_alert_columns(self, test_instance, batch_size):
+        raw_alerts = to_raw_alerts(build_random_alerts(0, "2023-01-01"))
+        alert_columns = closure_engine.AlertColumns()
+        for i in range(0, len(raw_alerts), batch_size):
+            alert_columns.append(raw_alerts[i : i + batch_size])
+
+        typed_df = alert_columns.to_df()
+
+        expected_df = closure_engine.build_alerts_df(raw_alerts)
+        for column in ["alert_start", "alert_end", "polling_datetime"]:
+            expected_df[column] = expected_df[column].dt.as_unit("ns")
+        assert alert_columns.row_count == len(raw_alerts)
+        pd.testing.assert_frame_equal(typed_df, expected_df)
+        assert normalize_closures(
+            lambda_function.get_closures(typed_df)
+        ) == normalize_closures(lambda_function.get_closures(expected_df))
+
+    def test_alert_columns_empty(self, test_instance):
+        alert_columns = closure_engine.AlertColumns()
+        alert_columns.append([])
+
+        typed_df = alert_columns.to_df()
+
+        assert list(typed_df.columns) == GET_ALERTS_COLUMNS
+        assert len(typed_df) == 0
+        assert lambda_function.get_closures(typed_df) is None
+
+    def test_empty_closures(self, test_instance):
+        alerts_df = build_random_alerts(0, "2023-01-01")
+        alerts_df = alerts_df[
+            alerts_df["location_id"] == "location_closure_alert_poller"
+        ]
+
+        assert lambda_function.get_closures(alerts_df.copy()) is None
+        assert lambda_function.get_closures_reference(alerts_df.copy()) is None
+
+    def test_multiple_days(self, test_instance):
+        alerts_df = pd.concat(
+            [
+                build_random_alerts(0, "2023-01-01"),
+                build_random_alerts(0, "2023-01-02"),
+            ],
+            ignore_index=True,
+        )
+
+        with pytest.raises(lambda_function.LocationClosureAggregatorError):
+            lambda_function.get_closures(alerts_df)
+
+    @pytest.mark.parametrize("seed", range(10))
+    @pytest.mark.parametrize("batch_size", [1, 13, 10000])
+    def test_batches_match_reference(self, test_instance, seed, batch_size):
+        alerts_df = build_random_alerts(seed, "2023-11-05")
+        polling_date, polling_datetimes = lambda_function._convert_to_eastern(alerts_df)
+        sorted_df = alerts_df.sort_values(
+            ["location_id", "alert_id", "polling_datetime"], na_position="last"
+        ).reset_index(drop=True)
+        batches = (
+            sorted_df.iloc[i : i + batch_size]
+            for i in range(0, len(sorted_df), batch_size)
+        )
+
+        assert normalize_closures(
+            closure_engine.aggregate_closure_batches(
+                batches, polling_date, polling_datetimes
+            )
+        ) == normalize_closures(
+            lambda_function.get_closures_reference(alerts_df.copy()) or []
+        )
+
+    @pytest.mark.parametrize("seed", range(10))
+    @pytest.mark.parametrize("batch_size", [1, 13, 10000])
+    def test_typed_batches_match_reference(self, test_instance, seed, batch_size):
+        alerts_df = build_random_alerts(seed, "2023-11-05")
+        polling_date, polling_datetimes = lambda_function._convert_to_eastern(
+            alerts_df.copy()
+        )
+        raw_alerts = to_raw_alerts(
+            alerts_df.sort_values(
+                ["location_id", "alert_id", "polling_datetime"], na_position="last"
+            )
+        )
+        batches = (
+            closure_engine.build_alerts_df(raw_alerts[i : i + batch_size])
+            for i in range(0, len(raw_alerts), batch_size)
+        )
+
+        assert normalize_closures(
+            closure_engine.aggregate_closure_batches(
+                batches, polling_date, polling_datetimes
+            )
+        ) == normalize_closures(
+            lambda_function.get_closures_reference(alerts_df.copy()) or []
+        )
+
+    @pytest.mark.parametrize("seed", range(5))
+    @pytest.mark.parametrize("shard_count", [2, 3])
+    def test_sharded_matches_serial(self, test_instance, seed, shard_count):
+        alerts_df = build_random_alerts(seed, "2023-03-12")
+        typed_df = closure_engine.build_alerts_df(to_raw_alerts(alerts_df))
+        polling_date, _ = lambda_function._convert_to_eastern(typed_df)
+
+        serial_run = metrics.start_run()
+        serial_closures = closure_engine.aggregate_closures(typed_df, polling_date)
+        sharded_run = metrics.start_run()
+        sharded_closures = closure_engine.aggregate_sharded_closures(
+            typed_df, polling_date, shard_count
+        )
+
+        assert sharded_closures == serial_closures
+        assert sharded_run.counts == serial_run.counts
+
+    def test_single_span_closure(self, test_instance):
+        alerts_df = build_gap_alerts()
+
+        assert lambda_function.get_closures(alerts_df) == [
+            Closure(
+                "aa",
+                "Library aa",
+                "1",
+                "closed",
+                False,
+                "2023-01-01",
+                "10:00:00",
+                "17:00:00",
+                False,
+            )
+        ]
+
+    def test_split_closures(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"SPLIT_CLOSURES_MODE": "True"})
+        alerts_df = build_gap_alerts()
+        closure = ("aa", "Library aa", "1", "closed", False, "2023-01-01")
+        run_metrics = metrics.start_run()
+
+        for closures in [
+            lambda_function.get_closures(alerts_df.copy()),
+            lambda_function.get_closures_from_rows(to_raw_alerts(alerts_df)),
+            lambda_function.get_closures(reduce_alerts(alerts_df)),
+        ]:
+            assert closures == [
+                Closure(*closure, "10:00:00", "12:00:00", False),
+                Closure(*closure, "15:00:00", "17:00:00", False),
+            ]
+        assert run_metrics.counts["SplitClosures"] == 3
+        assert run_metrics.counts["InferredClosures"] == 3
+
+    @pytest.mark.parametrize("seed", range(40))
+    def test_split_reduced_matches(self, test_instance, mocker, seed):
+        mocker.patch.dict(os.environ, {"SPLIT_CLOSURES_MODE": "True"})
+        alerts_df = build_random_alerts(seed, "2023-11-05")
+
+        assert normalize_closures(
+            lambda_function.get_closures(reduce_alerts(alerts_df))
+        ) == normalize_closures(lambda_function.get_closures(alerts_df.copy()))
+
+    @pytest.mark.parametrize("seed", range(40))
+    @pytest.mark.parametrize("polling_date", ["2023-01-01", "2023-03-12", "2023-11-05"])
+    def test_reduced_matches_reference(self, test_instance, seed, polling_date):
+        alerts_df = build_random_alerts(seed, polling_date)
+        reduced_df = reduce_alerts(alerts_df)
+
+        assert len(reduced_df) == alerts_df.groupby(
+            ["alert_id", "location_id"], dropna=False
+        ).ngroups
+        assert normalize_closures(
+            lambda_function.get_closures(reduced_df)
+        ) == normalize_closures(
+            lambda_function.get_closures_reference(alerts_df.copy())
+        )
+
+    def test_reduced_multiple_days(self, test_instance):
+        alerts_df = pd.concat(
+            [
+                build_random_alerts(0, "2023-01-01"),
+                build_random_alerts(0, "2023-01-02"),
+            ],
+            ignore_index=True,
+        )
+
+        with pytest.raises(lambda_function.LocationClosureAggregatorError):
+            lambda_function.get_closures(reduce_alerts(alerts_df))
+
+    @pytest.mark.parametrize("seed", range(10))
+    def test_reduce_alerts(self, test_instance, seed):
+        alerts_df = build_random_alerts(seed, "2023-11-05")
+        reduced_df = closure_engine.reduce_alerts(alerts_df)
+
+        assert normalize_closures(
+            reduced_df.values.tolist()
+        ) == normalize_closures(
+            reduce_alerts(alerts_df)
+            .sort_values(["alert_id", "location_id"], na_position="last")
+            .values.tolist()
+        )
+
+    @pytest.mark.parametrize("seed", range(10))
+    def test_merge_reduced_alerts(self, test_instance, seed):
+        alerts_df = build_random_alerts(seed, "2023-03-12")
+        cutoff = alerts_df["polling_datetime"].quantile(0.4)
+        earlier_df = closure_engine.reduce_alerts(
+            alerts_df[alerts_df["polling_datetime"] <= cutoff].reset_index(drop=True)
+        )
+        later_df = closure_engine.reduce_alerts(
+            alerts_df[alerts_df["polling_datetime"] > cutoff].reset_index(drop=True)
+        )
+
+        merged_df = closure_engine.merge_reduced_alerts(earlier_df, later_df)
+
+        assert normalize_closures(merged_df.values.tolist()) == normalize_closures(
+            closure_engine.reduce_alerts(alerts_df).values.tolist()
+        )
+        assert normalize_closures(
+            lambda_function.get_closures(merged_df)
+        ) == normalize_closures(
+            lambda_function.get_closures_reference(alerts_df.copy())
+        )
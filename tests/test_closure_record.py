@@ -0,0 +1,47 @@
+import query_helper
+import re
+
+from closure_record import Closure
+from query_helper import CLOSURES_COLUMNS
+
+_CLOSURE = Closure(
+    "aa",
+    "Library A",
+    "1",
+    "Lib A is closed",
+    False,
+    "2023-01-01",
+    "11:00:00",
+    "14:00:00",
+    False,
+)
+
+
+class TestClosureRecord:
+    def test_fields_match_insert_query(self):
+        insert_columns = re.search(
+            r"\(([^)]*)\) VALUES", query_helper._INSERT_QUERY
+        ).group(1)
+
+        assert list(Closure._fields) == CLOSURES_COLUMNS
+        assert list(Closure._fields) == [
+            column.strip() for column in insert_columns.split(",")
+        ]
+
+    def test_slotted(self):
+        assert not hasattr(_CLOSURE, "__dict__")
+
+    def test_fields(self):
+        assert _CLOSURE.location_id == "aa"
+        assert _CLOSURE.closure_start == "11:00:00"
+        assert list(_CLOSURE) == [
+            "aa",
+            "Library A",
+            "1",
+            "Lib A is closed",
+            False,
+            "2023-01-01",
+            "11:00:00",
+            "14:00:00",
+            False,
+        ]
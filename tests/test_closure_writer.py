@@ -0,0 +1,209 @@
+import closure_writer
+import csv
+import gzip
+import lambda_function
+import os
+import pytest
+import re
+import sqlite3
+
+from benchmarks.alert_generator import generate_alerts_df
+from botocore.exceptions import ClientError
+from query_helper import CLOSURES_COLUMNS
+
+
+class LocalDatabase:
+    """
+    Stands in for Redshift by running each query against an in-memory SQLite
+    database. COPY queries load the matching file from the staged files.
+    """
+
+    def __init__(self, staged_files):
+        self.staged_files = staged_files
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(
+            "CREATE TABLE closures ({});".format(", ".join(CLOSURES_COLUMNS))
+        )
+
+    def execute_transaction(self, queries):
+        for query, values in queries:
+            if query.strip().startswith("COPY"):
+                s3_path = re.search(r"FROM '(.+)'", query).group(1)
+                staged_file = gzip.decompress(self.staged_files[s3_path]).decode()
+                rows = [
+                    [self._parse_staged_value(value) for value in row]
+                    for row in csv.reader(staged_file.splitlines())
+                ]
+                self.conn.executemany(
+                    "INSERT INTO closures VALUES ({});".format(
+                        ", ".join(["?"] * len(CLOSURES_COLUMNS))
+                    ),
+                    rows,
+                )
+            else:
+                self.conn.execute(query.replace("%s", "?"), values)
+        self.conn.commit()
+
+    def select_closures(self):
+        return self.conn.execute(
+            "SELECT * FROM closures ORDER BY alert_id, location_id;"
+        ).fetchall()
+
+    def _parse_staged_value(self, value):
+        if value == "\\N":
+            return None
+        return {"true": True, "false": False}.get(value, value)
+
+
+def build_closures(location_count):
+    alerts_df = generate_alerts_df(
+        location_count=location_count, system_alert_share=0.2
+    )
+    return lambda_function.get_closures(alerts_df)
+
+
+class TestClosureWriter:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("lambda_function.create_log")
+        mocker.patch("closure_writer.create_log")
+        mocker.patch.dict(os.environ)
+        for env_var in [
+            "CLOSURES_STAGING_BUCKET",
+            "CLOSURES_COPY_IAM_ROLE",
+            "CLOSURES_COPY_MIN_ROWS",
+            "CLOSURES_INSERT_BATCH_SIZE",
+            "DO_NOT_UPDATE",
+        ]:
+            os.environ.pop(env_var, None)
+
+    @pytest.fixture
+    def mock_s3_client(self, mocker):
+        staged_files = {}
+        mock_s3_client = mocker.MagicMock()
+        mock_s3_client.upload_fileobj.side_effect = lambda fileobj, bucket, key: (
+            staged_files.update({"s3://{}/{}".format(bucket, key): fileobj.read()})
+        )
+        mocker.patch("closure_writer.boto3.client", return_value=mock_s3_client)
+        mock_s3_client.staged_files = staged_files
+        return mock_s3_client
+
+    def test_insert_batches(self, test_instance):
+        closures = [
+            ["loc", "name", str(i), "closed", False] + [None] * 4 for i in range(2500)
+        ]
+
+        queries = closure_writer.build_insert_queries("closures", closures, 1000)
+
+        assert len(queries) == 3
+        assert [len(values) for _, values in queries] == [9000, 9000, 4500]
+        assert queries[0][0].count("(%s, %s, %s, %s, %s, %s, %s, %s, %s)") == 1000
+        assert queries[2][0].count("(%s, %s, %s, %s, %s, %s, %s, %s, %s)") == 500
+
+    def test_insert_batches_parameter_limit(self, test_instance):
+        closures = [
+            ["loc", "name", str(i), "closed", False] + [None] * 4 for i in range(5000)
+        ]
+
+        queries = closure_writer.build_insert_queries("closures", closures, 10000)
+
+        assert [len(values) for _, values in queries] == [32760, 12240]
+
+    def test_insert_mode(self, test_instance, mock_s3_client):
+        closures = build_closures(50)
+
+        queries = closure_writer.build_closure_write_queries("closures", closures)
+
+        assert all(query.strip().startswith("INSERT") for query, _ in queries)
+        mock_s3_client.upload_fileobj.assert_not_called()
+
+    def test_insert_mode_below_copy_threshold(
+        self, test_instance, mock_s3_client, mocker
+    ):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CLOSURES_STAGING_BUCKET": "test-bucket",
+                "CLOSURES_COPY_IAM_ROLE": "test-role",
+                "CLOSURES_COPY_MIN_ROWS": "1000000",
+            },
+        )
+        closures = build_closures(50)
+
+        queries = closure_writer.build_closure_write_queries("closures", closures)
+
+        assert all(query.strip().startswith("INSERT") for query, _ in queries)
+        mock_s3_client.upload_fileobj.assert_not_called()
+
+    def test_copy_mode(self, test_instance, mock_s3_client, mocker):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CLOSURES_STAGING_BUCKET": "test-bucket",
+                "CLOSURES_COPY_IAM_ROLE": "test-role",
+                "CLOSURES_COPY_MIN_ROWS": "10",
+            },
+        )
+        closures = build_closures(50)
+
+        queries = closure_writer.build_closure_write_queries("closures", closures)
+
+        assert len(queries) == 1
+        assert queries[0][0].strip().startswith("COPY closures")
+        assert "s3://test-bucket/closures/" in queries[0][0]
+        assert "IAM_ROLE 'test-role'" in queries[0][0]
+        assert queries[0][1] is None
+        mock_s3_client.upload_fileobj.assert_called_once()
+
+    def test_copy_mode_do_not_update(self, test_instance, mock_s3_client, mocker):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CLOSURES_STAGING_BUCKET": "test-bucket",
+                "CLOSURES_COPY_IAM_ROLE": "test-role",
+                "CLOSURES_COPY_MIN_ROWS": "10",
+                "DO_NOT_UPDATE": "True",
+            },
+        )
+
+        queries = closure_writer.build_closure_write_queries(
+            "closures", build_closures(50)
+        )
+
+        assert queries[0][0].strip().startswith("COPY closures")
+        mock_s3_client.upload_fileobj.assert_not_called()
+
+    def test_modes_write_same_rows(self, test_instance, mock_s3_client, mocker):
+        closures = build_closures(200)
+        assert any(closure[0] is None for closure in closures) or any(
+            closure[0] != closure[0] for closure in closures
+        )
+
+        insert_database = LocalDatabase(mock_s3_client.staged_files)
+        insert_database.execute_transaction(
+            closure_writer.build_insert_queries("closures", closures, 37)
+        )
+
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CLOSURES_STAGING_BUCKET": "test-bucket",
+                "CLOSURES_COPY_IAM_ROLE": "test-role",
+                "CLOSURES_COPY_MIN_ROWS": "1",
+            },
+        )
+        copy_database = LocalDatabase(mock_s3_client.staged_files)
+        copy_database.execute_transaction(
+            closure_writer.build_closure_write_queries("closures", closures)
+        )
+
+        assert len(insert_database.select_closures()) == len(closures)
+        assert insert_database.select_closures() == copy_database.select_closures()
+
+    def test_stage_closures_error(self, test_instance, mock_s3_client):
+        mock_s3_client.upload_fileobj.side_effect = ClientError(
+            {"Error": {"Code": "AccessDenied"}}, "PutObject"
+        )
+
+        with pytest.raises(closure_writer.ClosureWriterError):
+            closure_writer.stage_closures([["loc"] + [None] * 8], "bucket", "key")
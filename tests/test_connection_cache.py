@@ -0,0 +1,157 @@
+import connection_cache
+import os
+import pytest
+
+
+class TestConnectionCache:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("connection_cache.create_log")
+        mocker.patch.dict(os.environ)
+        os.environ.pop("SECRETS_CACHE_TTL", None)
+        connection_cache.clear_cache()
+        yield
+        connection_cache.clear_cache()
+
+    @pytest.fixture
+    def mock_kms_client(self, mocker):
+        mock_kms_client = mocker.MagicMock()
+        mock_kms_client.decrypt.side_effect = lambda secret: "decrypted_" + secret
+        mocker.patch("connection_cache.KmsClient", return_value=mock_kms_client)
+        return mock_kms_client
+
+    @pytest.fixture
+    def mock_redshift_client_class(self, mocker):
+        return mocker.patch(
+            "connection_cache.RedshiftClient",
+            side_effect=lambda *args: mocker.MagicMock(),
+        )
+
+    def test_decrypt_secrets(self, test_instance, mock_kms_client, mocker):
+        assert connection_cache.decrypt_secrets(["host", "user", "password"]) == [
+            "decrypted_host",
+            "decrypted_user",
+            "decrypted_password",
+        ]
+        assert connection_cache.decrypt_secrets(["host", "user", "password"]) == [
+            "decrypted_host",
+            "decrypted_user",
+            "decrypted_password",
+        ]
+
+        mock_kms_client.decrypt.assert_has_calls(
+            [mocker.call("host"), mocker.call("user"), mocker.call("password")]
+        )
+        assert mock_kms_client.decrypt.call_count == 3
+        mock_kms_client.close.assert_called_once()
+
+    def test_decrypt_secrets_partial_cache(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        connection_cache.decrypt_secrets(["host"])
+
+        assert connection_cache.decrypt_secrets(["host", "user"]) == [
+            "decrypted_host",
+            "decrypted_user",
+        ]
+        assert mock_kms_client.decrypt.call_args_list == [
+            mocker.call("host"),
+            mocker.call("user"),
+        ]
+
+    def test_decrypt_secrets_expired(self, test_instance, mock_kms_client, mocker):
+        mocker.patch.dict(os.environ, {"SECRETS_CACHE_TTL": "60"})
+        mock_time = mocker.patch("connection_cache.time.monotonic", return_value=0)
+        connection_cache.decrypt_secrets(["host"])
+        mock_time.return_value = 59
+        connection_cache.decrypt_secrets(["host"])
+        assert mock_kms_client.decrypt.call_count == 1
+
+        mock_time.return_value = 60
+        connection_cache.decrypt_secrets(["host"])
+        assert mock_kms_client.decrypt.call_count == 2
+
+    def test_decrypt_secrets_cache_disabled(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        mocker.patch.dict(os.environ, {"SECRETS_CACHE_TTL": "0"})
+        connection_cache.decrypt_secrets(["host"])
+        connection_cache.decrypt_secrets(["host"])
+
+        assert mock_kms_client.decrypt.call_count == 2
+
+    def test_reuse_connection(self, test_instance, mock_redshift_client_class):
+        first_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "password"
+        )
+        second_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "password"
+        )
+
+        assert first_client is second_client
+        mock_redshift_client_class.assert_called_once_with(
+            "host", "db", "user", "password"
+        )
+        first_client.connect.assert_called_once()
+        first_client.conn.cursor.return_value.execute.assert_called_once_with(
+            "SELECT 1;"
+        )
+        first_client.conn.rollback.assert_called_once()
+
+    def test_reconnect_unhealthy_connection(
+        self, test_instance, mock_redshift_client_class
+    ):
+        first_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "password"
+        )
+        first_client.conn.cursor.return_value.execute.side_effect = Exception(
+            "server closed the connection"
+        )
+        second_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "password"
+        )
+
+        assert first_client is not second_client
+        first_client.close_connection.assert_called_once()
+        second_client.connect.assert_called_once()
+
+    def test_reconnect_closed_connection(
+        self, test_instance, mock_redshift_client_class
+    ):
+        first_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "password"
+        )
+        first_client.conn = None
+
+        assert (
+            connection_cache.get_redshift_client("host", "db", "user", "password")
+            is not first_client
+        )
+
+    def test_reconnect_new_password(self, test_instance, mock_redshift_client_class):
+        first_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "password"
+        )
+        second_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "new_password"
+        )
+
+        assert first_client is not second_client
+        first_client.close_connection.assert_called_once()
+        mock_redshift_client_class.assert_called_with(
+            "host", "db", "user", "new_password"
+        )
+
+    def test_clear_cache(
+        self, test_instance, mock_kms_client, mock_redshift_client_class
+    ):
+        connection_cache.decrypt_secrets(["host"])
+        redshift_client = connection_cache.get_redshift_client(
+            "host", "db", "user", "password"
+        )
+
+        connection_cache.clear_cache()
+
+        redshift_client.close_connection.assert_called_once()
+        connection_cache.decrypt_secrets(["host"])
+        assert mock_kms_client.decrypt.call_count == 2
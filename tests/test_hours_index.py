@@ -0,0 +1,159 @@
+import hours_index
+import os
+import pytest
+
+from benchmarks.alert_generator import generate_alert_rows
+from datetime import datetime, time, timezone
+
+
+def build_hours_rows(raw_alerts, weekday):
+    # Builds the hours table rows matching the hours joined to the alerts, with
+    # the weekday blank-padded as TO_CHAR pads it
+    return sorted(
+        {
+            (row[0], weekday.ljust(9), row[8], row[9])
+            for row in raw_alerts
+            if row[8] is not None
+        }
+    )
+
+
+def build_hours_client(mocker):
+    # Stands in for a Redshift client over a single current row of hours,
+    # counting the times the hours are loaded
+    mock_redshift_client = mocker.MagicMock()
+    mock_redshift_client.version = (1, 1, 100)
+    mock_redshift_client.hours = [("aa", "Monday", time(9), time(17))]
+    mock_redshift_client.load_count = 0
+
+    def execute_query(query):
+        if "COUNT(*)" in query:
+            return [mock_redshift_client.version]
+        mock_redshift_client.load_count += 1
+        return mock_redshift_client.hours
+
+    mock_redshift_client.execute_query.side_effect = execute_query
+    return mock_redshift_client
+
+
+class TestHoursIndex:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("hours_index.create_log")
+        mocker.patch.dict(os.environ)
+        os.environ.pop("HOURS_CACHE_TTL", None)
+        hours_index.clear_cache()
+
+    def test_get_hours_index(self, test_instance, mocker):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = [
+            ("aa", "Monday   ", time(9), time(17)),
+            ("aa", "Sunday   ", time(13), time(17)),
+            ("bb", "Monday", time(10), time(18)),
+            ("cc", None, time(10), time(18)),
+        ]
+
+        assert hours_index.get_hours_index(mock_redshift_client, "hours") == {
+            ("aa", "Monday"): (time(9), time(17)),
+            ("aa", "Sunday"): (time(13), time(17)),
+            ("bb", "Monday"): (time(10), time(18)),
+        }
+        query = mock_redshift_client.execute_query.call_args.args[0]
+        assert "FROM hours" in query
+        assert "WHERE is_current" in query
+
+    def test_get_hours_index_cached(self, test_instance, mocker):
+        mock_monotonic = mocker.patch("hours_index.time.monotonic", return_value=0)
+        mock_redshift_client = build_hours_client(mocker)
+
+        first_index = hours_index.get_hours_index(mock_redshift_client, "hours")
+        mock_monotonic.return_value = 3599
+        assert hours_index.get_hours_index(mock_redshift_client, "hours") is (
+            first_index
+        )
+        assert mock_redshift_client.load_count == 1
+
+        # Each hours table is cached separately
+        hours_index.get_hours_index(mock_redshift_client, "other_hours")
+        assert mock_redshift_client.load_count == 2
+
+        mock_monotonic.return_value = 3600
+        hours_index.get_hours_index(mock_redshift_client, "hours")
+        assert mock_redshift_client.load_count == 3
+
+    def test_get_hours_index_version_changed(self, test_instance, mocker):
+        mock_redshift_client = build_hours_client(mocker)
+        first_index = hours_index.get_hours_index(mock_redshift_client, "hours")
+
+        # New hours were added and the ones they replace are no longer current
+        mock_redshift_client.version = (2, 1, 200)
+        mock_redshift_client.hours = [("aa", "Monday", time(10), time(17))]
+        second_index = hours_index.get_hours_index(mock_redshift_client, "hours")
+
+        assert mock_redshift_client.load_count == 2
+        assert first_index == {("aa", "Monday"): (time(9), time(17))}
+        assert second_index == {("aa", "Monday"): (time(10), time(17))}
+        version_query = mock_redshift_client.execute_query.call_args_list[0].args[0]
+        assert "COUNT(CASE WHEN is_current THEN 1 END)" in version_query
+        assert "SUM(CASE WHEN is_current THEN CHECKSUM(" in version_query
+        assert "FROM hours;" in version_query
+
+    def test_get_hours_index_updated_in_place(self, test_instance, mocker):
+        mock_redshift_client = build_hours_client(mocker)
+        hours_index.get_hours_index(mock_redshift_client, "hours")
+
+        # A current row's hours were updated without adding a row, which only
+        # changes the checksum
+        mock_redshift_client.version = (1, 1, 101)
+        mock_redshift_client.hours = [("aa", "Monday", time(10), time(17))]
+
+        assert hours_index.get_hours_index(mock_redshift_client, "hours") == {
+            ("aa", "Monday"): (time(10), time(17))
+        }
+        assert mock_redshift_client.load_count == 2
+
+    def test_get_hours_index_cache_disabled(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"HOURS_CACHE_TTL": "0"})
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = []
+
+        hours_index.get_hours_index(mock_redshift_client, "hours")
+        hours_index.get_hours_index(mock_redshift_client, "hours")
+
+        assert mock_redshift_client.execute_query.call_count == 2
+
+    def test_join_hours_matches_query(self, test_instance, mocker):
+        raw_alerts = generate_alert_rows(location_count=50, missing_hours_share=0.2)
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = build_hours_rows(
+            raw_alerts, "Sunday"
+        )
+        index = hours_index.get_hours_index(mock_redshift_client, "hours")
+
+        assert (
+            hours_index.join_hours([row[:8] for row in raw_alerts], index) == raw_alerts
+        )
+
+    def test_join_hours_eastern_weekday(self, test_instance):
+        index = {
+            ("aa", "Saturday"): (time(10), time(18)),
+            ("aa", "Sunday"): (time(13), time(17)),
+        }
+        late_poll = datetime(2023, 3, 12, 3, 30, tzinfo=timezone.utc)
+        day_poll = datetime(2023, 3, 12, 15, 30, tzinfo=timezone.utc)
+        alert = ("aa", "Library A", "1", "closed", False, None, None)
+
+        assert hours_index.join_hours(
+            [
+                alert + (late_poll,),
+                alert + (day_poll,),
+                ("bb",) + alert[1:] + (day_poll,),
+                ("location_closure_alert_poller",) + (None,) * 6 + (day_poll,),
+            ],
+            index,
+        ) == [
+            alert + (late_poll, time(10), time(18)),
+            alert + (day_poll, time(13), time(17)),
+            ("bb",) + alert[1:] + (day_poll, None, None),
+            ("location_closure_alert_poller",) + (None,) * 6 + (day_poll, None, None),
+        ]
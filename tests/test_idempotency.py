@@ -0,0 +1,97 @@
+import idempotency
+import metrics
+import pytest
+
+from benchmarks.alert_generator import generate_alert_rows
+from closure_engine import AlertColumns, build_alerts_df
+from closure_record import Closure
+
+_CLOSURES = [
+    Closure(
+        "aa",
+        "Library A",
+        "1",
+        "Closed",
+        False,
+        "2023-01-01",
+        "11:00:00",
+        "14:00:00",
+        False,
+    ),
+    Closure("bb", "Library B", "2", "Closed", False, "2023-01-01", None, None, True),
+]
+
+
+class TestIdempotency:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("idempotency.logger")
+        metrics.start_run()
+        idempotency.clear_cache()
+
+    def test_fingerprint_rows(self, test_instance):
+        raw_alerts = generate_alert_rows(location_count=5)
+        fingerprint = idempotency.fingerprint_rows(raw_alerts)
+
+        assert len(fingerprint) == 64
+        assert idempotency.fingerprint_rows(raw_alerts[::-1]) == fingerprint
+        assert idempotency.fingerprint_rows(raw_alerts[1:]) != fingerprint
+        assert idempotency.fingerprint_rows(_CLOSURES) == (
+            idempotency.fingerprint_rows([tuple(c) for c in _CLOSURES[::-1]])
+        )
+        assert idempotency.fingerprint_rows([]) != idempotency.fingerprint_rows(
+            _CLOSURES
+        )
+
+    def test_fingerprint_alerts_df(self, test_instance):
+        raw_alerts = generate_alert_rows(location_count=5)
+        alert_columns = AlertColumns()
+        alert_columns.append(raw_alerts[::-1])
+        fingerprint = idempotency.fingerprint_alerts_df(build_alerts_df(raw_alerts))
+
+        assert len(fingerprint) == 64
+        assert idempotency.fingerprint_alerts_df(alert_columns.to_df()) == fingerprint
+        assert (
+            idempotency.fingerprint_alerts_df(build_alerts_df(raw_alerts[1:]))
+            != fingerprint
+        )
+
+    def test_check_alerts_not_cached(self, test_instance):
+        retry_cache = idempotency.RetryCache("alerts")
+
+        assert not retry_cache.check_alerts("a" * 64)
+        assert retry_cache.alerts_fingerprint == "a" * 64
+        assert retry_cache.cached_closures is None
+        assert "RetriedAlerts" not in metrics.current_run().counts
+
+    def test_record_and_reuse_closures(self, test_instance):
+        retry_cache = idempotency.RetryCache("alerts")
+        retry_cache.check_alerts("a" * 64)
+        retry_cache.record(_CLOSURES)
+
+        # A retry of the same alerts, e.g. after the write failed, reuses the
+        # closures while other alerts don't
+        retry = idempotency.RetryCache("alerts")
+        assert retry.check_alerts("a" * 64)
+        assert retry.cached_closures == _CLOSURES
+        assert metrics.current_run().counts["RetriedAlerts"] == 1
+        other = idempotency.RetryCache("alerts")
+        assert not other.check_alerts("c" * 64)
+        assert other.cached_closures is None
+
+    def test_record_keeps_other_tables(self, test_instance):
+        retry_cache = idempotency.RetryCache("alerts")
+        retry_cache.check_alerts("a" * 64)
+        retry_cache.record(_CLOSURES)
+        other_cache = idempotency.RetryCache("alerts_qa")
+        other_cache.check_alerts("c" * 64)
+        other_cache.record(_CLOSURES[:1])
+
+        # Each table's closures are kept, and only for its own alerts
+        retry = idempotency.RetryCache("alerts")
+        assert retry.check_alerts("a" * 64)
+        assert retry.cached_closures == _CLOSURES
+        other_retry = idempotency.RetryCache("alerts_qa")
+        assert other_retry.check_alerts("c" * 64)
+        assert other_retry.cached_closures == _CLOSURES[:1]
+        assert not idempotency.RetryCache("alerts_qa").check_alerts("a" * 64)
@@ -1,9 +1,26 @@
+import closure_engine
+import connection_cache
+import hours_index
+import idempotency
 import json
 import lambda_function
+import live_closures
+import metrics
+import os
 import pandas as pd
 import pytest
 
-from datetime import time
+from benchmarks.alert_generator import generate_alert_rows
+from closure_record import Closure
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time, timezone as dt_timezone
+from query_helper import (
+    CLOSURES_COLUMNS,
+    GET_ALERTS_COLUMNS,
+    GET_REDUCED_ALERTS_COLUMNS,
+    STATE_COLUMNS,
+)
+from tests.test_closure_engine import normalize_closures
 
 
 def convert_df_types(input_df):
@@ -17,23 +34,32 @@ def convert_df_types(input_df):
     )
 
 
+def to_closures(closures_df):
+    return [
+        Closure(*(None if pd.isnull(value) else value for value in row))
+        for row in closures_df.values.tolist()
+    ]
+
+
 def get_polling_times(start, end):
     return ["2023-01-01 {:02d}:01:23-05".format(i) for i in range(start, end)]
 
 
-_BASE_CLOSURES = pd.DataFrame(
-    {
-        "location_id": ["aa"],
-        "name": ["Library A"],
-        "alert_id": ["1"],
-        "closed_for": ["Lib A is closed"],
-        "is_extended_closure": [False],
-        "closure_date": ["2023-01-01"],
-        "closure_start": ["11:00:00"],
-        "closure_end": ["14:00:00"],
-        "is_full_day": [False],
-    }
-).values.tolist()
+_BASE_CLOSURES = to_closures(
+    pd.DataFrame(
+        {
+            "location_id": ["aa"],
+            "name": ["Library A"],
+            "alert_id": ["1"],
+            "closed_for": ["Lib A is closed"],
+            "is_extended_closure": [False],
+            "closure_date": ["2023-01-01"],
+            "closure_start": ["11:00:00"],
+            "closure_end": ["14:00:00"],
+            "is_full_day": [False],
+        }
+    )
+)
 
 _BASE_ALERTS_DF = convert_df_types(
     pd.DataFrame(
@@ -53,6 +79,181 @@ _BASE_ALERTS_DF = convert_df_types(
 )
 
 
+_BASE_REDUCED_ALERT_ROW = (
+    "aa",
+    "Library A",
+    "1",
+    "Lib A is closed",
+    False,
+    "2023-01-01 11:00:00-05",
+    "2023-01-01 14:00:00-05",
+    "2023-01-01 15:01:23-05",
+    time(9),
+    time(17),
+    "2023-01-01 10:01:23-05",
+    6,
+    ",".join("2023-01-01 {:02d}:01:23.000000".format(i) for i in range(15, 21)),
+)
+
+
+class LocalCursor:
+    """Stands in for a Redshift cursor over a server-side cursor's rows"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = None
+        self.results = None
+        self.queries = []
+
+    def execute(self, query):
+        self.queries.append(query)
+        if query.startswith("DECLARE"):
+            self.position = 0
+        elif query.startswith("FETCH FORWARD"):
+            batch_size = int(query.split()[2])
+            self.results = self.rows[self.position : self.position + batch_size]
+            self.position += len(self.results)
+
+    def fetchall(self):
+        return self.results
+
+    def close(self):
+        pass
+
+
+class SnapshotConnection:
+    """
+    Stands in for a redshift_connector connection with autocommit off, where
+    the first query of a transaction takes a snapshot of the staged alerts
+    that every later query of the transaction reads
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.snapshot = None
+
+    def cursor(self):
+        return SnapshotCursor(self)
+
+    def rollback(self):
+        self.snapshot = None
+
+    def commit(self):
+        self.snapshot = None
+
+
+class SnapshotCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.results = None
+
+    def execute(self, query):
+        if self.conn.snapshot is None:
+            self.conn.snapshot = list(self.conn.rows)
+        self.results = [(1,)] if query == "SELECT 1;" else self.conn.snapshot
+
+    def fetchall(self):
+        return self.results
+
+    def close(self):
+        pass
+
+
+class LocalIncrementalDatabase:
+    """
+    Stands in for Redshift in incremental mode by applying each query to
+    in-memory alerts, state, and closures tables
+    """
+
+    def __init__(self):
+        self.alerts = []
+        self.state = []
+        self.closures = []
+
+    def execute_query(self, query):
+        if query.startswith("SELECT polling_date"):
+            return [tuple(row) for row in self.state]
+        watermark = max(
+            (row[STATE_COLUMNS.index("polling_datetime")] for row in self.state),
+            default=None,
+        )
+        return [row for row in self.alerts if watermark is None or row[7] > watermark]
+
+    def execute_transaction(self, queries):
+        for query, values in queries:
+            query = query.strip()
+            if query.startswith("DELETE FROM closures WHERE closure_date"):
+                self.closures = [row for row in self.closures if row[5] != values[0]]
+            elif query.startswith("INSERT INTO closures"):
+                self.closures.extend(self._split_rows(values, len(CLOSURES_COLUMNS)))
+            elif query.startswith("DELETE FROM state"):
+                self.state = []
+            elif query.startswith("INSERT INTO state"):
+                self.state.extend(self._split_rows(values, len(STATE_COLUMNS)))
+            elif query.startswith("DELETE FROM alerts WHERE polling_datetime IN"):
+                self.alerts = [row for row in self.alerts if row[7] not in values]
+            else:
+                raise ValueError("Unexpected query: {}".format(query))
+
+    def _split_rows(self, values, column_count):
+        return [
+            values[i : i + column_count] for i in range(0, len(values), column_count)
+        ]
+
+
+class LocalStagingDatabase:
+    """
+    Stands in for Redshift with a staging table of alerts, which are deleted
+    when a write commits, and a closures table. The next write can be made to
+    fail, leaving both tables as they were.
+    """
+
+    def __init__(self, alerts):
+        self.alerts = alerts
+        self.closures = []
+        self.conn = None
+        self.fail_next_write = False
+
+    def connect(self):
+        pass
+
+    def close_connection(self):
+        pass
+
+    def execute_query(self, query):
+        return self.alerts
+
+    def execute_transaction(self, queries):
+        if self.fail_next_write:
+            self.fail_next_write = False
+            raise Exception("Write timed out")
+        for query, values in queries:
+            query = query.strip()
+            if query.startswith("INSERT INTO location_closures"):
+                self.closures.extend(
+                    values[i : i + len(CLOSURES_COLUMNS)]
+                    for i in range(0, len(values), len(CLOSURES_COLUMNS))
+                )
+            elif query.startswith("DELETE FROM location_closure_alerts"):
+                self.alerts = []
+            else:
+                raise ValueError("Unexpected query: {}".format(query))
+
+
+def sort_alert_rows(rows):
+    # Sorts the rows the same way as the sorted alerts query
+    return sorted(
+        rows,
+        key=lambda row: (
+            row[0] is None,
+            row[0] or "",
+            row[2] is None,
+            row[2] or "",
+            row[7],
+        ),
+    )
+
+
 class TestLambdaFunction:
     @pytest.fixture
     def test_instance(self, mocker):
@@ -61,6 +262,10 @@ class TestLambdaFunction:
             "lambda_function.build_get_alerts_query",
             return_value="REDSHIFT ALERTS QUERY",
         )
+        connection_cache.clear_cache()
+        hours_index.clear_cache()
+        idempotency.clear_cache()
+        live_closures.clear_cache()
 
     @pytest.fixture
     def mock_kms_client(self, mocker):
@@ -70,15 +275,17 @@ class TestLambdaFunction:
             "decrypted_user",
             "decrypted_password",
         ]
-        mocker.patch("lambda_function.KmsClient", return_value=mock_kms_client)
+        mocker.patch("connection_cache.KmsClient", return_value=mock_kms_client)
         return mock_kms_client
 
     def test_lambda_handler(self, test_instance, mock_kms_client, mocker):
         mock_redshift_client = mocker.MagicMock()
         mocker.patch(
-            "lambda_function.RedshiftClient", return_value=mock_redshift_client
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch(
+            "lambda_function.get_closures_from_rows", return_value=_BASE_CLOSURES
         )
-        mocker.patch("lambda_function.get_closures", return_value=_BASE_CLOSURES)
 
         assert lambda_function.lambda_handler(None, None) == {
             "statusCode": 200,
@@ -99,30 +306,882 @@ class TestLambdaFunction:
             "REDSHIFT ALERTS QUERY"
         )
         mock_redshift_client.execute_transaction.assert_called_once()
-        mock_redshift_client.close_connection.assert_called_once()
+        mock_redshift_client.close_connection.assert_not_called()
 
         assert len(mock_redshift_client.execute_transaction.call_args.args[0]) == 2
         first_query = mock_redshift_client.execute_transaction.call_args.args[0][0]
         second_query = mock_redshift_client.execute_transaction.call_args.args[0][1]
         assert "INSERT INTO location_closures_v2_test_redshift_db" in first_query[0]
         assert first_query[1] == [
-            [
-                "aa",
-                "Library A",
-                "1",
-                "Lib A is closed",
-                False,
-                "2023-01-01",
-                "11:00:00",
-                "14:00:00",
-                False,
-            ]
+            "aa",
+            "Library A",
+            "1",
+            "Lib A is closed",
+            False,
+            "2023-01-01",
+            "11:00:00",
+            "14:00:00",
+            False,
         ]
         assert second_query[0] == (
             "DELETE FROM location_closure_alerts_v2_test_redshift_db;"
         )
         assert second_query[1] is None
 
+    def test_lambda_handler_warm_container(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client_class = mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch(
+            "lambda_function.get_closures_from_rows", return_value=_BASE_CLOSURES
+        )
+
+        lambda_function.lambda_handler(None, None)
+        lambda_function.lambda_handler(None, None)
+
+        assert mock_kms_client.decrypt.call_count == 3
+        mock_redshift_client_class.assert_called_once_with(
+            "decrypted_host",
+            "test_redshift_db",
+            "decrypted_user",
+            "decrypted_password",
+        )
+        mock_redshift_client.connect.assert_called_once()
+        assert mock_redshift_client.execute_transaction.call_count == 2
+
+    def test_lambda_handler_environments(
+        self, test_instance, mock_kms_client, mocker, capsys
+    ):
+        mock_redshift_clients = {}
+
+        def build_redshift_client(host, database, user, password):
+            mock_redshift_clients[database] = mocker.MagicMock()
+            return mock_redshift_clients[database]
+
+        mocker.patch(
+            "connection_cache.RedshiftClient", side_effect=build_redshift_client
+        )
+        mocker.patch(
+            "lambda_function.get_closures_from_rows", return_value=_BASE_CLOSURES
+        )
+
+        response = lambda_function.lambda_handler(
+            {"environments": ["qa", "production"]}, None
+        )
+
+        # The credentials are only decrypted once for both databases
+        assert mock_kms_client.decrypt.call_count == 3
+        assert sorted(mock_redshift_clients) == ["production", "qa"]
+        for database, suffix in [("qa", "_qa"), ("production", "")]:
+            mock_redshift_client = mock_redshift_clients[database]
+            mock_redshift_client.connect.assert_called_once()
+            mock_redshift_client.execute_transaction.assert_called_once()
+            queries = mock_redshift_client.execute_transaction.call_args.args[0]
+            assert f"INSERT INTO location_closures_v2{suffix} " in queries[0][0]
+            assert queries[1][0] == f"DELETE FROM location_closure_alerts_v2{suffix};"
+
+        body = json.loads(response["body"])
+        assert [result["database"] for result in body["environments"]] == [
+            "qa",
+            "production",
+        ]
+        for result in body["environments"]:
+            assert result["status"] == "succeeded"
+            assert result["counts"] == {"AlertRows": 0, "Closures": 1}
+            assert "Write" in result["timings"]
+        records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert [record.get("Database") for record in records] == [
+            "qa",
+            "production",
+            None,
+        ]
+        assert "DecryptSecretsTime" in records[2]
+        assert "EnvironmentsTime" in records[2]
+        assert "WriteTime" not in records[2]
+
+    def test_lambda_handler_environments_error(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        mock_redshift_clients = {}
+
+        def build_redshift_client(host, database, user, password):
+            mock_redshift_clients[database] = mocker.MagicMock()
+            if database == "qa":
+                mock_redshift_clients[database].execute_transaction.side_effect = (
+                    Exception("connection reset")
+                )
+            return mock_redshift_clients[database]
+
+        mocker.patch(
+            "connection_cache.RedshiftClient", side_effect=build_redshift_client
+        )
+        mocker.patch(
+            "lambda_function.get_closures_from_rows", return_value=_BASE_CLOSURES
+        )
+
+        with pytest.raises(lambda_function.LocationClosureAggregatorError) as e:
+            lambda_function.lambda_handler({"environments": ["qa", "production"]}, None)
+
+        assert e.value.message == "Failed to process environments: ['qa']"
+        mock_redshift_clients["production"].execute_transaction.assert_called_once()
+
+    def test_lambda_handler_duplicate_environments(
+        self, test_instance, mock_kms_client
+    ):
+        with pytest.raises(lambda_function.LocationClosureAggregatorError) as e:
+            lambda_function.lambda_handler({"environments": ["qa", "qa"]}, None)
+
+        assert e.value.message == "Duplicate environments: ['qa', 'qa']"
+        mock_kms_client.decrypt.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "mode_env_vars, expected_mode",
+        [
+            ({}, ("default", False, False)),
+            ({"BACKFILL_MODE": "True"}, ("default", True, False)),
+            ({"ALERTS_BATCH_SIZE": "10"}, ("streaming", False, False)),
+            (
+                {"ALERTS_BATCH_SIZE": "10", "PIPELINE_MODE": "True"},
+                ("pipelined", False, False),
+            ),
+            (
+                {"ALERTS_BATCH_SIZE": "10", "BACKFILL_MODE": "True"},
+                ("default", True, False),
+            ),
+            (
+                {"REDUCED_ALERTS_MODE": "True", "ALERTS_BATCH_SIZE": "10"},
+                ("streaming", False, False),
+            ),
+            ({"REDUCED_ALERTS_MODE": "True"}, ("reduced", False, False)),
+            (
+                {"COLUMNAR_FETCH_MODE": "True", "IDEMPOTENCY_MODE": "True"},
+                ("columnar", False, True),
+            ),
+            (
+                {"INCREMENTAL_MODE": "True", "ALERTS_SNAPSHOT_FORMAT": "parquet"},
+                ("incremental", False, False),
+            ),
+        ],
+    )
+    def test_get_run_mode(self, test_instance, mocker, mode_env_vars, expected_mode):
+        mocker.patch.dict(os.environ, mode_env_vars)
+
+        assert lambda_function._get_run_mode() == expected_mode
+
+    @pytest.mark.parametrize(
+        "mode_env_vars, expected_error",
+        [
+            ({"PIPELINE_MODE": "True"}, "PIPELINE_MODE needs ALERTS_BATCH_SIZE"),
+            (
+                {"ALERTS_BATCH_SIZE": "10", "ALERTS_SNAPSHOT_FORMAT": "parquet"},
+                "Alert snapshots can't be written in streaming mode",
+            ),
+            (
+                {
+                    "ALERTS_BATCH_SIZE": "10",
+                    "PIPELINE_MODE": "True",
+                    "ALERTS_SNAPSHOT_FORMAT": "parquet",
+                },
+                "Alert snapshots can't be written in pipelined mode",
+            ),
+            (
+                {"REDUCED_ALERTS_MODE": "True", "IDEMPOTENCY_MODE": "True"},
+                "IDEMPOTENCY_MODE isn't supported in reduced mode",
+            ),
+            (
+                {"INCREMENTAL_MODE": "True", "IDEMPOTENCY_MODE": "True"},
+                "IDEMPOTENCY_MODE isn't supported in incremental mode",
+            ),
+        ],
+    )
+    def test_lambda_handler_unsupported_mode(
+        self, test_instance, mock_kms_client, mocker, mode_env_vars, expected_error
+    ):
+        mock_redshift_client = mocker.MagicMock()
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, mode_env_vars)
+
+        with pytest.raises(
+            lambda_function.LocationClosureAggregatorError, match=expected_error
+        ):
+            lambda_function.lambda_handler(None, None)
+
+        mock_redshift_client.execute_query.assert_not_called()
+        mock_redshift_client.execute_transaction.assert_not_called()
+
+    def test_lambda_handler_warm_container_reads_new_alerts(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        raw_alerts = generate_alert_rows(location_count=5)
+        conn = SnapshotConnection(raw_alerts[:10])
+        mocker.patch.object(
+            connection_cache.RedshiftClient,
+            "connect",
+            autospec=True,
+            side_effect=lambda redshift_client: setattr(redshift_client, "conn", conn),
+        )
+        mocker.patch.dict(os.environ, {"DO_NOT_UPDATE": "True"})
+        mock_get_closures_from_rows = mocker.patch(
+            "lambda_function.get_closures_from_rows", return_value=_BASE_CLOSURES
+        )
+
+        lambda_function.lambda_handler(None, None)
+        conn.rows.extend(raw_alerts[10:])
+        lambda_function.lambda_handler(None, None)
+
+        # The first run never wrote, so it left its read transaction open, and
+        # the second run still sees the alerts staged since
+        assert mock_get_closures_from_rows.call_args.args[0] == raw_alerts
+
+    def test_lambda_handler_fast_path(self, test_instance, mock_kms_client, mocker):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = generate_alert_rows(
+            location_count=5
+        )
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, {"FAST_PATH_MAX_ROWS": "100000"})
+        mock_get_closures = mocker.patch("lambda_function.get_closures")
+        mock_get_closures_from_rows = mocker.patch(
+            "lambda_function.get_closures_from_rows", return_value=_BASE_CLOSURES
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_get_closures.assert_not_called()
+        mock_get_closures_from_rows.assert_called_once_with(
+            mock_redshift_client.execute_query.return_value
+        )
+
+    def test_lambda_handler_metrics(
+        self, test_instance, mock_kms_client, mocker, capsys
+    ):
+        raw_alerts = generate_alert_rows(location_count=5)
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = raw_alerts
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+        metric_names = [
+            metric["Name"]
+            for metric in record["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+        ]
+        assert record["Environment"] == os.environ["ENVIRONMENT"]
+        assert {
+            "DecryptSecretsTime",
+            "ConnectTime",
+            "AlertsQueryTime",
+            "AggregateTime",
+            "BuildWriteQueriesTime",
+            "WriteTime",
+        }.issubset(metric_names)
+        assert record["AlertRows"] == len(raw_alerts)
+        closure_count = len(lambda_function.get_closures_from_rows(raw_alerts))
+        assert record["Closures"] == closure_count
+        assert (
+            record["SystemClosures"]
+            + record["MissingHoursClosures"]
+            + record["RegularHoursClosures"]
+            == closure_count
+        )
+        assert record["AlertGroups"] == (
+            closure_count
+            + record["DroppedInactive"]
+            + record["DroppedOutsideRegularHours"]
+        )
+
+    def test_lambda_handler_profiling_mode(
+        self, test_instance, mock_kms_client, mocker, tmp_path
+    ):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = generate_alert_rows(
+            location_count=5
+        )
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        output_path = str(tmp_path / "lambda.prof")
+        mocker.patch.dict(
+            os.environ, {"PROFILING_MODE": "True", "PROFILE_OUTPUT_PATH": output_path}
+        )
+        mock_logger = mocker.patch("profiling.logger")
+
+        lambda_function.lambda_handler(None, None)
+
+        summary = mock_logger.info.call_args_list[0].args[0]
+        assert "aggregate_closure_rows" in summary
+        for stage in ["DecryptSecrets", "Connect", "AlertsQuery", "Aggregate", "Write"]:
+            assert f"  {stage}: " in summary
+        assert os.path.exists(output_path)
+
+    def test_lambda_handler_snapshot(
+        self, test_instance, mock_kms_client, mocker, tmp_path
+    ):
+        raw_alerts = generate_alert_rows(location_count=5)
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = raw_alerts
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(
+            os.environ,
+            {
+                "ALERTS_SNAPSHOT_FORMAT": "parquet",
+                "ALERTS_SNAPSHOT_DIR": str(tmp_path),
+            },
+        )
+        mocker.patch("alert_snapshots.create_log")
+
+        lambda_function.lambda_handler(None, None)
+
+        snapshot_paths = [str(path) for path in tmp_path.iterdir()]
+        assert len(snapshot_paths) == 1
+        assert normalize_closures(
+            lambda_function.get_closures_from_snapshots(snapshot_paths)
+        ) == normalize_closures(lambda_function.get_closures_from_rows(raw_alerts))
+
+    def test_lambda_handler_above_fast_path_limit(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        raw_alerts = generate_alert_rows(location_count=5)
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = raw_alerts
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, {"FAST_PATH_MAX_ROWS": str(len(raw_alerts) - 1)})
+        mock_get_closures = mocker.patch(
+            "lambda_function.get_closures", return_value=_BASE_CLOSURES
+        )
+        mock_get_closures_from_rows = mocker.patch(
+            "lambda_function.get_closures_from_rows"
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_get_closures_from_rows.assert_not_called()
+        mock_get_closures.assert_called_once()
+        assert len(mock_get_closures.call_args.args[0]) == len(raw_alerts)
+
+    def test_lambda_handler_reduced_mode(self, test_instance, mock_kms_client, mocker):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = [_BASE_REDUCED_ALERT_ROW]
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch(
+            "lambda_function.build_get_reduced_alerts_query",
+            return_value="REDSHIFT REDUCED ALERTS QUERY",
+        )
+        mocker.patch.dict(os.environ, {"REDUCED_ALERTS_MODE": "True"})
+        mock_get_closures = mocker.patch(
+            "lambda_function.get_closures", return_value=_BASE_CLOSURES
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_redshift_client.execute_query.assert_called_once_with(
+            "REDSHIFT REDUCED ALERTS QUERY"
+        )
+        reduced_df = mock_get_closures.call_args.args[0]
+        assert reduced_df.columns.tolist() == GET_REDUCED_ALERTS_COLUMNS
+        assert reduced_df.values.tolist() == [list(_BASE_REDUCED_ALERT_ROW)]
+        first_query = mock_redshift_client.execute_transaction.call_args.args[0][0]
+        assert first_query[1] == list(_BASE_CLOSURES[0])
+
+    def test_lambda_handler_incremental_mode(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        mock_redshift_client = mocker.MagicMock()
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(
+            os.environ, {"INCREMENTAL_MODE": "True", "BACKFILL_MODE": "True"}
+        )
+        mock_get_closures_by_day = mocker.patch("lambda_function.get_closures_by_day")
+        mock_get_incremental_queries = mocker.patch(
+            "lambda_function.get_incremental_queries",
+            return_value=[("INCREMENTAL QUERY", None)],
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_get_closures_by_day.assert_not_called()
+        mock_get_incremental_queries.assert_called_once_with(
+            mock_redshift_client,
+            "location_hours_v2_test_redshift_db",
+            "location_closures_v2_test_redshift_db",
+            "location_closure_alerts_v2_test_redshift_db",
+            "location_closure_aggregator_state_v2_test_redshift_db",
+        )
+        mock_redshift_client.execute_transaction.assert_called_once_with(
+            [("INCREMENTAL QUERY", None)]
+        )
+
+    def test_lambda_handler_incremental_mode_no_alerts(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = []
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, {"INCREMENTAL_MODE": "True"})
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_redshift_client.execute_query.assert_called_once()
+        mock_redshift_client.execute_transaction.assert_not_called()
+
+    @pytest.mark.parametrize("run_count", [1, 5, 24])
+    def test_incremental_queries(self, test_instance, mocker, run_count):
+        mocker.patch("closure_writer.create_log")
+        raw_alerts = generate_alert_rows(
+            location_count=20, polling_date="2023-03-11", seed=1
+        ) + generate_alert_rows(location_count=20, polling_date="2023-03-12", seed=2)
+        polling_datetimes = sorted({row[7] for row in raw_alerts})
+        database = LocalIncrementalDatabase()
+
+        # Each run picks up the alerts polled since the previous one
+        run_size = -(-len(polling_datetimes) // run_count)
+        for run in range(run_count):
+            run_polls = set(polling_datetimes[run * run_size : (run + 1) * run_size])
+            database.alerts.extend(row for row in raw_alerts if row[7] in run_polls)
+            database.execute_transaction(
+                lambda_function.get_incremental_queries(
+                    database, "hours", "closures", "alerts", "state"
+                )
+            )
+
+        assert database.alerts == []
+        assert {row[0] for row in database.state} == {date(2023, 3, 12)}
+        for polling_date in ["2023-03-11", "2023-03-12"]:
+            day_alerts = [
+                row
+                for row in raw_alerts
+                if row[7].tz_convert("US/Eastern").date().isoformat() == polling_date
+            ]
+            expected_closures = lambda_function.get_closures(
+                pd.DataFrame(day_alerts, columns=GET_ALERTS_COLUMNS)
+            )
+            assert sorted(
+                normalize_closures(
+                    [row for row in database.closures if row[5] == polling_date]
+                ),
+                key=str,
+            ) == sorted(normalize_closures(expected_closures), key=str)
+
+    def test_incremental_queries_late_poll(self, test_instance, mocker):
+        mocker.patch("closure_writer.create_log")
+        raw_alerts = generate_alert_rows(location_count=20)
+        polling_datetimes = sorted({row[7] for row in raw_alerts})
+        late_poll = polling_datetimes[len(polling_datetimes) // 2]
+        database = LocalIncrementalDatabase()
+        database.alerts = [row for row in raw_alerts if row[7] != late_poll]
+
+        queries = lambda_function.get_incremental_queries(
+            database, "hours", "closures", "alerts", "state"
+        )
+        # A poll with an earlier polling datetime than the latest one read is
+        # committed after the alerts were read but before they're deleted
+        late_alerts = [row for row in raw_alerts if row[7] == late_poll]
+        database.alerts.extend(late_alerts)
+        database.execute_transaction(queries)
+
+        assert len(late_alerts) > 0
+        assert database.alerts == late_alerts
+
+    def test_incremental_snapshots(self, test_instance, mocker, tmp_path):
+        mocker.patch("closure_writer.create_log")
+        mocker.patch("alert_snapshots.create_log")
+        mocker.patch(
+            "lambda_function.ProcessPoolExecutor",
+            side_effect=OSError("Function not implemented"),
+        )
+        mocker.patch.dict(
+            os.environ,
+            {"ALERTS_SNAPSHOT_FORMAT": "arrow", "ALERTS_SNAPSHOT_DIR": str(tmp_path)},
+        )
+        raw_alerts = generate_alert_rows(
+            location_count=20, polling_date="2023-03-11", seed=1
+        ) + generate_alert_rows(location_count=20, polling_date="2023-03-12", seed=2)
+        polling_datetimes = sorted({row[7] for row in raw_alerts})
+        database = LocalIncrementalDatabase()
+
+        run_size = -(-len(polling_datetimes) // 5)
+        for run in range(5):
+            run_polls = set(polling_datetimes[run * run_size : (run + 1) * run_size])
+            database.alerts.extend(row for row in raw_alerts if row[7] in run_polls)
+            database.execute_transaction(
+                lambda_function.get_incremental_queries(
+                    database, "hours", "closures", "alerts", "state"
+                )
+            )
+
+        snapshot_paths = sorted(str(path) for path in tmp_path.iterdir())
+        assert len(snapshot_paths) == 5
+        assert sorted(
+            normalize_closures(
+                lambda_function.get_closures_from_snapshots(snapshot_paths)
+            ),
+            key=str,
+        ) == sorted(normalize_closures(database.closures), key=str)
+
+    def test_incremental_queries_no_alerts(self, test_instance):
+        database = LocalIncrementalDatabase()
+
+        assert (
+            lambda_function.get_incremental_queries(
+                database, "hours", "closures", "alerts", "state"
+            )
+            == []
+        )
+
+    def test_lambda_handler_hours_index_mode(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        raw_alerts = generate_alert_rows(location_count=10)
+        hours_rows = sorted(
+            {(row[0], "Sunday   ", row[8], row[9]) for row in raw_alerts if row[8]}
+        )
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.side_effect = [
+            [(len(hours_rows), len(hours_rows), 100)],
+            hours_rows,
+            [row[:8] for row in raw_alerts],
+            [(len(hours_rows), len(hours_rows), 100)],
+            [row[:8] for row in raw_alerts],
+        ]
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, {"HOURS_INDEX_MODE": "True"})
+        mock_get_closures_from_rows = mocker.patch(
+            "lambda_function.get_closures_from_rows", return_value=_BASE_CLOSURES
+        )
+
+        lambda_function.lambda_handler(None, None)
+        lambda_function.lambda_handler(None, None)
+
+        # The hours are only loaded by the first invocation, and the second
+        # only checks that they haven't changed
+        queries = [
+            call.args[0] for call in mock_redshift_client.execute_query.call_args_list
+        ]
+        assert "CHECKSUM(" in queries[0] and "CHECKSUM(" in queries[3]
+        assert "FROM location_hours_v2_test_redshift_db" in queries[1]
+        for query in [queries[2], queries[4]]:
+            assert "FROM location_closure_alerts_v2_test_redshift_db;" in query
+            assert "location_hours" not in query
+        assert mock_get_closures_from_rows.call_args.args[0] == raw_alerts
+
+    def test_lambda_handler_hours_index_incremental_mode(
+        self, test_instance, mock_kms_client, mocker
+    ):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.side_effect = [[(0, 0)], [], []]
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(
+            os.environ, {"HOURS_INDEX_MODE": "True", "INCREMENTAL_MODE": "True"}
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        staged_query = mock_redshift_client.execute_query.call_args.args[0]
+        assert "location_hours" not in staged_query
+        assert (
+            "FROM location_closure_aggregator_state_v2_test_redshift_db" in staged_query
+        )
+
+    def test_lambda_handler_backfill_mode(self, test_instance, mock_kms_client, mocker):
+        mock_redshift_client = mocker.MagicMock()
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, {"BACKFILL_MODE": "True"})
+        mock_get_closures = mocker.patch("lambda_function.get_closures")
+        mock_get_closures_by_day = mocker.patch(
+            "lambda_function.get_closures_by_day", return_value=_BASE_CLOSURES
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_get_closures.assert_not_called()
+        mock_get_closures_by_day.assert_called_once()
+        mock_redshift_client.execute_transaction.assert_called_once()
+        first_query = mock_redshift_client.execute_transaction.call_args.args[0][0]
+        assert first_query[1] == list(_BASE_CLOSURES[0])
+
+    def test_lambda_handler_streaming(self, test_instance, mock_kms_client, mocker):
+        mock_redshift_client = mocker.MagicMock()
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, {"ALERTS_BATCH_SIZE": "1000"})
+        mock_get_closures = mocker.patch("lambda_function.get_closures")
+        mock_get_streamed_closures = mocker.patch(
+            "lambda_function.get_streamed_closures", return_value=_BASE_CLOSURES
+        )
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_get_closures.assert_not_called()
+        mock_redshift_client.execute_query.assert_not_called()
+        mock_get_streamed_closures.assert_called_once_with(
+            mock_redshift_client,
+            "location_hours_v2_test_redshift_db",
+            "location_closure_alerts_v2_test_redshift_db",
+        )
+        first_query = mock_redshift_client.execute_transaction.call_args.args[0][0]
+        assert first_query[1] == list(_BASE_CLOSURES[0])
+
+    def test_lambda_handler_pipelined(self, test_instance, mock_kms_client, mocker):
+        mock_redshift_client = mocker.MagicMock()
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(
+            os.environ, {"ALERTS_BATCH_SIZE": "1000", "PIPELINE_MODE": "True"}
+        )
+        mock_get_streamed_closures = mocker.patch(
+            "lambda_function.get_streamed_closures"
+        )
+        mock_run_closure_pipeline = mocker.patch(
+            "lambda_function.run_closure_pipeline", return_value=12
+        )
+        mock_emit = mocker.patch("metrics.emit")
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_get_streamed_closures.assert_not_called()
+        mock_run_closure_pipeline.assert_called_once_with(
+            mock_redshift_client,
+            "location_hours_v2_test_redshift_db",
+            "location_closures_v2_test_redshift_db",
+            "location_closure_alerts_v2_test_redshift_db",
+        )
+        mock_redshift_client.execute_transaction.assert_not_called()
+        run_metrics = metrics.current_run()
+        assert run_metrics.counts["Closures"] == 12
+        assert "Pipeline" in run_metrics.timings
+        mock_emit.assert_called_once()
+
+    @pytest.mark.parametrize("columnar_fetch_mode", ["False", "True"])
+    def test_lambda_handler_idempotency_mode(
+        self, test_instance, mock_kms_client, mocker, columnar_fetch_mode
+    ):
+        raw_alerts = generate_alert_rows(location_count=10, polling_interval=15)
+        database = LocalStagingDatabase(raw_alerts)
+        database.conn = mocker.MagicMock()
+        database.conn.cursor.return_value = LocalCursor(raw_alerts)
+        mocker.patch("connection_cache.RedshiftClient", return_value=database)
+        mocker.patch.dict(
+            os.environ,
+            {
+                "IDEMPOTENCY_MODE": "True",
+                "COLUMNAR_FETCH_MODE": columnar_fetch_mode,
+                "FAST_PATH_MAX_ROWS": "0",
+            },
+        )
+        expected_closures = normalize_closures(
+            lambda_function.get_closures(
+                pd.DataFrame(raw_alerts, columns=GET_ALERTS_COLUMNS)
+            )
+        )
+        spy_get_closures = mocker.spy(lambda_function, "get_closures")
+
+        # The first write fails, so the retry writes the cached closures
+        # without aggregating them again
+        database.fail_next_write = True
+        with pytest.raises(Exception, match="Write timed out"):
+            lambda_function.lambda_handler(None, None)
+        database.conn.cursor.return_value = LocalCursor(database.alerts)
+        lambda_function.lambda_handler(None, None)
+
+        assert spy_get_closures.call_count == 1
+        assert sorted(database.closures, key=str) == sorted(expected_closures, key=str)
+        assert metrics.current_run().counts["RetriedAlerts"] == 1
+
+        # The alerts were deleted along with the closures being inserted, so a
+        # further retry finds nothing to write again
+        database.conn.cursor.return_value = LocalCursor(database.alerts)
+        lambda_function.lambda_handler(None, None)
+
+        assert len(database.closures) == len(expected_closures)
+
+    @pytest.mark.parametrize("hours_index_mode", ["False", "True"])
+    def test_lambda_handler_columnar_fetch(
+        self, test_instance, mock_kms_client, mocker, hours_index_mode
+    ):
+        raw_alerts = generate_alert_rows(location_count=20, polling_interval=15)
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = sorted(
+            {(row[0], "Sunday   ", row[8], row[9]) for row in raw_alerts if row[8]}
+        )
+        mock_cursor = LocalCursor(
+            [row[:8] for row in raw_alerts]
+            if hours_index_mode == "True"
+            else raw_alerts
+        )
+        mock_redshift_client.conn.cursor.return_value = mock_cursor
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(
+            os.environ,
+            {
+                "COLUMNAR_FETCH_MODE": "True",
+                "COLUMNAR_FETCH_BATCH_SIZE": "25",
+                "HOURS_INDEX_MODE": hours_index_mode,
+            },
+        )
+        mock_get_closures_from_rows = mocker.patch(
+            "lambda_function.get_closures_from_rows"
+        )
+        spy_get_closures = mocker.spy(lambda_function, "get_closures")
+
+        lambda_function.lambda_handler(None, None)
+
+        mock_get_closures_from_rows.assert_not_called()
+        alerts_df = pd.DataFrame(raw_alerts, columns=GET_ALERTS_COLUMNS)
+        assert normalize_closures(spy_get_closures.spy_return) == normalize_closures(
+            lambda_function.get_closures(alerts_df)
+        )
+        assert mock_cursor.queries[1] == "FETCH FORWARD 25 FROM closure_alerts_cursor;"
+        assert ("REDSHIFT ALERTS QUERY" in mock_cursor.queries[0]) == (
+            hours_index_mode == "False"
+        )
+        assert metrics.current_run().counts["AlertRows"] == len(raw_alerts)
+        mock_redshift_client.execute_transaction.assert_called_once()
+
+    @pytest.mark.parametrize("naive_datetimes", [False, True])
+    def test_live_lambda_handler(
+        self, test_instance, mock_kms_client, mocker, tmp_path, naive_datetimes
+    ):
+        raw_alerts = generate_alert_rows(location_count=10, polling_interval=15)
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = sorted(
+            {(row[0], "Sunday   ", row[8], row[9]) for row in raw_alerts if row[8]}
+        )
+        mocker.patch(
+            "connection_cache.RedshiftClient", return_value=mock_redshift_client
+        )
+        mocker.patch.dict(os.environ, {"LIVE_STATE_DIR": str(tmp_path)})
+        polling_datetimes = sorted({row[7] for row in raw_alerts})
+
+        def format_datetime(value):
+            # Datetimes without an offset are taken to be in UTC
+            if naive_datetimes:
+                value = value.astimezone(dt_timezone.utc).replace(tzinfo=None)
+            return value.isoformat()
+
+        for polling_datetime in polling_datetimes:
+            event = {
+                "alerts": [
+                    {
+                        column: (format_datetime(value) if i >= 5 else value)
+                        for i, (column, value) in enumerate(
+                            zip(GET_ALERTS_COLUMNS[:8], row)
+                        )
+                        if value is not None
+                    }
+                    for row in raw_alerts
+                    if row[7] == polling_datetime
+                ]
+            }
+            response = lambda_function.live_lambda_handler(event, None)
+
+        # The hours are only loaded once and nothing is written
+        assert [
+            call.args[0].strip().startswith("SELECT location_id, weekday")
+            for call in mock_redshift_client.execute_query.call_args_list
+        ].count(True) == 1
+        mock_redshift_client.execute_transaction.assert_not_called()
+        assert (
+            tmp_path / "location_closure_alerts_v2_test_redshift_db-live-closures.json"
+        ).exists()
+        assert response["statusCode"] == 200
+        body = json.loads(response["body"])
+        expected = lambda_function.get_closures(
+            pd.DataFrame(raw_alerts, columns=GET_ALERTS_COLUMNS)
+        )
+        assert body["closures"] == json.loads(
+            json.dumps([closure._asdict() for closure in expected])
+        )
+        assert metrics.current_run().counts["Closures"] == len(expected)
+
+    @pytest.mark.parametrize("batch_size", [1, 7, 250, 100000])
+    def test_streamed_closures(self, test_instance, mocker, batch_size):
+        raw_alerts = sort_alert_rows(
+            generate_alert_rows(location_count=30, polling_interval=15)
+        )
+        polling_datetimes = sorted({(row[7],) for row in raw_alerts})
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = polling_datetimes
+        mock_cursor = LocalCursor(raw_alerts)
+        mock_redshift_client.conn.cursor.return_value = mock_cursor
+        mocker.patch.dict(os.environ, {"ALERTS_BATCH_SIZE": str(batch_size)})
+
+        closures = lambda_function.get_streamed_closures(
+            mock_redshift_client, "hours_table", "alerts_table"
+        )
+
+        alerts_df = pd.DataFrame(raw_alerts, columns=GET_ALERTS_COLUMNS)
+        assert normalize_closures(closures) == normalize_closures(
+            lambda_function.get_closures(alerts_df)
+        )
+        assert mock_cursor.queries[0].startswith(
+            "DECLARE closure_alerts_cursor CURSOR FOR"
+        )
+        assert "ORDER BY alerts_table.location_id" in mock_cursor.queries[0]
+        assert mock_cursor.queries[1] == (
+            "FETCH FORWARD {} FROM closure_alerts_cursor;".format(batch_size)
+        )
+        assert mock_cursor.queries[-1] == "CLOSE closure_alerts_cursor;"
+        assert len(mock_cursor.queries) == -(-len(raw_alerts) // batch_size) + 3
+        mock_redshift_client.conn.commit.assert_called_once()
+
+    def test_streamed_closures_no_alerts(self, test_instance, mocker):
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = []
+
+        assert (
+            lambda_function.get_streamed_closures(
+                mock_redshift_client, "hours_table", "alerts_table"
+            )
+            is None
+        )
+        mock_redshift_client.conn.cursor.assert_not_called()
+
+    def test_streamed_closures_error(self, test_instance, mocker):
+        raw_alerts = generate_alert_rows(location_count=1)
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = [(raw_alerts[0][7],)]
+        mock_redshift_client.conn.cursor.return_value.execute.side_effect = Exception(
+            "connection reset"
+        )
+        mocker.patch.dict(os.environ, {"ALERTS_BATCH_SIZE": "10"})
+
+        with pytest.raises(lambda_function.LocationClosureAggregatorError):
+            lambda_function.get_streamed_closures(
+                mock_redshift_client, "hours_table", "alerts_table"
+            )
+        mock_redshift_client.conn.rollback.assert_called_once()
+        mock_redshift_client.conn.cursor.return_value.close.assert_called_once()
+
     def test_poller_closures(self, test_instance):
         assert lambda_function.get_closures(_BASE_ALERTS_DF) is None
 
@@ -187,19 +1246,21 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
-            {
-                "location_id": ["bb"],
-                "name": ["Library B"],
-                "alert_id": ["2"],
-                "closed_for": ["Lib B is closed"],
-                "is_extended_closure": [True],
-                "closure_date": ["2023-01-01"],
-                "closure_start": [None],
-                "closure_end": [None],
-                "is_full_day": [True],
-            }
-        ).values.tolist()
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": ["bb"],
+                    "name": ["Library B"],
+                    "alert_id": ["2"],
+                    "closed_for": ["Lib B is closed"],
+                    "is_extended_closure": [True],
+                    "closure_date": ["2023-01-01"],
+                    "closure_start": [None],
+                    "closure_end": [None],
+                    "is_full_day": [True],
+                }
+            )
+        )
 
         assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
 
@@ -227,19 +1288,21 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
-            {
-                "location_id": ["cc", "dd"],
-                "name": ["Library C", "Library D"],
-                "alert_id": ["3", "4"],
-                "closed_for": ["Lib C is closed", "Lib D is closed"],
-                "is_extended_closure": [False, False],
-                "closure_date": ["2023-01-01", "2023-01-01"],
-                "closure_start": ["09:00:00", "15:30:00"],
-                "closure_end": ["12:30:00", "17:00:00"],
-                "is_full_day": [False, False],
-            }
-        ).values.tolist()
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": ["cc", "dd"],
+                    "name": ["Library C", "Library D"],
+                    "alert_id": ["3", "4"],
+                    "closed_for": ["Lib C is closed", "Lib D is closed"],
+                    "is_extended_closure": [False, False],
+                    "closure_date": ["2023-01-01", "2023-01-01"],
+                    "closure_start": ["09:00:00", "15:30:00"],
+                    "closure_end": ["12:30:00", "17:00:00"],
+                    "is_full_day": [False, False],
+                }
+            )
+        )
 
         assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
 
@@ -262,19 +1325,21 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
-            {
-                "location_id": ["ee"],
-                "name": ["Library E"],
-                "alert_id": ["5"],
-                "closed_for": ["Lib E is closed"],
-                "is_extended_closure": [False],
-                "closure_date": ["2023-01-01"],
-                "closure_start": ["09:00:00"],
-                "closure_end": ["17:00:00"],
-                "is_full_day": [True],
-            }
-        ).values.tolist()
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": ["ee"],
+                    "name": ["Library E"],
+                    "alert_id": ["5"],
+                    "closed_for": ["Lib E is closed"],
+                    "is_extended_closure": [False],
+                    "closure_date": ["2023-01-01"],
+                    "closure_start": ["09:00:00"],
+                    "closure_end": ["17:00:00"],
+                    "is_full_day": [True],
+                }
+            )
+        )
 
         assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
 
@@ -318,19 +1383,21 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
-            {
-                "location_id": ["gg"],
-                "name": ["Library G"],
-                "alert_id": ["7"],
-                "closed_for": ["Lib G is closed"],
-                "is_extended_closure": [False],
-                "closure_date": ["2023-01-01"],
-                "closure_start": [None],
-                "closure_end": [None],
-                "is_full_day": [True],
-            }
-        ).values.tolist()
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": ["gg"],
+                    "name": ["Library G"],
+                    "alert_id": ["7"],
+                    "closed_for": ["Lib G is closed"],
+                    "is_extended_closure": [False],
+                    "closure_date": ["2023-01-01"],
+                    "closure_start": [None],
+                    "closure_end": [None],
+                    "is_full_day": [True],
+                }
+            )
+        )
 
         assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
 
@@ -357,19 +1424,21 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
-            {
-                "location_id": ["hh"],
-                "name": ["Library H"],
-                "alert_id": ["8"],
-                "closed_for": ["new closed_for"],
-                "is_extended_closure": [False],
-                "closure_date": ["2023-01-01"],
-                "closure_start": ["10:00:00"],
-                "closure_end": ["13:00:00"],
-                "is_full_day": [False],
-            }
-        ).values.tolist()
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": ["hh"],
+                    "name": ["Library H"],
+                    "alert_id": ["8"],
+                    "closed_for": ["new closed_for"],
+                    "is_extended_closure": [False],
+                    "closure_date": ["2023-01-01"],
+                    "closure_start": ["10:00:00"],
+                    "closure_end": ["13:00:00"],
+                    "is_full_day": [False],
+                }
+            )
+        )
 
         assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
 
@@ -392,19 +1461,21 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
-            {
-                "location_id": ["ii"],
-                "name": ["Library I"],
-                "alert_id": ["9"],
-                "closed_for": ["Lib I is closed"],
-                "is_extended_closure": [False],
-                "closure_date": ["2023-01-01"],
-                "closure_start": ["09:01:23"],
-                "closure_end": ["12:01:23"],
-                "is_full_day": [False],
-            }
-        ).values.tolist()
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": ["ii"],
+                    "name": ["Library I"],
+                    "alert_id": ["9"],
+                    "closed_for": ["Lib I is closed"],
+                    "is_extended_closure": [False],
+                    "closure_date": ["2023-01-01"],
+                    "closure_start": ["09:01:23"],
+                    "closure_end": ["12:01:23"],
+                    "is_full_day": [False],
+                }
+            )
+        )
 
         assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
 
@@ -448,19 +1519,21 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
-            {
-                "location_id": ["kk", "ll"],
-                "name": ["Library K", "Library L"],
-                "alert_id": ["11", "11"],
-                "closed_for": ["Lib K is closed", "Lib L is closed"],
-                "is_extended_closure": [False, False],
-                "closure_date": ["2023-01-01", "2023-01-01"],
-                "closure_start": ["09:00:00", "09:00:00"],
-                "closure_end": ["17:00:00", "17:00:00"],
-                "is_full_day": [True, True],
-            }
-        ).values.tolist()
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": ["kk", "ll"],
+                    "name": ["Library K", "Library L"],
+                    "alert_id": ["11", "11"],
+                    "closed_for": ["Lib K is closed", "Lib L is closed"],
+                    "is_extended_closure": [False, False],
+                    "closure_date": ["2023-01-01", "2023-01-01"],
+                    "closure_start": ["09:00:00", "09:00:00"],
+                    "closure_end": ["17:00:00", "17:00:00"],
+                    "is_full_day": [True, True],
+                }
+            )
+        )
 
         assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
 
@@ -485,18 +1558,158 @@ class TestLambdaFunction:
             pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
         )
 
-        _CLOSURES = pd.DataFrame(
+        _CLOSURES = to_closures(
+            pd.DataFrame(
+                {
+                    "location_id": [None, None],
+                    "name": [None, None],
+                    "alert_id": ["12", "13"],
+                    "closed_for": ["System full closure", "System part closure"],
+                    "is_extended_closure": [False, False],
+                    "closure_date": ["2023-01-01", "2023-01-01"],
+                    "closure_start": ["00:00:59", "00:00:59"],
+                    "closure_end": ["23:59:00", "11:00:00"],
+                    "is_full_day": [True, False],
+                }
+            )
+        )
+
+        assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
+
+    def _build_multi_day_alerts(self):
+        _ALERTS_DF = pd.DataFrame(
             {
-                "location_id": [None, None],
-                "name": [None, None],
-                "alert_id": ["12", "13"],
-                "closed_for": ["System full closure", "System part closure"],
-                "is_extended_closure": [False, False],
-                "closure_date": ["2023-01-01", "2023-01-01"],
-                "closure_start": ["00:00:59", "00:00:59"],
-                "closure_end": ["23:59:00", "11:00:00"],
-                "is_full_day": [True, False],
+                "location_id": ["aa"] * 3,
+                "name": ["Library A"] * 3,
+                "alert_id": ["1"] * 3,
+                "closed_for": ["Lib A is closed"] * 3,
+                "extended_closing": [False] * 3,
+                "alert_start": ["2023-01-01 11:00:00-05"] * 3,
+                "alert_end": ["2023-01-01 14:00:00-05"] * 3,
+                "polling_datetime": get_polling_times(11, 14),
+                "regular_open": [time(9)] * 3,
+                "regular_close": [time(17)] * 3,
             }
-        ).values.tolist()
+        )
+        _DAY_DF = convert_df_types(
+            pd.concat([_BASE_ALERTS_DF, _ALERTS_DF], ignore_index=True)
+        )
+        _NEXT_DAY_DF = _DAY_DF.copy()
+        for column in ["alert_start", "alert_end", "polling_datetime"]:
+            _NEXT_DAY_DF[column] += pd.Timedelta(days=1)
+        return pd.concat([_NEXT_DAY_DF, _DAY_DF], ignore_index=True)
 
-        assert lambda_function.get_closures(_FULL_DF) == _CLOSURES
+    def test_multi_day_closures(self, test_instance):
+        with pytest.raises(lambda_function.LocationClosureAggregatorError):
+            lambda_function.get_closures(self._build_multi_day_alerts())
+
+    def test_closures_by_day(self, test_instance):
+        _NEXT_DAY_CLOSURES = [
+            closure._replace(closure_date="2023-01-02") for closure in _BASE_CLOSURES
+        ]
+
+        assert (
+            lambda_function.get_closures_by_day(self._build_multi_day_alerts())
+            == _BASE_CLOSURES + _NEXT_DAY_CLOSURES
+        )
+
+    def test_closures_by_day_without_process_pool(self, test_instance, mocker):
+        mocker.patch(
+            "lambda_function.ProcessPoolExecutor",
+            side_effect=OSError("Function not implemented"),
+        )
+        _NEXT_DAY_CLOSURES = [
+            closure._replace(closure_date="2023-01-02") for closure in _BASE_CLOSURES
+        ]
+
+        assert (
+            lambda_function.get_closures_by_day(self._build_multi_day_alerts())
+            == _BASE_CLOSURES + _NEXT_DAY_CLOSURES
+        )
+
+    def test_sharded_closures(self, test_instance, mocker):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "PARALLEL_MODE": "True",
+                "PARALLEL_WORKERS": "3",
+                "PARALLEL_MIN_ROWS": "100",
+            },
+        )
+        sharded_spy = mocker.spy(closure_engine, "aggregate_sharded_closures")
+        alerts_df = pd.DataFrame(
+            generate_alert_rows(location_count=20), columns=GET_ALERTS_COLUMNS
+        )
+        serial_closures = lambda_function.get_closures(alerts_df.copy(), sharded=False)
+
+        assert lambda_function.get_closures(alerts_df.copy()) == serial_closures
+        sharded_spy.assert_called_once()
+        assert sharded_spy.call_args.args[2] == 3
+
+    def test_sharded_closures_in_thread(self, test_instance, mocker):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "PARALLEL_MODE": "True",
+                "PARALLEL_WORKERS": "2",
+                "PARALLEL_MIN_ROWS": "100",
+            },
+        )
+        mock_pool = mocker.patch(
+            "closure_engine.ProcessPoolExecutor",
+            wraps=closure_engine.ProcessPoolExecutor,
+        )
+        alerts_df = pd.DataFrame(
+            generate_alert_rows(location_count=20), columns=GET_ALERTS_COLUMNS
+        )
+
+        # As when several environments are processed at once, the workers
+        # aren't forked from a process that's running other threads
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            closures = executor.submit(
+                lambda_function.get_closures, alerts_df.copy()
+            ).result()
+
+        assert closures == lambda_function.get_closures(alerts_df.copy(), sharded=False)
+        mp_context = mock_pool.call_args.kwargs["mp_context"]
+        assert mp_context.get_start_method() == "forkserver"
+
+    def test_sharded_closures_below_min_rows(self, test_instance, mocker):
+        mocker.patch.dict(
+            os.environ, {"PARALLEL_MODE": "True", "PARALLEL_WORKERS": "3"}
+        )
+        mock_sharded = mocker.patch("closure_engine.aggregate_sharded_closures")
+
+        lambda_function.get_closures(
+            pd.DataFrame(
+                generate_alert_rows(location_count=20), columns=GET_ALERTS_COLUMNS
+            )
+        )
+        mock_sharded.assert_not_called()
+
+    def test_sharded_closures_without_process_pool(self, test_instance, mocker):
+        mocker.patch.dict(
+            os.environ,
+            {
+                "PARALLEL_MODE": "True",
+                "PARALLEL_WORKERS": "3",
+                "PARALLEL_MIN_ROWS": "0",
+            },
+        )
+        mocker.patch(
+            "closure_engine.ProcessPoolExecutor",
+            side_effect=OSError("Function not implemented"),
+        )
+        alerts_df = pd.DataFrame(
+            generate_alert_rows(location_count=20), columns=GET_ALERTS_COLUMNS
+        )
+
+        assert lambda_function.get_closures(
+            alerts_df.copy()
+        ) == lambda_function.get_closures(alerts_df.copy(), sharded=False)
+
+    def test_closures_by_day_single_day(self, test_instance, mocker):
+        mock_pool = mocker.patch("lambda_function.ProcessPoolExecutor")
+
+        assert lambda_function.get_closures_by_day(_BASE_ALERTS_DF.copy()) is None
+        mock_pool.assert_not_called()
@@ -0,0 +1,261 @@
+import io
+import itertools
+import lambda_function
+import live_closures
+import metrics
+import os
+import pandas as pd
+import pytest
+
+from query_helper import GET_ALERTS_COLUMNS
+from tests.test_closure_engine import (
+    build_gap_alerts,
+    build_random_alerts,
+    to_raw_alerts,
+)
+
+
+def split_polls(raw_alerts):
+    # Splits the rows into one batch per polling datetime, in polling order
+    return [
+        list(batch)
+        for _, batch in itertools.groupby(
+            sorted(raw_alerts, key=lambda row: row[7]), key=lambda row: row[7]
+        )
+    ]
+
+
+class ClientError(Exception):
+    def __init__(self, code):
+        self.response = {"Error": {"Code": code}}
+
+
+class LocalS3Client:
+    """
+    Stands in for an S3 client over in-memory objects, with the ETag
+    conditions of put_object, shared by every container's client
+    """
+
+    class exceptions:
+        NoSuchKey = KeyError
+
+    def __init__(self):
+        self.objects = {}
+        self.version = 0
+
+    def get_object(self, Bucket, Key):
+        body, etag = self.objects[Key]
+        return {"Body": io.BytesIO(body), "ETag": etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        current_etag = self.objects.get(Key, (None, None))[1]
+        if (IfNoneMatch == "*" and current_etag is not None) or (
+            IfMatch is not None and IfMatch != current_etag
+        ):
+            raise ClientError("PreconditionFailed")
+        self.version += 1
+        self.objects[Key] = (Body, f'"{self.version}"')
+        return {"ETag": f'"{self.version}"'}
+
+    def close(self):
+        pass
+
+
+class TestLiveClosures:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("live_closures.logger")
+        mocker.patch.dict(os.environ)
+        os.environ.pop("LIVE_STATE_BUCKET", None)
+        metrics.start_run()
+        live_closures.clear_cache()
+
+    @pytest.mark.parametrize("seed", range(6))
+    def test_matches_get_closures(self, test_instance, seed):
+        raw_alerts = to_raw_alerts(build_random_alerts(seed, "2023-01-01"))
+        batches = split_polls(raw_alerts)
+        state = live_closures.LiveClosures()
+
+        for i, batch in enumerate(batches):
+            state.update(batch)
+            if i == len(batches) // 2:
+                # The state survives being saved and loaded mid-day, and the
+                # provisional closures match those of the polls so far
+                state = live_closures.LiveClosures.from_json(state.to_json())
+                assert state.get_closures() == lambda_function.get_closures(
+                    pd.DataFrame(
+                        [row for batch in batches[: i + 1] for row in batch],
+                        columns=GET_ALERTS_COLUMNS,
+                    )
+                )
+
+        assert state.get_closures() == lambda_function.get_closures(
+            pd.DataFrame(raw_alerts, columns=GET_ALERTS_COLUMNS)
+        )
+
+    @pytest.mark.parametrize("split_closures_mode", ["False", "True"])
+    def test_gap_closures(self, test_instance, mocker, split_closures_mode):
+        mocker.patch.dict(os.environ, {"SPLIT_CLOSURES_MODE": split_closures_mode})
+        raw_alerts = to_raw_alerts(build_gap_alerts())
+        state = live_closures.LiveClosures()
+
+        for batch in split_polls(raw_alerts):
+            state.update(batch)
+
+        alert = state.alerts[("1", "aa")]
+        assert alert.runs == [[1, 4], [7, 9]]
+        assert alert.missed_polls == 2
+        assert state.get_closures() == lambda_function.get_closures(
+            pd.DataFrame(raw_alerts, columns=GET_ALERTS_COLUMNS)
+        )
+
+    def test_duplicate_rows(self, test_instance):
+        raw_alerts = to_raw_alerts(build_random_alerts(0, "2023-01-01"))
+        # Each poll arrives in two batches, the second repeating some rows of
+        # the first with a different closure reason
+        batches = []
+        for batch in split_polls(raw_alerts):
+            batches.append(batch)
+            batches.append([row[:3] + ("repeated",) + row[4:] for row in batch[::2]])
+        state = live_closures.LiveClosures()
+
+        for batch in batches:
+            state.update(batch)
+
+        assert state.get_closures() == lambda_function.get_closures(
+            pd.DataFrame(
+                [row for batch in batches for row in batch],
+                columns=GET_ALERTS_COLUMNS,
+            )
+        )
+
+    def test_new_day(self, test_instance):
+        first_day = to_raw_alerts(build_random_alerts(0, "2023-01-01"))
+        second_day = to_raw_alerts(build_random_alerts(1, "2023-01-02"))
+        state = live_closures.LiveClosures()
+
+        for batch in split_polls(first_day) + split_polls(second_day):
+            state.update(batch)
+
+        assert str(state.polling_date) == "2023-01-02"
+        assert state.get_closures() == lambda_function.get_closures(
+            pd.DataFrame(second_day, columns=GET_ALERTS_COLUMNS)
+        )
+
+    def test_empty(self, test_instance):
+        state = live_closures.LiveClosures()
+        state.update([])
+
+        assert state.get_closures() is None
+        assert live_closures.LiveClosures.from_json(state.to_json()).alerts == {}
+
+    def test_out_of_order(self, test_instance):
+        batches = split_polls(to_raw_alerts(build_random_alerts(0, "2023-01-01")))
+        state = live_closures.LiveClosures()
+        state.update(batches[1])
+
+        with pytest.raises(live_closures.LiveClosuresError) as e:
+            state.update(batches[0])
+        assert "arrived out of order" in e.value.message
+
+        with pytest.raises(live_closures.LiveClosuresError) as e:
+            state.update(batches[2] + batches[3])
+        assert e.value.message == "Poll batch holds more than one polling datetime"
+
+    def test_update_live_closures(self, test_instance, mocker, tmp_path):
+        mocker.patch.dict(os.environ, {"LIVE_STATE_DIR": str(tmp_path)})
+        batches = split_polls(to_raw_alerts(build_random_alerts(0, "2023-01-01")))
+        live_closures.update_live_closures(batches[0], "alerts")
+        mock_load = mocker.spy(live_closures, "load_live_closures")
+
+        # A warm container keeps its state and a cold one loads the saved state
+        state = live_closures.update_live_closures(batches[1], "alerts")
+        mock_load.assert_not_called()
+        live_closures.clear_cache()
+        saved = (tmp_path / "alerts-live-closures.json").read_text()
+        assert len(live_closures.LiveClosures.from_json(saved).polls) == 2
+        state = live_closures.update_live_closures(batches[2], "alerts")
+        mock_load.assert_called_once_with("alerts")
+        assert len(state.polls) == 3
+
+        # A failed update is forgotten, so the saved state is loaded again
+        with pytest.raises(live_closures.LiveClosuresError):
+            live_closures.update_live_closures(batches[0], "alerts")
+        state = live_closures.update_live_closures(batches[3], "alerts")
+        assert mock_load.call_count == 2
+        assert len(state.polls) == 4
+
+    def test_live_closures_s3(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"LIVE_STATE_BUCKET": "bucket"})
+        mock_s3_client = mocker.MagicMock()
+        mock_s3_client.exceptions.NoSuchKey = KeyError
+        mock_s3_client.get_object.side_effect = KeyError
+        mocker.patch("boto3.client", return_value=mock_s3_client)
+        batches = split_polls(to_raw_alerts(build_random_alerts(0, "2023-01-01")))
+
+        state = live_closures.update_live_closures(batches[0], "alerts")
+
+        mock_s3_client.get_object.assert_called_once_with(
+            Bucket="bucket", Key="alerts-live-closures.json"
+        )
+        put_kwargs = mock_s3_client.put_object.call_args.kwargs
+        assert put_kwargs["Key"] == "alerts-live-closures.json"
+        assert put_kwargs["IfNoneMatch"] == "*"
+        loaded = live_closures.LiveClosures.from_json(put_kwargs["Body"].decode())
+        assert loaded.polls == state.polls
+
+    def test_live_closures_s3_error(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"LIVE_STATE_BUCKET": "bucket"})
+        mock_s3_client = mocker.MagicMock()
+        mock_s3_client.exceptions.NoSuchKey = KeyError
+        mock_s3_client.get_object.side_effect = Exception("access denied")
+        mocker.patch("boto3.client", return_value=mock_s3_client)
+
+        with pytest.raises(live_closures.LiveClosuresError) as e:
+            live_closures.load_live_closures("alerts")
+        assert e.value.message == "Error loading live closure state: access denied"
+
+    def test_live_closures_s3_containers(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"LIVE_STATE_BUCKET": "bucket"})
+        s3_client = LocalS3Client()
+        mocker.patch("boto3.client", return_value=s3_client)
+        raw_alerts = to_raw_alerts(build_random_alerts(0, "2023-01-01"))
+        batches = split_polls(raw_alerts)
+
+        # Consecutive polls alternate between two warm containers, each of
+        # which picks up the polls the other added
+        containers = [{}, {}]
+        for i, batch in enumerate(batches):
+            mocker.patch.object(live_closures, "_live_closures", containers[i % 2])
+            state = live_closures.update_live_closures(batch, "alerts")
+
+        assert len(state.polls) == len(batches)
+        assert state.get_closures() == lambda_function.get_closures(
+            pd.DataFrame(raw_alerts, columns=GET_ALERTS_COLUMNS)
+        )
+
+    def test_live_closures_s3_conflict(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"LIVE_STATE_BUCKET": "bucket"})
+        s3_client = LocalS3Client()
+        mocker.patch("boto3.client", return_value=s3_client)
+        batches = split_polls(to_raw_alerts(build_random_alerts(0, "2023-01-01")))
+        live_closures.update_live_closures(batches[0], "alerts")
+        state = live_closures.load_live_closures("alerts")
+        live_closures.update_live_closures(batches[1], "alerts")
+
+        # A state loaded before another update saved doesn't overwrite it
+        state.update(batches[2])
+        with pytest.raises(live_closures.LiveClosuresError) as e:
+            live_closures.save_live_closures(state, "alerts")
+        assert e.value.message == "Live closure state was saved by another update"
+        assert len(live_closures.load_live_closures("alerts").polls) == 2
+
+    def test_update_live_closures_warns_without_bucket(
+        self, test_instance, mocker, tmp_path
+    ):
+        mocker.patch.dict(os.environ, {"LIVE_STATE_DIR": str(tmp_path)})
+        batches = split_polls(to_raw_alerts(build_random_alerts(0, "2023-01-01")))
+
+        live_closures.update_live_closures(batches[0], "alerts")
+
+        live_closures.logger.warning.assert_called_once()
@@ -0,0 +1,125 @@
+import json
+import metrics
+import pytest
+import tracemalloc
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TestMetrics:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("metrics.time.perf_counter", side_effect=[1.0, 1.25, 2.0, 2.5])
+        return metrics.start_run(Environment="test")
+
+    def test_stage(self, test_instance):
+        with metrics.stage("Aggregate"):
+            pass
+        with metrics.stage("Aggregate"):
+            pass
+
+        assert test_instance.timings == {"Aggregate": 750.0}
+
+    def test_stage_error(self, test_instance):
+        with pytest.raises(ValueError):
+            with metrics.stage("Aggregate"):
+                raise ValueError()
+
+        assert test_instance.timings == {"Aggregate": 250.0}
+
+    def test_stage_memory_peaks_nested(self, test_instance):
+        tracemalloc.start()
+        try:
+            with metrics.stage("Aggregate"):
+                with metrics.stage("BuildDataFrame"):
+                    data = bytearray(10**6)
+                del data
+        finally:
+            tracemalloc.stop()
+
+        # The nested stage doesn't reset the peak of the stage it's nested in
+        assert list(test_instance.memory_peaks) == ["Aggregate"]
+        assert test_instance.memory_peaks["Aggregate"] >= 10**6
+
+    def test_stage_memory_peaks_use_run(self, test_instance):
+        run = metrics.RunMetrics()
+        tracemalloc.start()
+        try:
+            with metrics.use_run(run):
+                with metrics.stage("Aggregate"):
+                    pass
+        finally:
+            tracemalloc.stop()
+
+        assert run.timings == {"Aggregate": 250.0}
+        assert run.memory_peaks == {}
+
+    def test_count(self, test_instance):
+        metrics.count("AlertRows", 10)
+        metrics.count("AlertRows", 5)
+        metrics.count("Closures")
+
+        assert test_instance.counts == {"AlertRows": 15, "Closures": 1}
+
+    def test_start_run(self, test_instance):
+        metrics.count("Closures")
+        new_run = metrics.start_run(Environment="test")
+
+        assert metrics.current_run() is new_run
+        assert new_run.counts == {}
+
+    def test_to_emf(self, test_instance):
+        with metrics.stage("Aggregate"):
+            metrics.count("Closures", 3)
+
+        assert test_instance.to_emf(timestamp=1672531200.5) == {
+            "_aws": {
+                "Timestamp": 1672531200500,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": "LocationClosureAggregator",
+                        "Dimensions": [["Environment"]],
+                        "Metrics": [
+                            {"Name": "AggregateTime", "Unit": "Milliseconds"},
+                            {"Name": "Closures", "Unit": "Count"},
+                        ],
+                    }
+                ],
+            },
+            "Environment": "test",
+            "AggregateTime": 250.0,
+            "Closures": 3,
+        }
+
+    def test_emit(self, test_instance, capsys):
+        metrics.count("Closures", 3)
+
+        record = metrics.emit()
+
+        assert json.loads(capsys.readouterr().out) == record
+        assert record["Closures"] == 3
+
+    def test_use_run(self, test_instance):
+        run = metrics.RunMetrics({"Environment": "test", "Database": "qa"})
+
+        with metrics.use_run(run):
+            metrics.count("Closures", 3)
+            assert metrics.current_run() is run
+        metrics.count("Closures")
+
+        assert run.counts == {"Closures": 3}
+        assert test_instance.counts == {"Closures": 1}
+
+    def test_use_run_threads(self, test_instance):
+        runs = [metrics.RunMetrics() for _ in range(4)]
+
+        def count_closures(run):
+            with metrics.use_run(run):
+                for _ in range(1000):
+                    metrics.count("Closures")
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(count_closures, runs))
+
+        assert [run.counts for run in runs] == [{"Closures": 1000}] * 4
+        assert test_instance.counts == {}
@@ -0,0 +1,164 @@
+import lambda_function
+import os
+import pandas as pd
+import pipeline
+import pytest
+
+from benchmarks.alert_generator import generate_alert_rows
+from closure_record import Closure
+from query_helper import CLOSURES_COLUMNS, GET_ALERTS_COLUMNS
+from tests.test_closure_engine import normalize_closures
+from tests.test_lambda_function import sort_alert_rows
+
+
+class LocalPipelineCursor:
+    """
+    Stands in for a Redshift cursor that serves a server-side cursor's rows
+    and records every other query along with its values
+    """
+
+    def __init__(self, rows, fail_on=None):
+        self.rows = rows
+        self.fail_on = fail_on
+        self.position = None
+        self.results = None
+        self.queries = []
+        self.closed = False
+
+    def execute(self, query, values=None):
+        if self.fail_on is not None and query.strip().startswith(self.fail_on):
+            raise Exception("connection reset")
+        self.queries.append((query, values))
+        if query.startswith("DECLARE"):
+            self.position = 0
+        elif query.startswith("FETCH FORWARD"):
+            batch_size = int(query.split()[2])
+            self.results = self.rows[self.position : self.position + batch_size]
+            self.position += len(self.results)
+
+    def fetchall(self):
+        return self.results
+
+    def close(self):
+        self.closed = True
+
+    def inserted_closures(self):
+        return [
+            Closure(*values[i : i + len(CLOSURES_COLUMNS)])
+            for query, values in self.queries
+            if query.strip().startswith("INSERT")
+            for i in range(0, len(values), len(CLOSURES_COLUMNS))
+        ]
+
+
+class TestPipeline:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("pipeline.logger")
+        raw_alerts = sort_alert_rows(
+            generate_alert_rows(location_count=30, polling_interval=15)
+        )
+        mock_redshift_client = mocker.MagicMock()
+        mock_redshift_client.execute_query.return_value = sorted(
+            {(row[7],) for row in raw_alerts}
+        )
+        mock_redshift_client.conn.cursor.return_value = LocalPipelineCursor(raw_alerts)
+        return mock_redshift_client
+
+    def _expected_closures(self, cursor):
+        return normalize_closures(
+            lambda_function.get_closures(
+                pd.DataFrame(cursor.rows, columns=GET_ALERTS_COLUMNS)
+            )
+        )
+
+    @pytest.mark.parametrize("batch_size", [1, 7, 250, 100000])
+    def test_run_closure_pipeline(self, test_instance, mocker, batch_size):
+        mocker.patch.dict(os.environ, {"ALERTS_BATCH_SIZE": str(batch_size)})
+        cursor = test_instance.conn.cursor.return_value
+
+        closure_count = lambda_function.run_closure_pipeline(
+            test_instance, "hours_table", "closures_table", "alerts_table"
+        )
+
+        closures = cursor.inserted_closures()
+        assert closure_count == len(closures)
+        assert sorted(normalize_closures(closures), key=str) == sorted(
+            self._expected_closures(cursor), key=str
+        )
+        queries = [query for query, _ in cursor.queries]
+        assert queries[0] == "BEGIN TRANSACTION;"
+        assert queries[1].startswith("DECLARE closure_alerts_cursor CURSOR FOR")
+        assert "ORDER BY alerts_table.location_id" in queries[1]
+        assert queries[-2:] == ["DELETE FROM alerts_table;", "END TRANSACTION;"]
+        assert queries.index("CLOSE closure_alerts_cursor;") < queries.index(
+            "DELETE FROM alerts_table;"
+        )
+        test_instance.conn.commit.assert_called_once()
+        test_instance.conn.rollback.assert_not_called()
+        assert cursor.closed
+
+    def test_run_closure_pipeline_queue_size(self, test_instance, mocker):
+        mocker.patch.dict(
+            os.environ, {"ALERTS_BATCH_SIZE": "20", "PIPELINE_QUEUE_SIZE": "1"}
+        )
+        cursor = test_instance.conn.cursor.return_value
+
+        lambda_function.run_closure_pipeline(
+            test_instance, "hours_table", "closures_table", "alerts_table"
+        )
+
+        assert sorted(normalize_closures(cursor.inserted_closures()), key=str) == (
+            sorted(self._expected_closures(cursor), key=str)
+        )
+
+    def test_run_closure_pipeline_no_alerts(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"ALERTS_BATCH_SIZE": "100"})
+        test_instance.execute_query.return_value = []
+        cursor = LocalPipelineCursor([])
+        test_instance.conn.cursor.return_value = cursor
+
+        assert (
+            lambda_function.run_closure_pipeline(
+                test_instance, "hours_table", "closures_table", "alerts_table"
+            )
+            == 0
+        )
+        assert [query for query, _ in cursor.queries][-2:] == [
+            "DELETE FROM alerts_table;",
+            "END TRANSACTION;",
+        ]
+        test_instance.conn.commit.assert_called_once()
+
+    def test_run_closure_pipeline_do_not_update(self, test_instance, mocker):
+        mocker.patch.dict(
+            os.environ, {"ALERTS_BATCH_SIZE": "100", "DO_NOT_UPDATE": "True"}
+        )
+        cursor = test_instance.conn.cursor.return_value
+
+        assert (
+            lambda_function.run_closure_pipeline(
+                test_instance, "hours_table", "closures_table", "alerts_table"
+            )
+            > 0
+        )
+        assert not any(
+            query.strip().startswith(("INSERT", "DELETE"))
+            for query, _ in cursor.queries
+        )
+
+    @pytest.mark.parametrize("fail_on", ["FETCH", "INSERT", "DELETE"])
+    def test_run_closure_pipeline_error(self, test_instance, mocker, fail_on):
+        mocker.patch.dict(os.environ, {"ALERTS_BATCH_SIZE": "100"})
+        cursor = test_instance.conn.cursor.return_value
+        cursor.fail_on = fail_on
+
+        with pytest.raises(pipeline.PipelineError) as e:
+            lambda_function.run_closure_pipeline(
+                test_instance, "hours_table", "closures_table", "alerts_table"
+            )
+
+        assert e.value.message == "Error running closure pipeline: connection reset"
+        test_instance.conn.rollback.assert_called_once()
+        test_instance.conn.commit.assert_not_called()
+        assert cursor.closed
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from poll_runs import PollRuns
+
+_POLLS = np.arange(10, dtype=np.int64) * 3600 * 10**9
+
+
+class TestPollRuns:
+    @pytest.fixture
+    def test_instance(self):
+        # Out of order and with duplicates, as the polls come from the alerts
+        group_ids = np.array([1, 0, 0, 0, 2, 0, 0, 1, 0, 2])
+        positions = np.array([5, 0, 2, 1, 9, 4, 5, 6, 1, 0])
+        return PollRuns(group_ids, _POLLS[positions], _POLLS, 3)
+
+    def test_runs(self, test_instance):
+        assert len(test_instance) == 5
+        assert test_instance.groups.tolist() == [0, 0, 1, 2, 2]
+        assert test_instance.firsts.tolist() == [0, 4, 5, 0, 9]
+        assert test_instance.lasts.tolist() == [2, 5, 6, 0, 9]
+        assert test_instance.firsts.dtype == np.int32
+
+    def test_single_run(self):
+        poll_runs = PollRuns(np.zeros(10, dtype=int), _POLLS, _POLLS, 1)
+
+        assert len(poll_runs) == 1
+        assert (poll_runs.firsts[0], poll_runs.lasts[0]) == (0, 9)
+
+    def test_from_runs(self, test_instance):
+        poll_runs = PollRuns.from_runs(
+            [0, 0, 1, 2, 2], [0, 4, 5, 0, 9], [2, 5, 6, 0, 9], _POLLS, 3
+        )
+        firsts, stops = np.array([1, 0, 0]), np.array([6, 6, 9])
+
+        assert poll_runs.groups.dtype == np.int32
+        assert (poll_runs.count_seen_within(firsts, stops) == [4, 1, 1]).all()
+        assert (
+            poll_runs.overlapping(firsts, stops)
+            == test_instance.overlapping(firsts, stops)
+        ).all()
+
+    def test_window(self, test_instance):
+        firsts, stops = test_instance.window(
+            np.array([_POLLS[1], _POLLS[2] + 1, _POLLS[8]]),
+            np.array([_POLLS[6], _POLLS[3], _POLLS[2]]),
+        )
+
+        assert firsts.tolist() == [2, 3, 9]
+        assert stops.tolist() == [6, 3, 9]
+
+    def test_count_seen_within(self, test_instance):
+        seen = test_instance.count_seen_within(np.array([1, 0, 0]), np.array([6, 6, 9]))
+
+        # Group 0 is seen at 1, 2, 4, and 5, group 1 at 5, and group 2 at 0
+        assert seen.tolist() == [4, 1, 1]
+
+    def test_count_seen_within_random(self):
+        rng = np.random.default_rng(0)
+        group_ids = rng.integers(0, 20, 500)
+        positions = rng.integers(0, len(_POLLS), 500)
+        poll_runs = PollRuns(group_ids, _POLLS[positions], _POLLS, 20)
+        firsts = rng.integers(0, 10, 20)
+        stops = firsts + rng.integers(0, 10, 20)
+
+        expected = [
+            len(
+                {
+                    position
+                    for group, position in zip(group_ids, positions)
+                    if group == group_id and firsts[group_id] <= position
+                    if position < stops[group_id]
+                }
+            )
+            for group_id in range(20)
+        ]
+        assert poll_runs.count_seen_within(firsts, stops).tolist() == expected
+
+    def test_overlapping(self, test_instance):
+        assert test_instance.overlapping(
+            np.array([3, 7, 1]), np.array([5, 9, 9])
+        ).tolist() == [False, True, False, False, False]
+
+    def test_empty(self):
+        poll_runs = PollRuns(
+            np.array([], dtype=int), np.array([], dtype=np.int64), _POLLS[:0], 0
+        )
+
+        assert len(poll_runs) == 0
+        assert (
+            poll_runs.count_seen_within(
+                np.array([], dtype=int), np.array([], dtype=int)
+            ).tolist()
+            == []
+        )
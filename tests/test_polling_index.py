@@ -0,0 +1,103 @@
+import pytest
+
+from datetime import datetime, timedelta, timezone
+from polling_index import PollingTimeIndex
+from pytz import timezone as pytz_timezone
+
+_FIRST_POLL = datetime(2023, 1, 1, 11, 1, 23, tzinfo=timezone.utc)
+
+_POLLS = [_FIRST_POLL + timedelta(hours=i) for i in range(10)]
+
+
+class TestPollingTimeIndex:
+    @pytest.fixture
+    def test_instance(self):
+        # Out of order and with duplicates, as the polls come from the alerts
+        return PollingTimeIndex(_POLLS[::-1] + _POLLS[:3])
+
+    def test_sorted_positions(self, test_instance):
+        assert len(test_instance) == 10
+        assert test_instance.polling_datetimes == _POLLS
+        assert [test_instance.position(poll) for poll in _POLLS] == list(range(10))
+        assert test_instance[0] == _POLLS[0]
+        assert test_instance[-1] == _POLLS[-1]
+
+    def test_position_in_other_timezone(self, test_instance):
+        eastern_poll = _POLLS[4].astimezone(pytz_timezone("US/Eastern"))
+
+        assert test_instance.position(eastern_poll) == 4
+
+    def test_position_not_indexed(self, test_instance):
+        with pytest.raises(KeyError):
+            test_instance.position(_FIRST_POLL - timedelta(minutes=1))
+
+    def test_positions(self, test_instance):
+        assert test_instance.positions([_POLLS[5], _POLLS[2], _POLLS[5]]) == [2, 5]
+
+    @pytest.mark.parametrize(
+        "start, end, window",
+        [
+            # The window excludes polls at exactly the start and end
+            (_POLLS[2], _POLLS[6], (3, 6)),
+            (_POLLS[2] - timedelta(seconds=1), _POLLS[6] + timedelta(seconds=1), (2, 7)),
+            (_FIRST_POLL - timedelta(days=1), _POLLS[-1] + timedelta(days=1), (0, 10)),
+            (_POLLS[3], _POLLS[4], (4, 4)),
+            (_POLLS[6], _POLLS[2], (7, 7)),
+        ],
+    )
+    def test_window(self, test_instance, start, end, window):
+        assert test_instance.window(start, end) == window
+        assert test_instance.count_within(start, end) == window[1] - window[0]
+
+    def test_count_seen_within(self, test_instance):
+        seen_positions = [0, 3, 4, 6, 9]
+
+        assert test_instance.count_seen_within(seen_positions, _POLLS[2], _POLLS[6]) == 2
+        assert test_instance.count_seen_within(seen_positions, _POLLS[6], _POLLS[2]) == 0
+
+    def test_is_seen_throughout(self, test_instance):
+        seen_positions = [2, 3, 4, 5, 6, 8]
+
+        assert test_instance.is_seen_throughout(seen_positions, _POLLS[1], _POLLS[7])
+        assert test_instance.is_seen_throughout(seen_positions, _POLLS[2], _POLLS[7])
+        assert not test_instance.is_seen_throughout(
+            seen_positions, _POLLS[1], _POLLS[9]
+        )
+        assert not test_instance.is_seen_throughout(
+            seen_positions, _POLLS[0], _POLLS[3]
+        )
+        # A window with no polls in it is trivially seen throughout
+        assert test_instance.is_seen_throughout([], _POLLS[3], _POLLS[4])
+
+    def test_runs(self, test_instance):
+        seen = [_POLLS[i] for i in [8, 2, 3, 4, 6, 3, 0]]
+
+        assert test_instance.runs(seen) == [(0, 0), (2, 4), (6, 6), (8, 8)]
+        assert test_instance.runs(_POLLS) == [(0, 9)]
+        assert test_instance.runs([]) == []
+
+    def test_is_seen_throughout_runs(self, test_instance):
+        runs = [(2, 6), (8, 8)]
+
+        assert test_instance.is_seen_throughout_runs(runs, _POLLS[1], _POLLS[7])
+        assert test_instance.is_seen_throughout_runs(runs, _POLLS[2], _POLLS[7])
+        assert not test_instance.is_seen_throughout_runs(runs, _POLLS[1], _POLLS[9])
+        assert not test_instance.is_seen_throughout_runs(runs, _POLLS[0], _POLLS[3])
+        assert test_instance.is_seen_throughout_runs([], _POLLS[3], _POLLS[4])
+
+    def test_runs_within(self, test_instance):
+        runs = [(0, 1), (3, 4), (6, 6), (8, 9)]
+
+        assert test_instance.runs_within(runs, _POLLS[1], _POLLS[8]) == [
+            (3, 4),
+            (6, 6),
+        ]
+        assert test_instance.runs_within(runs, _POLLS[0], _POLLS[9]) == runs
+        assert test_instance.runs_within(runs, _POLLS[4], _POLLS[6]) == []
+
+    def test_empty_index(self):
+        empty_index = PollingTimeIndex([])
+
+        assert len(empty_index) == 0
+        assert empty_index.count_within(_POLLS[0], _POLLS[-1]) == 0
+        assert empty_index.is_seen_throughout([], _POLLS[0], _POLLS[-1])
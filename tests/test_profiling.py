@@ -0,0 +1,83 @@
+import metrics
+import os
+import profiling
+import pstats
+import pytest
+import tracemalloc
+
+
+def _allocate():
+    return [str(i) for i in range(10000)]
+
+
+class TestProfiling:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        metrics.start_run()
+        return mocker.patch("profiling.logger")
+
+    def test_profile_run_disabled(self, test_instance, mocker):
+        mock_profile = mocker.patch("profiling.cProfile.Profile")
+
+        with profiling.profile_run():
+            with metrics.stage("Aggregate"):
+                _allocate()
+
+        mock_profile.assert_not_called()
+        test_instance.info.assert_not_called()
+        assert not tracemalloc.is_tracing()
+        assert metrics.current_run().memory_peaks == {}
+
+    def test_profile_run(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"PROFILING_MODE": "True"})
+
+        with profiling.profile_run():
+            with metrics.stage("Aggregate"):
+                allocated = _allocate()
+
+        assert not tracemalloc.is_tracing()
+        assert metrics.current_run().memory_peaks["Aggregate"] > 0
+        test_instance.info.assert_called_once()
+        summary = test_instance.info.call_args.args[0]
+        assert summary.startswith("Peak traced memory: ")
+        assert "  Aggregate: " in summary
+        assert "Top allocation sites:" in summary
+        assert "Top functions by cumulative time:" in summary
+        assert "_allocate" in summary
+        assert len(allocated) == 10000
+
+    def test_profile_run_output_path(self, test_instance, mocker, tmp_path):
+        output_path = str(tmp_path / "closures.prof")
+        mocker.patch.dict(
+            os.environ, {"PROFILING_MODE": "True", "PROFILE_OUTPUT_PATH": output_path}
+        )
+
+        with profiling.profile_run():
+            _allocate()
+
+        function_names = [
+            function[2] for function in pstats.Stats(output_path).stats.keys()
+        ]
+        assert "_allocate" in function_names
+        test_instance.info.assert_called_with(f"Wrote profile to {output_path}")
+
+    def test_profile_run_error(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"PROFILING_MODE": "True"})
+
+        with pytest.raises(ValueError):
+            with profiling.profile_run():
+                raise ValueError()
+
+        assert not tracemalloc.is_tracing()
+        test_instance.info.assert_called_once()
+
+    def test_profile_run_already_tracing(self, test_instance, mocker):
+        mocker.patch.dict(os.environ, {"PROFILING_MODE": "True"})
+        tracemalloc.start()
+        try:
+            with profiling.profile_run():
+                _allocate()
+
+            assert tracemalloc.is_tracing()
+        finally:
+            tracemalloc.stop()
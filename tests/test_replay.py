@@ -0,0 +1,184 @@
+import csv
+import lambda_function
+import os
+import pytest
+
+from benchmarks import replay
+from benchmarks.alert_generator import generate_alert_rows
+from datetime import datetime, time, timezone
+from tests.test_closure_engine import normalize_closures
+
+
+def write_snapshot(path, columns, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(
+            ["" if value is None else value for value in row] for row in rows
+        )
+    return str(path)
+
+
+class TestReplay:
+    @pytest.fixture
+    def test_instance(self, mocker, tmp_path):
+        mocker.patch.dict(os.environ)
+        raw_alerts = generate_alert_rows(location_count=20)
+        hours = {(row[0], row[8], row[9]) for row in raw_alerts if row[8] is not None}
+        # 2023-01-01 is a Sunday, and Redshift blank-pads the weekday names
+        hours_rows = [
+            (location_id, "Sunday   ", regular_open, regular_close, "t")
+            for location_id, regular_open, regular_close in sorted(hours)
+        ] + [
+            (location_id, "Sunday", time(0), time(23, 59), "f")
+            for location_id, _, _ in sorted(hours)
+        ]
+        alerts_path = write_snapshot(
+            tmp_path / "alerts.csv",
+            replay.STAGED_ALERTS_COLUMNS,
+            [row[:8] for row in raw_alerts],
+        )
+        hours_path = write_snapshot(
+            tmp_path / "hours.csv", replay.HOURS_COLUMNS, hours_rows
+        )
+        return raw_alerts, alerts_path, hours_path
+
+    def test_load_snapshots(self, test_instance):
+        raw_alerts, alerts_path, hours_path = test_instance
+
+        alerts = replay.load_alerts_snapshot(alerts_path)
+        hours = replay.load_hours_snapshot(hours_path)
+
+        assert alerts == [row[:8] for row in raw_alerts]
+        assert isinstance(alerts[0][7], datetime)
+        assert alerts[0][7].tzinfo == timezone.utc
+        assert hours[0][1] == "Sunday   "
+        assert isinstance(hours[0][2], time)
+        assert hours[0][4] is True
+        assert hours[-1][4] is False
+
+    def test_load_snapshot_missing_columns(self, test_instance, tmp_path):
+        path = write_snapshot(tmp_path / "hours.csv", ["location_id", "weekday"], [])
+
+        with pytest.raises(replay.ReplayError):
+            replay.load_hours_snapshot(path)
+
+    @pytest.mark.parametrize(
+        "mode_env_vars",
+        [
+            {},
+            {"FAST_PATH_MAX_ROWS": "0"},
+            {"REDUCED_ALERTS_MODE": "True"},
+            {"ALERTS_BATCH_SIZE": "100"},
+            {"INCREMENTAL_MODE": "True"},
+            {"HOURS_INDEX_MODE": "True"},
+            {"HOURS_INDEX_MODE": "True", "INCREMENTAL_MODE": "True"},
+            {"IDEMPOTENCY_MODE": "True"},
+            {"IDEMPOTENCY_MODE": "True", "COLUMNAR_FETCH_MODE": "True"},
+            {"BACKFILL_MODE": "True"},
+            {"BACKFILL_MODE": "True", "HOURS_INDEX_MODE": "True"},
+            {"COLUMNAR_FETCH_MODE": "True"},
+            {"COLUMNAR_FETCH_MODE": "True", "BACKFILL_MODE": "True"},
+            {"SPLIT_CLOSURES_MODE": "True"},
+            {
+                "PARALLEL_MODE": "True",
+                "PARALLEL_MIN_ROWS": "1",
+                "FAST_PATH_MAX_ROWS": "0",
+            },
+            {"ALERTS_SNAPSHOT_FORMAT": "parquet", "ALERTS_SNAPSHOT_BUCKET": "bucket"},
+            {"PROFILING_MODE": "True"},
+        ],
+    )
+    def test_replay(self, test_instance, tmp_path, mode_env_vars):
+        raw_alerts, alerts_path, hours_path = test_instance
+        os.environ.update(mode_env_vars)
+        os.environ["ALERTS_SNAPSHOT_DIR"] = str(tmp_path)
+        expected_closures = lambda_function.get_closures_from_rows(raw_alerts)
+
+        client, run_metrics = replay.replay(
+            replay.load_alerts_snapshot(alerts_path),
+            replay.load_hours_snapshot(hours_path),
+        )
+
+        assert sorted(normalize_closures(client.closures), key=str) == sorted(
+            normalize_closures(expected_closures), key=str
+        )
+        assert client.alerts == []
+        assert len(client.transactions) == 1
+        assert run_metrics.counts["Closures"] == len(expected_closures)
+        assert "Aggregate" in run_metrics.timings
+        if "ALERTS_SNAPSHOT_FORMAT" in mode_env_vars:
+            assert len(list(tmp_path.glob("*.parquet"))) == 1
+
+    def test_replay_pipeline_mode(self, test_instance):
+        raw_alerts, alerts_path, hours_path = test_instance
+        os.environ.update({"ALERTS_BATCH_SIZE": "100", "PIPELINE_MODE": "True"})
+        expected_closures = lambda_function.get_closures_from_rows(raw_alerts)
+
+        client, run_metrics = replay.replay(
+            replay.load_alerts_snapshot(alerts_path),
+            replay.load_hours_snapshot(hours_path),
+        )
+
+        assert sorted(normalize_closures(client.closures), key=str) == sorted(
+            normalize_closures(expected_closures), key=str
+        )
+        assert client.alerts == []
+        # The pipeline's inserts and deletion are committed together
+        assert len(client.transactions) == 1
+        assert len(client.transactions[0]) > 2
+        assert run_metrics.counts["Closures"] == len(expected_closures)
+        assert "Pipeline" in run_metrics.timings
+
+    def test_replay_pipeline_mode_rollback(self, test_instance):
+        client = replay.ReplayRedshiftClient([], [])
+        cursor = client.conn.cursor()
+
+        cursor.execute("BEGIN TRANSACTION;")
+        cursor.execute("DELETE FROM {};".format(replay.CLOSURE_ALERTS_TABLE))
+        cursor.execute("END TRANSACTION;")
+        client.conn.rollback()
+        client.conn.commit()
+
+        assert client.transactions == []
+        with pytest.raises(replay.ReplayError):
+            cursor.execute("DELETE FROM {};".format(replay.CLOSURE_ALERTS_TABLE))
+
+    def test_replay_idempotency_mode(self, test_instance):
+        _, alerts_path, hours_path = test_instance
+        os.environ["IDEMPOTENCY_MODE"] = "True"
+        replay.replay(
+            replay.load_alerts_snapshot(alerts_path),
+            replay.load_hours_snapshot(hours_path),
+        )
+
+        # Each replay starts with an empty cache, so the closures cached by the
+        # first one aren't reused
+        _, run_metrics = replay.replay(
+            replay.load_alerts_snapshot(alerts_path),
+            replay.load_hours_snapshot(hours_path),
+        )
+
+        assert "Fingerprint" in run_metrics.timings
+        assert "RetriedAlerts" not in run_metrics.counts
+
+    def test_format_replay(self, test_instance):
+        _, alerts_path, hours_path = test_instance
+        client, run_metrics = replay.replay(
+            replay.load_alerts_snapshot(alerts_path),
+            replay.load_hours_snapshot(hours_path),
+        )
+
+        output = replay.format_replay(client, run_metrics)
+
+        assert "Stage timings (ms):" in output
+        assert "INSERT INTO location_closures_v2" in output
+        assert "Closures ({}):".format(len(client.closures)) in output
+
+    def test_unexpected_query(self):
+        client = replay.ReplayRedshiftClient([], [])
+
+        with pytest.raises(replay.ReplayError):
+            client.execute_query("SELECT * FROM location_closures_v2;")
+        with pytest.raises(replay.ReplayError):
+            client.execute_transaction([("DROP TABLE location_closures_v2;", None)])
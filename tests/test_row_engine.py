@@ -0,0 +1,129 @@
+import lambda_function
+import metrics
+import os
+import pandas as pd
+import pytest
+import row_engine
+
+from datetime import date, datetime, time
+from pytz import timezone
+from tests.test_closure_engine import (
+    build_random_alerts,
+    normalize_closures,
+    to_raw_alerts,
+)
+
+
+class TestRowEngine:
+    @pytest.fixture
+    def test_instance(self, mocker):
+        mocker.patch("lambda_function.create_log")
+        row_engine.localize_eastern.cache_clear()
+
+    @pytest.mark.parametrize("seed", range(40))
+    @pytest.mark.parametrize("polling_date", ["2023-01-01", "2023-03-12", "2023-11-05"])
+    def test_matches_columnar_engine(self, test_instance, seed, polling_date):
+        alerts_df = build_random_alerts(seed, polling_date)
+
+        assert normalize_closures(
+            lambda_function.get_closures_from_rows(to_raw_alerts(alerts_df))
+        ) == normalize_closures(lambda_function.get_closures(alerts_df.copy()))
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_metrics_match_columnar_engine(self, test_instance, seed):
+        alerts_df = build_random_alerts(seed, "2023-03-12")
+
+        row_metrics = metrics.start_run()
+        lambda_function.get_closures_from_rows(to_raw_alerts(alerts_df))
+        columnar_metrics = metrics.start_run()
+        lambda_function.get_closures(alerts_df.copy())
+
+        assert row_metrics.counts["AlertGroups"] > 0
+        assert row_metrics.counts == columnar_metrics.counts
+
+    @pytest.mark.parametrize("seed", range(40))
+    @pytest.mark.parametrize("polling_date", ["2023-01-01", "2023-03-12", "2023-11-05"])
+    def test_split_closures_match_columnar_engine(
+        self, test_instance, mocker, seed, polling_date
+    ):
+        mocker.patch.dict(os.environ, {"SPLIT_CLOSURES_MODE": "True"})
+        alerts_df = build_random_alerts(seed, polling_date)
+
+        row_metrics = metrics.start_run()
+        row_closures = lambda_function.get_closures_from_rows(to_raw_alerts(alerts_df))
+        columnar_metrics = metrics.start_run()
+        columnar_closures = lambda_function.get_closures(alerts_df.copy())
+
+        assert normalize_closures(row_closures) == normalize_closures(columnar_closures)
+        assert row_metrics.counts == columnar_metrics.counts
+
+    def test_no_alerts(self, test_instance):
+        assert lambda_function.get_closures_from_rows([]) is None
+
+    def test_empty_closures(self, test_instance):
+        alerts_df = build_random_alerts(0, "2023-01-01")
+        alerts_df = alerts_df[
+            alerts_df["location_id"] == "location_closure_alert_poller"
+        ]
+
+        assert lambda_function.get_closures_from_rows(to_raw_alerts(alerts_df)) is None
+
+    def test_multiple_days(self, test_instance):
+        alerts_df = pd.concat(
+            [
+                build_random_alerts(0, "2023-01-01"),
+                build_random_alerts(0, "2023-01-02"),
+            ],
+            ignore_index=True,
+        )
+
+        with pytest.raises(lambda_function.LocationClosureAggregatorError):
+            lambda_function.get_closures_from_rows(to_raw_alerts(alerts_df))
+
+    @pytest.mark.parametrize(
+        "local_date", [date(2023, 1, 1), date(2023, 3, 12), date(2023, 11, 5)]
+    )
+    @pytest.mark.parametrize(
+        "wall_time", [time(0), time(1, 30), time(2, 30), time(9), time(23, 59, 59)]
+    )
+    def test_localize_eastern(self, test_instance, local_date, wall_time):
+        expected = timezone("US/Eastern").localize(
+            datetime.combine(local_date, wall_time)
+        )
+
+        localized = row_engine.localize_eastern(local_date, wall_time)
+
+        assert localized == expected
+        assert localized.utcoffset() == expected.utcoffset()
+        assert row_engine.localize_eastern(local_date, wall_time) is localized
+
+    def test_localize_cache_stats(self, test_instance):
+        assert row_engine.localize_cache_stats()["hit_rate"] == 0.0
+
+        for _ in range(3):
+            row_engine.localize_eastern(date(2023, 1, 1), time(9))
+        row_engine.localize_eastern(date(2023, 1, 1), time(17))
+
+        assert row_engine.localize_cache_stats() == {
+            "hits": 2,
+            "misses": 2,
+            "size": 2,
+            "hit_rate": 0.5,
+        }
+
+    def test_localize_cache_eviction(self, test_instance):
+        for minute in range(row_engine._LOCALIZE_CACHE_SIZE + 10):
+            row_engine.localize_eastern(
+                date(2023, 1, 1), time(minute // 60, minute % 60)
+            )
+
+        assert (
+            row_engine.localize_cache_stats()["size"] == row_engine._LOCALIZE_CACHE_SIZE
+        )
+
+    def test_localize_cache_hits(self, test_instance):
+        alerts_df = build_random_alerts(0, "2023-01-01")
+
+        lambda_function.get_closures_from_rows(to_raw_alerts(alerts_df))
+
+        assert row_engine.localize_cache_stats()["hits"] > 0